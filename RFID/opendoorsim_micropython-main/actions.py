@@ -0,0 +1,79 @@
+# actions.py - Special event rules and action dispatch
+
+# --- Action Registry ---
+# Maps an events.json 'action' string to a handler taking the event's params dict.
+# main.py registers the built-in actions at import; new action types only need a
+# register_action() call before the events are compiled.
+
+ACTIONS = {}
+
+def register_action(name, handler):
+    """Registers handler(params) for events whose 'action' is name."""
+    ACTIONS[name] = handler
+
+# --- Compiled Event Rules ---
+# events.json is compiled once into lookup tiers so a swipe or MQTT command is
+# matched with at most four dict lookups however many events there are:
+#   exact      (FC, CN) -> rule
+#   FC wildcard   CN    -> rule   (event has no FC)
+#   CN wildcard   FC    -> rule   (event has no CN)
+#   catch-all             rule    (event has neither)
+# Each tier keeps the first event for its key, and the earliest of the candidates
+# wins, so the result is the same as scanning the list in order.
+
+class EventRule:
+    """One compiled events.json entry with its action resolved to a handler."""
+    __slots__ = ('index', 'fc', 'cn', 'action', 'params', 'handler')
+
+    def __init__(self, index, event):
+        self.index = index
+        self.fc = event.get('FC')
+        self.cn = event.get('CN')
+        self.action = event.get('action')
+        self.params = event.get('params', {})
+        self.handler = ACTIONS.get(self.action) # None for unknown actions
+
+    def run(self):
+        if self.handler is None:
+            print(f"Unknown action: {self.action}")
+            return
+        self.handler(self.params)
+
+class EventRules:
+    """Tiered first-match lookup over a list of events.json entries."""
+    __slots__ = ('events', '_exact', '_any_fc', '_any_cn', '_catch_all')
+
+    def __init__(self, events=None):
+        self.events = events if events is not None else []
+        exact = {}
+        any_fc = {}
+        any_cn = {}
+        catch_all = None
+        for index, event in enumerate(self.events):
+            rule = EventRule(index, event)
+            if rule.fc is None and rule.cn is None:
+                if catch_all is None:
+                    catch_all = rule
+            elif rule.fc is None:
+                if rule.cn not in any_fc:
+                    any_fc[rule.cn] = rule
+            elif rule.cn is None:
+                if rule.fc not in any_cn:
+                    any_cn[rule.fc] = rule
+            elif (rule.fc, rule.cn) not in exact:
+                exact[(rule.fc, rule.cn)] = rule
+        self._exact = exact
+        self._any_fc = any_fc
+        self._any_cn = any_cn
+        self._catch_all = catch_all
+
+    def __len__(self):
+        return len(self.events)
+
+    def match(self, fc, cn):
+        """Returns the first rule matching FC and CN, or None."""
+        best = self._exact.get((fc, cn))
+        for rule in (self._any_fc.get(cn), self._any_cn.get(fc), self._catch_all):
+            if rule is not None and (best is None or rule.index < best.index):
+                best = rule
+        return best
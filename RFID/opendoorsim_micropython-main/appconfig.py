@@ -0,0 +1,285 @@
+# appconfig.py - config.json parsed once into a typed object shared by boot.py, main.py and webserver.py
+
+import json
+import datastore
+
+CONFIG_PATH = 'config.json'
+
+# --- Field Types ---
+# Each converter takes a JSON or form value and returns the typed value, raising
+# ValueError (or TypeError) if it does not fit its type or range. A bad value in
+# config.json falls back to the default at boot; update() rejects it outright.
+
+def _int(value):
+    if isinstance(value, bool):
+        raise ValueError(f"expected a number, got {value}")
+    return int(value)
+
+def _opt_int(value):
+    """int, or None for an unused pin or timer (null, '' or 'none')."""
+    if value is None or (isinstance(value, str) and value.strip().lower() in ('', 'none', 'null')):
+        return None
+    return _int(value)
+
+def _float(value):
+    return float(value)
+
+def _bool(value):
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ('1', 'true', 'on', 'yes'):
+            return True
+        if value in ('0', 'false', 'off', 'no', ''):
+            return False
+        raise ValueError(f"expected true/false, got {value}")
+    return bool(value)
+
+def _str(value):
+    return '' if value is None else str(value)
+
+def _dict(value):
+    if not isinstance(value, dict):
+        raise ValueError("expected an object")
+    return value
+
+def _opt_list(value):
+    if value is not None and not isinstance(value, list):
+        raise ValueError("expected a list")
+    return value
+
+def _ranged(convert, low=None, high=None):
+    """A converter that also requires low <= value <= high (None = unbounded; None values pass)."""
+    def check(value):
+        value = convert(value)
+        if value is not None and ((low is not None and value < low) or (high is not None and value > high)):
+            raise ValueError(f"{value} is not in {low}..{high}")
+        return value
+    return check
+
+def _choice(*choices):
+    def check(value):
+        value = _str(value).lower()
+        if value not in choices:
+            raise ValueError(f"expected one of {', '.join(choices)}, got '{value}'")
+        return value
+    return check
+
+def _fp_rate(value):
+    """Bloom filter false-positive rate: 0 (no filter) or strictly between 0 and 1."""
+    value = _float(value)
+    if not 0 <= value < 1:
+        raise ValueError(f"{value} is not 0 or between 0 and 1")
+    return value
+
+MODES = ('raw', 'doorsim', 'accessory')
+
+_pin = _ranged(_int, 0, 48)
+_opt_pin = _ranged(_opt_int, 0, 48)
+
+def _light_pins(value):
+    """{light id: GPIO or None}; ids must be integers (kept as strings, as JSON stores them)."""
+    lights = {}
+    for light_id, pin in _dict(value).items():
+        try:
+            light_id = _int(light_id)
+        except (ValueError, TypeError):
+            raise ValueError(f"light id '{light_id}' is not a number")
+        lights[str(light_id)] = _opt_pin(pin)
+    return lights
+
+# Lockouts and windows are kept well under half the ticks_ms period (2^30 ms)
+MAX_INTERVAL_S = 86400
+
+# name, converter, default
+FIELDS = (
+    ('MODE', _choice(*MODES), 'doorsim'),
+    ('MRACS_ENABLED', _bool, False),
+    ('D0_PIN', _pin, 21),
+    ('D1_PIN', _pin, 22),
+    ('MAX_BITS', _ranged(_int, 8, 256), 96),
+    ('CARD_READ_TIMEOUT_MS', _ranged(_int, 1, 10000), 200),
+    ('ISR_EMITTER', _choice('viper', 'native', 'python'), 'viper'),
+    ('FRAME_QUEUE_SIZE', _ranged(_int, 1, 64), 8),
+    ('FRAME_TIMER_ID', _ranged(_opt_int, -1, 15), 0),
+    ('ADAPTIVE_TIMEOUT', _bool, True),
+    ('ADAPTIVE_GAP_MULTIPLIER', _ranged(_int, 1, 64), 4),
+    ('GLITCH_FILTER_US', _ranged(_int, 0, 10000), 0),
+    ('MIN_FRAME_BITS', _ranged(_int, 1, 256), 4),
+    ('MAX_GLITCHES', _ranged(_int, 0, 255), 2),
+    ('PULSE_CAPTURE', _bool, False),
+    ('READERS', _opt_list, None),
+    ('USER_STORE', _str, ''),
+    ('BLOOM_FP_RATE', _fp_rate, 0.01),
+    ('BLOOM_MAX_BYTES', _ranged(_int, 8, 262144), 16384),
+    ('JOURNAL_COMPACT_OPS', _ranged(_int, 1, 10000), 32),
+    ('CARD_RATE_LIMIT', _ranged(_int, 0, 65534), 10),
+    ('READER_DENY_LIMIT', _ranged(_int, 0, 65534), 20),
+    ('RATE_LOCKOUT_S', _ranged(_int, 0, MAX_INTERVAL_S), 60),
+    ('RATE_WINDOW_S', _ranged(_int, 1, MAX_INTERVAL_S), 60),
+    ('RATE_SKETCH_WIDTH', _ranged(_int, 16, 16384), 256),
+    ('RATE_HOT_KEYS', _ranged(_int, 1, 64), 8),
+    ('DOOR_PIN', _opt_pin, None),
+    ('LIGHT_PINS', _light_pins, {}),
+    ('BUZZER_PIN', _opt_pin, None),
+    ('OUTPUT_ACTIVE_LOW', _bool, False),
+    ('SCL_PIN', _pin, 18),
+    ('SDA_PIN', _pin, 19),
+    ('SCREEN_WIDTH', _ranged(_int, 1, 1024), 128),
+    ('SCREEN_HEIGHT', _ranged(_int, 1, 1024), 32),
+    ('OLED_FLIPPED', _bool, False),
+    ('MQTT_BROKER', _str, '192.168.1.100'),
+    ('MQTT_PORT', _ranged(_int, 1, 65535), 1883),
+    ('MQTT_CLIENT_ID', _str, ''),
+    ('MQTT_USERNAME', _str, ''),
+    ('MQTT_PASSWORD', _str, ''),
+    ('MQTT_TOPIC_PREFIX', _str, 'opendoorsim'),
+)
+
+_CONVERTERS = {name: convert for name, convert, _ in FIELDS}
+
+# Settings main.py applies to the running system when they change; everything
+# else (pins, mode, readers, MQTT connection, display) takes effect at the next boot.
+LIVE_FIELDS = ('BLOOM_FP_RATE', 'BLOOM_MAX_BYTES', 'JOURNAL_COMPACT_OPS', 'MQTT_TOPIC_PREFIX',
+               'CARD_RATE_LIMIT', 'READER_DENY_LIMIT', 'RATE_LOCKOUT_S')
+
+
+class ConfigConflict(ValueError):
+    """The config changed since the version an update was based on."""
+
+# --- Config ---
+# Read with attributes (config.MAX_BITS) on hot paths; get()/[] are kept for
+# per-reader overrides and unknown keys, which are preserved in 'extra'.
+
+class Config:
+    """Typed, validated settings from config.json plus values derived from them."""
+    __slots__ = tuple(name for name, _, _ in FIELDS) + (
+        'path', 'version', 'error', 'extra', 'listeners',
+        'mode', 'frame_words', 'mqtt_active', 'start_ap', 'light_pins')
+
+    def __init__(self, data=None, path=CONFIG_PATH):
+        self.path = path
+        self.version = 1
+        self.error = None      # Why config.json could not be used as-is, or None
+        self.extra = {}
+        self.listeners = []    # Called with (config, changed names) after each update()
+        data = data or {}
+        for name, convert, default in FIELDS:
+            value = default
+            if name in data:
+                try:
+                    value = convert(data[name])
+                except (ValueError, TypeError) as e:
+                    print(f"config.json: bad {name} ({e}), using {default}")
+                    self.error = f"bad {name}"
+            setattr(self, name, value)
+        for key, value in data.items():
+            if key not in _CONVERTERS:
+                self.extra[key] = value
+        self._derive()
+
+    def _derive(self):
+        mode = self.MODE.lower()
+        self.mode = mode if mode in MODES else 'doorsim'
+        self.frame_words = (self.MAX_BITS + 31) // 32
+        self.mqtt_active = self.MRACS_ENABLED and self.mode in ('doorsim', 'accessory')
+        self.start_ap = self.mode == 'raw' or (self.mode == 'doorsim' and not self.MRACS_ENABLED)
+        self.light_pins = {int(light_id): pin for light_id, pin in self.LIGHT_PINS.items()}
+
+    def get(self, key, default=None):
+        """dict-style lookup, for code that handles config.json keys by name."""
+        if key in _CONVERTERS:
+            return getattr(self, key)
+        return self.extra.get(key, default)
+
+    def __getitem__(self, key):
+        if key in _CONVERTERS:
+            return getattr(self, key)
+        return self.extra[key]
+
+    def __contains__(self, key):
+        return key in _CONVERTERS or key in self.extra
+
+    def to_dict(self):
+        """The settings as config.json stores them."""
+        data = {name: getattr(self, name) for name, _, _ in FIELDS}
+        data.update(self.extra)
+        return data
+
+    def update(self, changes, version=None):
+        """
+        Validates changes ({name: value}), applies and derives them, persists
+        the result and increments version. With version given, raises ConfigConflict if the
+        config has changed since then (e.g. a stale web form). Raises ValueError
+        for an unknown name or a bad value; nothing is changed in that case.
+        Returns the names whose values changed.
+        """
+        if version is not None and version != self.version:
+            raise ConfigConflict(f"config is at version {self.version}, not {version}")
+        values = {}
+        for name, value in changes.items():
+            convert = _CONVERTERS.get(name)
+            if convert is None:
+                raise ValueError(f"unknown setting {name}")
+            try:
+                value = convert(value)
+            except (ValueError, TypeError) as e:
+                raise ValueError(f"bad {name}: {e}")
+            if value != getattr(self, name):
+                values[name] = value
+        if not values:
+            return ()
+        data = self.to_dict()
+        data.update(values)
+        previous = {name: getattr(self, name) for name in values}
+        for name, value in values.items():
+            setattr(self, name, value)
+        try:
+            self._derive()
+            save(data, self.path) # Only a fully derived config is persisted
+        except Exception:
+            # Roll back, so RAM never runs ahead of flash
+            for name, value in previous.items():
+                setattr(self, name, value)
+            self._derive()
+            raise
+        self.version += 1
+        changed = tuple(values)
+        for listener in self.listeners:
+            try:
+                listener(self, changed)
+            except Exception as e:
+                print(f"Config listener failed: {e}")
+        return changed
+
+def save(data, path=CONFIG_PATH):
+    """Writes a config dict to path through a temp file."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    datastore.replace_file(tmp_path, path)
+
+# --- Shared Instance ---
+# boot.py runs first in the same interpreter, so its import parses config.json
+# and main.py and webserver.py reuse the same object.
+
+_config = None
+
+def load(path=CONFIG_PATH):
+    """Parses config.json into a new shared Config (defaults if it cannot be read)."""
+    global _config
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        config = Config(data, path)
+    except (OSError, ValueError) as e:
+        print(f"Error loading {path}: {e}")
+        config = Config(None, path)
+        config.error = str(e)
+    _config = config
+    return config
+
+def get():
+    """Returns the shared Config, parsing config.json on first use."""
+    if _config is None:
+        return load()
+    return _config
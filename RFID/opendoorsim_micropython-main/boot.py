@@ -1,27 +1,13 @@
 # boot.py - WiFi Access Point Setup
 
 import network
-import json
 import machine
 import utime
-
-def load_config():
-    """Loads configuration from config.json file."""
-    try:
-        with open('config.json', 'r') as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"Error loading config.json in boot.py: {e}")
-        return {
-            "MODE": "doorsim",
-            "MRACS_ENABLED": False
-        }
+import appconfig
 
 def setup_wifi():
     """Set up WiFi Access Point or Station mode based on MODE and MRACS settings."""
-    config = load_config()
-    mode = config.get('MODE', 'doorsim').lower()
-    mracs_enabled = config.get('MRACS_ENABLED', False)
+    config = appconfig.get() # Parsed once here and shared with main.py and webserver.py
     
     ap = network.WLAN(network.AP_IF)
     sta = network.WLAN(network.STA_IF)
@@ -31,13 +17,9 @@ def setup_wifi():
     sta.active(False)
     utime.sleep_ms(100)
     
-    # Determine if we should start Access Point
-    start_ap = False
-    if mode == 'raw':
-        start_ap = True
-    elif mode == 'doorsim' and not mracs_enabled:
-        start_ap = True
-    # If mode is 'accessory' or 'doorsim' with MRACS enabled, don't start AP
+    # Start the Access Point in raw mode, or doorsim without MRACS
+    # (not in 'accessory' or 'doorsim' with MRACS enabled)
+    start_ap = config.start_ap
     
     if start_ap:
         # Start Access Point
@@ -0,0 +1,350 @@
+# credentials.py - Credential lookup for access decisions
+import math
+import struct
+import datastore
+
+# --- User Index ---
+# Built once per user set so a swipe is decided with a single dict lookup instead
+# of a walk over every user. Formats without a facility code (e.g. the 37-bit
+# H10302) report FC -1 and are matched on CN alone, as find_user() always did.
+# When several users share a key the first one in users.json wins, matching the
+# old linear scan.
+
+class UserIndex:
+    """(FC, CN) and CN-only lookup tables over a list of user dicts."""
+    __slots__ = ('users', '_by_key', '_by_cn')
+
+    def __init__(self, users=None):
+        self.users = users if users is not None else []
+        by_key = {}
+        by_cn = {}
+        for user in self.users:
+            cn = user.get('CN')
+            key = (user.get('FC'), cn)
+            if key not in by_key:
+                by_key[key] = user
+            if cn not in by_cn:
+                by_cn[cn] = user
+        self._by_key = by_key
+        self._by_cn = by_cn
+
+    def __len__(self):
+        return len(self.users)
+
+    def find(self, fc, cn):
+        """Returns the user dict for a card, or None. FC -1 matches on CN only."""
+        if fc == -1:
+            return self._by_cn.get(cn)
+        return self._by_key.get((fc, cn))
+
+    def put(self, user):
+        """Adds or replaces one user in the lookup tables (self.users is not touched)."""
+        cn = user.get('CN')
+        key = (user.get('FC'), cn)
+        self._by_key[key] = user
+        current = self._by_cn.get(cn)
+        if current is None or (current.get('FC'), cn) == key:
+            self._by_cn[cn] = user
+
+    def remove(self, fc, cn):
+        """Drops one (FC, CN) key from the lookup tables."""
+        user = self._by_key.pop((fc, cn), None)
+        if user is not None and self._by_cn.get(cn) is user:
+            del self._by_cn[cn]
+            # The next indexed user with this CN takes over CN-only lookups
+            for other in self.users:
+                if other.get('CN') == cn and self._by_key.get((other.get('FC'), cn)) is other:
+                    self._by_cn[cn] = other
+                    break
+
+# --- Flash Credential Store ---
+# A sorted file of fixed-width records searched in place with seek()/readinto(),
+# so RAM use does not grow with the number of badges. Layout (big-endian, so the
+# packed (FC, CN) key sorts the same as the numbers):
+#
+#   header    magic 'ODSU', version, record size, record count,
+#             CN index offset, CN index count, text offset
+#   records   FC u32, CN u64, flags u16, group u16, text offset u32
+#             sorted by (FC, CN)
+#   CN index  CN u64, record number u32, sorted by CN (for FC -1 lookups)
+#   text      per record: name length u8, name, flag length u8, flag (UTF-8)
+#
+# Duplicate keys keep the first user in source order, as UserIndex does.
+# Changes made after the store was written (see datastore.py) are held in two
+# small dicts in RAM and checked first, until the store is rewritten.
+
+STORE_MAGIC = b'ODSU'
+STORE_VERSION = 1
+_HEADER = '>4sHHIIII'
+_HEADER_SIZE = 24
+_RECORD = '>IQHHI'
+_RECORD_SIZE = 20
+_CN_ENTRY = '>QI'
+_CN_ENTRY_SIZE = 12
+FLAG_ACTIVE = 0x0001
+
+class CredentialStore:
+    """Lookups in a flash credential store written by write_store()."""
+    __slots__ = ('path', 'count', '_file', '_cn_offset', '_cn_count', '_text_offset', '_record', '_entry', '_length',
+                 '_changed', '_changed_cn')
+
+    def __init__(self, path):
+        self.path = path
+        self._record = bytearray(_RECORD_SIZE)
+        self._entry = bytearray(_CN_ENTRY_SIZE)
+        self._length = bytearray(1)
+        self._file = open(path, 'rb')
+        header = self._file.read(_HEADER_SIZE)
+        if len(header) != _HEADER_SIZE:
+            self._file.close()
+            raise ValueError(f"{path}: truncated header")
+        magic, version, record_size, count, cn_offset, cn_count, text_offset = struct.unpack(_HEADER, header)
+        if magic != STORE_MAGIC or version != STORE_VERSION or record_size != _RECORD_SIZE:
+            self._file.close()
+            raise ValueError(f"{path}: not a version {STORE_VERSION} credential store")
+        self.count = count
+        self._cn_offset = cn_offset
+        self._cn_count = cn_count
+        self._text_offset = text_offset
+        self._changed = {}     # (FC, CN) -> user dict, or None once deleted
+        self._changed_cn = {}  # CN -> user dict, or None once deleted
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._file.close()
+
+    def _read_record(self, number):
+        self._file.seek(_HEADER_SIZE + number * _RECORD_SIZE)
+        self._file.readinto(self._record)
+        return struct.unpack_from(_RECORD, self._record)
+
+    def _read_text(self):
+        self._file.readinto(self._length)
+        return self._file.read(self._length[0]).decode('utf-8') if self._length[0] else ''
+
+    def _user(self, record):
+        """Builds the user dict for a matched record (only done on a hit)."""
+        fc, cn, flags, group, text_offset = record
+        self._file.seek(self._text_offset + text_offset)
+        name = self._read_text()
+        flag = self._read_text()
+        return {'FC': fc, 'CN': cn, 'Name': name, 'Flag': flag, 'active': bool(flags & FLAG_ACTIVE), 'group': group}
+
+    def find(self, fc, cn):
+        """Returns the user dict for a card, or None. FC -1 matches on CN only."""
+        if fc == -1:
+            if cn in self._changed_cn:
+                return self._changed_cn[cn]
+            return self._find_cn(cn)
+        key = (fc, cn)
+        if key in self._changed:
+            return self._changed[key]
+        low = 0
+        high = self.count - 1
+        while low <= high:
+            mid = (low + high) >> 1
+            record = self._read_record(mid)
+            found = (record[0], record[1])
+            if found < key:
+                low = mid + 1
+            elif found > key:
+                high = mid - 1
+            else:
+                return self._user(record)
+        return None
+
+    def put(self, user):
+        """Records an added or changed user in RAM (the file is not modified)."""
+        cn = user.get('CN')
+        self._changed[(user.get('FC'), cn)] = user
+        self._changed_cn[cn] = user
+
+    def remove(self, fc, cn):
+        """Records a deleted (FC, CN) key in RAM (the file is not modified)."""
+        current = self.find(-1, cn)
+        self._changed[(fc, cn)] = None
+        if current is not None and current.get('FC') == fc:
+            # As in UserIndex.remove, another user with this CN takes over CN-only lookups
+            self._changed_cn[cn] = self._next_with_cn(cn)
+
+    def _next_with_cn(self, cn):
+        """
+        The first remaining user with this CN: from the file (lowest FC first, the
+        file's order), then from users added since it was written. Reads every
+        record, which is only done when a CN-only lookup's user is deleted.
+        """
+        for number in range(self.count):
+            record = self._read_record(number)
+            if record[1] != cn:
+                continue
+            key = (record[0], cn)
+            if key not in self._changed:
+                return self._user(record)
+            if self._changed[key] is not None:
+                return self._changed[key]
+        for key, user in self._changed.items():
+            if key[1] == cn and user is not None:
+                return user
+        return None
+
+    def keys(self):
+        """Yields the (FC, CN) key of every record, reading the file sequentially."""
+        for number in range(self.count):
+            record = self._read_record(number)
+            yield record[0], record[1]
+
+    def _find_cn(self, cn):
+        file = self._file
+        low = 0
+        high = self._cn_count - 1
+        while low <= high:
+            mid = (low + high) >> 1
+            file.seek(self._cn_offset + mid * _CN_ENTRY_SIZE)
+            file.readinto(self._entry)
+            found, number = struct.unpack_from(_CN_ENTRY, self._entry)
+            if found < cn:
+                low = mid + 1
+            elif found > cn:
+                high = mid - 1
+            else:
+                return self._user(self._read_record(number))
+        return None
+
+# --- Bloom Filter ---
+# Most swipes in the labs are unknown cards (FC/CN brute force). A small bit array
+# over the enrolled (FC, CN) keys answers "definitely not enrolled" with a few
+# hashes, so those cards are denied without touching the index or the flash store.
+# A hit may be a false positive and still goes through the full lookup.
+
+def _mix32(x):
+    """Scrambles a 32-bit integer (xorshift-multiply finalizer)."""
+    x = ((x >> 16) ^ x) * 0x45D9F3B & 0xFFFFFFFF
+    x = ((x >> 16) ^ x) * 0x45D9F3B & 0xFFFFFFFF
+    return (x >> 16) ^ x
+
+def key_hashes(fc, cn):
+    """Two independent 32-bit hashes of an (FC, CN) key, for double hashing."""
+    h = _mix32(_mix32(fc & 0xFFFFFFFF) ^ (cn & 0xFFFFFFFF))
+    h1 = _mix32(h ^ (cn >> 32))
+    h2 = _mix32(h1 ^ 0x9E3779B9) | 1
+    return h1, h2
+
+class BloomFilter:
+    """Bit-array Bloom filter over (FC, CN) keys."""
+    __slots__ = ('bits', 'hashes', 'count', '_array')
+
+    def __init__(self, capacity, fp_rate=0.01, max_bytes=16384):
+        # m = -n ln(p) / ln(2)^2 bits and k = (m / n) ln(2) hashes, capped at max_bytes
+        capacity = max(capacity, 1)
+        bits = int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)) + 1
+        bits = min(max(bits, 64), max_bytes * 8)
+        self.bits = bits
+        self.hashes = max(1, min(16, int(bits / capacity * math.log(2) + 0.5)))
+        self.count = 0
+        self._array = bytearray((bits + 7) >> 3)
+
+    def add(self, fc, cn):
+        h1, h2 = key_hashes(fc, cn)
+        array = self._array
+        for _ in range(self.hashes):
+            bit = h1 % self.bits
+            array[bit >> 3] |= 1 << (bit & 7)
+            h1 += h2
+        self.count += 1
+
+    def might_contain(self, fc, cn):
+        """False means the key was never added; True may be a false positive."""
+        h1, h2 = key_hashes(fc, cn)
+        array = self._array
+        for _ in range(self.hashes):
+            bit = h1 % self.bits
+            if not array[bit >> 3] & (1 << (bit & 7)):
+                return False
+            h1 += h2
+        return True
+
+    def fp_rate(self):
+        """Expected false-positive rate at the current fill: (1 - e^(-kn/m))^k."""
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    def size_bytes(self):
+        return len(self._array)
+
+def build_bloom(index, fp_rate=0.01, max_bytes=16384):
+    """Builds a BloomFilter over every (FC, CN) key of a UserIndex or CredentialStore."""
+    bloom = BloomFilter(len(index), fp_rate, max_bytes)
+    if isinstance(index, CredentialStore):
+        for fc, cn in index.keys():
+            bloom.add(fc, cn)
+    else:
+        for user in index.users:
+            fc = user.get('FC')
+            cn = user.get('CN')
+            if fc is not None and cn is not None:
+                bloom.add(fc, cn)
+    return bloom
+
+def _text_bytes(value):
+    data = str(value or '').encode('utf-8')[:255]
+    return bytes((len(data),)) + data
+
+def write_store(users, path):
+    """
+    Writes users (users.json schema) as a credential store at path. The file is
+    written to path + '.tmp' and renamed over the old one when complete.
+    Returns the number of records written.
+    """
+    # Keep the first user per key and per CN, in source order
+    by_key = {}
+    for user in users:
+        key = (user.get('FC'), user.get('CN'))
+        if key[0] is None or key[1] is None or key[0] < 0 or key in by_key:
+            continue
+        by_key[key] = user
+    keys = sorted(by_key)
+    numbers = {}
+    cn_first = {}
+    for number, key in enumerate(keys):
+        numbers[key] = number
+    for user in users:
+        key = (user.get('FC'), user.get('CN'))
+        if key in numbers and key[1] not in cn_first:
+            cn_first[key[1]] = numbers[key]
+
+    count = len(keys)
+    cn_offset = _HEADER_SIZE + count * _RECORD_SIZE
+    text_offset = cn_offset + len(cn_first) * _CN_ENTRY_SIZE
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack(_HEADER, STORE_MAGIC, STORE_VERSION, _RECORD_SIZE, count, cn_offset, len(cn_first), text_offset))
+        position = 0
+        texts = []
+        for key in keys:
+            user = by_key[key]
+            text = _text_bytes(user.get('Name')) + _text_bytes(user.get('Flag'))
+            flags = FLAG_ACTIVE if user.get('active', False) else 0
+            f.write(struct.pack(_RECORD, key[0], key[1], flags, user.get('group') or 0, position))
+            texts.append(text)
+            position += len(text)
+        for cn in sorted(cn_first):
+            f.write(struct.pack(_CN_ENTRY, cn, cn_first[cn]))
+        for text in texts:
+            f.write(text)
+    datastore.replace_file(tmp_path, path)
+    return count
+
+def convert_users_json(src='users.json', dst='users.bin'):
+    """Converts a users.json file into a credential store. Returns the record count."""
+    import json
+    with open(src, 'r') as f:
+        users = json.load(f)
+    return write_store(users, dst)
+
+if __name__ == '__main__':
+    # Host-side conversion: python3 credentials.py [users.json] [users.bin]
+    import sys
+    args = sys.argv[1:]
+    count = convert_users_json(*args)
+    print(f"Wrote {count} records to {args[1] if len(args) > 1 else 'users.bin'}")
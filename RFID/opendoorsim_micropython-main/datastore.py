@@ -0,0 +1,457 @@
+# datastore.py - Journaled storage for users.json and events.json
+
+import json
+import os
+
+def replace_file(tmp_path, path):
+    """Renames a completely written tmp_path over path."""
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # FAT cannot rename over an existing file
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        os.rename(tmp_path, path)
+
+def iter_records(path, chunk_size=256):
+    """Yields the objects of a JSON list file one at a time, reading it in chunks."""
+    try:
+        f = open(path, 'r')
+    except OSError:
+        return
+    with f:
+        depth = 0
+        in_string = escaped = False
+        start = None   # Where the current object began in this chunk
+        parts = []     # The current object's text from earlier chunks
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            for i, char in enumerate(chunk):
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif char == '\\':
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char in '{[':
+                    depth += 1
+                    if depth == 2 and char == '{':
+                        start = i
+                elif char in '}]':
+                    depth -= 1
+                    if depth == 1 and start is not None:
+                        parts.append(chunk[start:i + 1])
+                        yield json.loads(''.join(parts))
+                        parts = []
+                        start = None
+            if start is not None:
+                parts.append(chunk[start:])
+                start = 0
+
+# --- Journaled Store ---
+# Single-row edits (add, update, delete, set active) are appended to a journal
+# file next to the JSON file as one compact line each, so a change writes a few
+# dozen bytes however many rows there are. Loading reads the JSON file and
+# replays the journal over it. Once compact_ops changes have been journaled the
+# records are written to path + '.tmp', renamed over the JSON file and the
+# journal is removed.
+#
+# Journal lines (keys are [FC, CN] for users, the event 'id' for events and the
+# 'group' number for schedules):
+#   ["a", record]          add (replaces a record with the same key)
+#   ["u", key, record]     update the record at key (the key may change)
+#   ["d", key]             delete
+#   ["s", key, active]     set the 'active' flag
+#
+# Every operation gives the same result when replayed twice, so a crash between
+# the rename and removing the journal only re-applies changes already in the
+# file. A line cut short by a power loss fails to parse and is skipped; load()
+# then compacts at once, so later changes are never appended to the torn line
+# (if that fails, the next change starts on a new line instead).
+#
+# A store that is not resident (see release()) serves page() without loading:
+# one pass over the JSON file counts the records and keeps the few the journal
+# refers to, the journal is replayed over those, and a second pass yields the
+# requested slice with the changes applied.
+#
+# Listeners are called with each op once it is applied and journaled, or with
+# None when every record was replaced or reloaded. main.py uses them to update
+# the live user index and event rules as soon as the web interface saves a
+# change. Both run in the main loop, so a swipe sees either the old or the new
+# state, never a half-applied one.
+
+class JournaledStore:
+    """A JSON list of records with single-record updates journaled to flash."""
+    __slots__ = ('path', 'journal_path', 'key_func', 'auto_id', 'compact_ops', 'on_compact', 'listeners', 'resident',
+                 'generation', 'records', '_positions', '_journal_ops', '_next_id', '_torn')
+
+    def __init__(self, path, journal_path, key_func, auto_id=False, compact_ops=32):
+        self.path = path
+        self.journal_path = journal_path
+        self.key_func = key_func       # record -> key (tuple or int)
+        self.auto_id = auto_id         # Give records without a key the next integer 'id'
+        self.compact_ops = compact_ops
+        self.on_compact = None         # Called with the records after each compaction
+        self.listeners = []            # Called with each applied op (None = everything changed)
+        self.generation = 0            # Incremented on every change
+        self.records = None            # Loaded on first use
+        self.resident = True           # Keep records in RAM; False lets release() drop them
+        self._positions = {}
+        self._journal_ops = 0
+        self._next_id = 1
+        self._torn = False             # The journal ends in a partial line
+
+    # --- Loading ---
+
+    def get(self):
+        """Returns the current records, loading them on first use."""
+        if self.records is None:
+            self.load()
+        return self.records
+
+    def _recover(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            os.stat(self.path)
+        except OSError:
+            # A compaction was interrupted after removing the old file on FAT
+            try:
+                os.stat(tmp_path)
+                os.rename(tmp_path, self.path)
+            except OSError:
+                pass
+
+    def _journal_entries(self):
+        """Yields each journal op, or None for a line that does not parse (cut short)."""
+        try:
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        print(f"{self.journal_path}: ignoring truncated entry")
+                        op = None
+                    yield op
+        except OSError:
+            pass # No journal
+
+    def load(self):
+        """Reads the JSON file and replays the journal over it. Returns the records."""
+        self._recover()
+        try:
+            with open(self.path, 'r') as f:
+                records = json.load(f)
+        except OSError:
+            records = []
+        self._set_records(records)
+        self._journal_ops = 0
+        self._torn = False
+        for op in self._journal_entries():
+            if op is None:
+                self._torn = True
+                continue
+            self._apply(op)
+            self._journal_ops += 1
+        if self._torn:
+            try:
+                self.compact() # Drops the torn line with the rest of the journal
+            except OSError as e:
+                print(f"{self.path}: compaction after truncated entry failed: {e}")
+        self._changed(None)
+        return self.records
+
+    def release(self):
+        """
+        Drops the records from RAM unless resident (they are reloaded on next use).
+        For a store whose rows are served from elsewhere, e.g. users.json when
+        main.py looks users up in a USER_STORE credential store.
+        """
+        if not self.resident:
+            self.records = None
+            self._positions = {}
+
+    # --- Paging ---
+
+    def page(self, offset, limit):
+        """Returns (total, the records from offset, at most limit of them)."""
+        if self.records is not None or self.resident or self.auto_id:
+            records = self.get()
+            return len(records), records[offset:offset + limit]
+        self._recover()
+        ops = [op for op in self._journal_entries() if op is not None]
+        keys = set()
+        for op in ops:
+            if op[0] == 'a':
+                keys.add(self.key_func(op[1]))
+            else:
+                keys.add(self._key(op[1]))
+                if op[0] == 'u':
+                    keys.add(self.key_func(op[2]))
+        count = 0
+        positions = {}  # key -> file positions, for the keys the journal names
+        originals = {}  # file position -> record, for the same records
+        for record in iter_records(self.path):
+            key = self.key_func(record)
+            if key in keys:
+                positions.setdefault(key, []).append(count)
+                originals[count] = record
+            count += 1
+
+        # Replay the journal as _apply() does, over slots (0, file position) and
+        # (1, n) for the nth added record, each mapped to its record or None (deleted)
+        slots = {}
+        def find(key):
+            found = None
+            for position in positions.get(key, ()):
+                if (0, position) not in slots:
+                    found = (0, position)
+                    break
+            for slot, record in slots.items():
+                if record is not None and self.key_func(record) == key and (found is None or slot < found):
+                    found = slot
+            return found
+        added = 0
+        for op in ops:
+            kind = op[0]
+            if kind == 'u':
+                key = self._key(op[1])
+                slot = find(key)
+                if slot is not None:
+                    record = op[2]
+                    new_key = self.key_func(record)
+                    other = None if new_key == key else find(new_key)
+                    slots[slot] = record
+                    if other is not None:
+                        slots[other] = None # The new key replaces the record that had it
+                    continue
+                kind, op = 'a', ('a', op[2])
+            if kind == 'a':
+                slot = find(self.key_func(op[1]))
+                if slot is None:
+                    slot = (1, added)
+                    added += 1
+                slots[slot] = op[1]
+            elif kind == 'd':
+                slot = find(self._key(op[1]))
+                if slot is not None:
+                    slots[slot] = None
+            elif kind == 's':
+                slot = find(self._key(op[1]))
+                if slot is not None:
+                    record = dict(slots[slot] if slot in slots else originals[slot[1]])
+                    record['active'] = bool(op[2])
+                    slots[slot] = record
+
+        total = count
+        for slot, record in slots.items():
+            if slot[0] == 0 and record is None:
+                total -= 1
+            elif slot[0] == 1 and record is not None:
+                total += 1
+        page = []
+        if limit <= 0 or offset >= total:
+            return total, page
+        index = 0
+        for position, record in enumerate(iter_records(self.path)):
+            record = slots.get((0, position), record)
+            if record is None:
+                continue
+            if index >= offset:
+                page.append(record)
+                if len(page) >= limit:
+                    return total, page
+            index += 1
+        for n in range(added):
+            record = slots[(1, n)]
+            if record is None:
+                continue
+            if index >= offset:
+                page.append(record)
+                if len(page) >= limit:
+                    break
+            index += 1
+        return total, page
+
+    def _set_records(self, records):
+        self.records = records
+        self._next_id = 1
+        if self.auto_id:
+            for record in records:
+                if isinstance(record.get('id'), int) and record['id'] >= self._next_id:
+                    self._next_id = record['id'] + 1
+            for record in records:
+                if record.get('id') is None:
+                    record['id'] = self._next_id
+                    self._next_id += 1
+        self._reindex()
+
+    def _reindex(self):
+        positions = {}
+        for position, record in enumerate(self.records):
+            key = self.key_func(record)
+            if key not in positions:
+                positions[key] = position
+        self._positions = positions
+
+    def _key(self, key):
+        return tuple(key) if isinstance(key, list) else key
+
+    # --- Operations ---
+
+    def _apply(self, op):
+        """Applies one journal operation to the records in RAM."""
+        kind = op[0]
+        if kind == 'a':
+            record = op[1]
+            key = self.key_func(record)
+            position = self._positions.get(key)
+            if position is None:
+                self._positions[key] = len(self.records)
+                self.records.append(record)
+            else:
+                self.records[position] = record
+            if self.auto_id and record.get('id', 0) >= self._next_id:
+                self._next_id = record['id'] + 1
+        elif kind == 'u':
+            key = self._key(op[1])
+            record = op[2]
+            position = self._positions.get(key)
+            if position is None:
+                self._apply(('a', record)) # Already applied under its new key
+                return
+            self.records[position] = record
+            new_key = self.key_func(record)
+            if new_key != key:
+                other = self._positions.get(new_key)
+                if other is not None:
+                    self.records.pop(other) # The new key replaces the record that had it
+                self._reindex()
+        elif kind == 'd':
+            position = self._positions.get(self._key(op[1]))
+            if position is not None:
+                self._drop(position)
+        elif kind == 's':
+            position = self._positions.get(self._key(op[1]))
+            if position is not None:
+                self.records[position]['active'] = bool(op[2])
+
+    def _drop(self, position):
+        self.records.pop(position)
+        self._reindex()
+
+    def _changed(self, op):
+        self.generation += 1
+        for listener in self.listeners:
+            try:
+                listener(op)
+            except Exception as e:
+                print(f"{self.path}: change listener failed: {e}")
+
+    def _journal(self, op):
+        """Applies op in RAM, appends it to the journal and notifies the listeners."""
+        self.get()
+        self._apply(op)
+        with open(self.journal_path, 'a') as f:
+            if self._torn:
+                f.write('\n') # Keep this change off the partial line
+                self._torn = False
+            f.write(json.dumps(op) + '\n')
+        self._journal_ops += 1
+        self._changed(op)
+        if self._journal_ops >= self.compact_ops:
+            self.compact()
+
+    def find(self, key):
+        """Returns the record with this key, or None."""
+        self.get()
+        position = self._positions.get(self._key(key))
+        return None if position is None else self.records[position]
+
+    def add(self, record):
+        """Adds a record (replacing one with the same key). Returns the record."""
+        self.get()
+        if self.auto_id and record.get('id') is None:
+            record['id'] = self._next_id
+        self._journal(['a', record])
+        return record
+
+    def update(self, key, record):
+        """Replaces the record at key. Returns False if there is none."""
+        if self.find(key) is None:
+            return False
+        if self.auto_id and record.get('id') is None:
+            record['id'] = self._key(key)
+        self._journal(['u', key, record])
+        return True
+
+    def delete(self, key):
+        """Deletes the record at key. Returns False if there is none."""
+        if self.find(key) is None:
+            return False
+        self._journal(['d', key])
+        return True
+
+    def set_active(self, key, active):
+        """Sets a record's 'active' flag. Returns False if there is none."""
+        if self.find(key) is None:
+            return False
+        self._journal(['s', key, bool(active)])
+        return True
+
+    # --- Compaction ---
+
+    def replace(self, records):
+        """Replaces every record (a whole-list save) and compacts."""
+        self._set_records(records)
+        self.compact()
+        self._changed(None)
+
+    def compact(self):
+        """Writes the records to the JSON file through a temp file and clears the journal."""
+        records = self.get()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(records, f)
+        replace_file(tmp_path, self.path)
+        if self.on_compact is not None:
+            self.on_compact(records) # Before the journal goes, so a crash here is redone at boot
+        try:
+            os.remove(self.journal_path)
+        except OSError:
+            pass
+        self._journal_ops = 0
+        self._torn = False
+
+    def journal_ops(self):
+        """Number of changes waiting in the journal."""
+        return self._journal_ops
+
+    def has_journal(self):
+        """True if a journal file exists (checked on flash, without loading the records)."""
+        try:
+            os.stat(self.journal_path)
+            return True
+        except OSError:
+            return False
+
+def user_key(user):
+    return (user.get('FC'), user.get('CN'))
+
+def event_key(event):
+    return event.get('id')
+
+def schedule_key(schedule):
+    return schedule.get('group')
+
+user_db = JournaledStore('users.json', 'users.journal', user_key)
+event_db = JournaledStore('events.json', 'events.journal', event_key, auto_id=True)
+schedule_db = JournaledStore('schedules.json', 'schedules.journal', schedule_key)
@@ -1,4 +1,5 @@
 # Wiegand_Formats.py - Dictionary of Wiegand formats
+import json
 
 # --- Wiegand Format Definitions ---
 # This dictionary holds all desired Wiegand card formats.
@@ -72,3 +73,235 @@ WIEGAND_FORMATS = {
         ]
     }
 }
+
+
+# --- Compiled Formats ---
+# Each entry in WIEGAND_FORMATS is compiled once at import into integer masks and
+# shifts so a swipe can be decoded with a few shifts, ANDs and popcounts on a
+# single integer instead of walking bit positions one at a time.
+# The frame integer holds the first received bit (position 0) in its most
+# significant bit, so position p of an n-bit frame is integer bit (n - 1 - p).
+
+def popcount(value):
+    """Returns the number of set bits in a non-negative integer."""
+    return bin(value).count('1')
+
+def _position_mask(bits, positions):
+    """Builds an integer mask with one bit set for each frame bit position."""
+    mask = 0
+    for pos in positions:
+        mask |= 1 << (bits - 1 - pos)
+    return mask
+
+def _bit_positions(spec):
+    """Accepts a list of bit positions or a {'start', 'end'} range (inclusive, as used in formats.json)."""
+    if isinstance(spec, dict):
+        return range(spec['start'], spec['end'] + 1)
+    return spec
+
+class CompiledFormat:
+    """Integer masks and shifts for one Wiegand format."""
+    __slots__ = ('bits', 'name', 'fc_shift', 'fc_mask', 'cn_shift', 'cn_mask', 'parity_checks', 'fc_whitelist')
+
+    def __init__(self, bits, format_info):
+        self.bits = bits
+        self.name = format_info['name']
+        whitelist = format_info.get('fc_whitelist')
+        self.fc_whitelist = set(whitelist) if whitelist else None
+
+        # Field ranges become (shift, mask) pairs; FC is optional (e.g. H10302)
+        fc = format_info.get('facility_code') or {}
+        if 'start' in fc:
+            self.fc_shift = bits - 1 - fc['end']
+            self.fc_mask = (1 << (fc['end'] - fc['start'] + 1)) - 1
+        else:
+            self.fc_shift = 0
+            self.fc_mask = 0
+        cn = format_info['card_number']
+        self.cn_shift = bits - 1 - cn['end']
+        self.cn_mask = (1 << (cn['end'] - cn['start'] + 1)) - 1
+
+        # Each parity check becomes (check_mask, expected): the popcount of the
+        # parity bit plus its data bits is even for even parity, odd for odd.
+        checks = []
+        for p_check in format_info.get('parity_checks', []):
+            check_mask = _position_mask(bits, _bit_positions(p_check['data_bits']))
+            check_mask |= _position_mask(bits, (p_check['parity_bit_pos'],))
+            expected = 1 if p_check['type'].lower() == 'odd' else 0
+            checks.append((check_mask, expected))
+        self.parity_checks = tuple(checks)
+
+    def facility_code(self, raw):
+        """Extracts the facility code from a frame integer, or -1 if the format has none."""
+        if not self.fc_mask:
+            return -1
+        return (raw >> self.fc_shift) & self.fc_mask
+
+    def card_number(self, raw):
+        """Extracts the card number from a frame integer."""
+        return (raw >> self.cn_shift) & self.cn_mask
+
+    def parity_ok(self, raw):
+        """Returns True if every parity check passes for the frame integer."""
+        for check_mask, expected in self.parity_checks:
+            if (popcount(raw & check_mask) & 1) != expected:
+                return False
+        return True
+
+# --- Format Registry ---
+# Several formats may share a bit length (e.g. site-specific 35/36-bit layouts).
+# FORMAT_CANDIDATES maps each length to its compiled candidates in registration
+# order (built-ins first, then formats.json), so the per-swipe lookup is one dict
+# access no matter how many formats are registered. When a length has several
+# candidates, select_format() ranks them by parity match and FC-whitelist hit.
+
+FORMAT_CANDIDATES = {}
+
+def register_format(bits, format_info):
+    """Compiles a format definition and adds it to the candidates for its bit length."""
+    compiled = CompiledFormat(bits, format_info)
+    candidates = FORMAT_CANDIDATES.get(bits)
+    if candidates is None:
+        FORMAT_CANDIDATES[bits] = [compiled]
+    else:
+        candidates.append(compiled)
+    return compiled
+
+def load_formats_file(path='formats.json'):
+    """
+    Registers additional formats from a JSON list. Each entry uses the same fields
+    as WIEGAND_FORMATS plus 'bits' and an optional 'fc_whitelist' list.
+    Returns the number of formats registered (0 if the file does not exist).
+    """
+    try:
+        with open(path, 'r') as f:
+            entries = json.load(f)
+    except OSError:
+        return 0
+    except Exception as e:
+        print(f"Error loading {path}: {e}")
+        return 0
+
+    count = 0
+    for entry in entries:
+        try:
+            register_format(entry['bits'], entry)
+            count += 1
+        except Exception as e:
+            print(f"Skipping format '{entry.get('name', '?')}' in {path}: {e}")
+    return count
+
+def select_format(raw, bits):
+    """
+    Picks the best format for a frame. Returns (CompiledFormat, parity_ok), or
+    (None, False) if no format is registered for this length. A parity match
+    outranks an FC-whitelist hit; ties go to the earlier registration.
+    """
+    candidates = FORMAT_CANDIDATES.get(bits)
+    if not candidates:
+        return None, False
+    if len(candidates) == 1:
+        return candidates[0], candidates[0].parity_ok(raw)
+
+    best = None
+    best_parity = False
+    best_score = -1
+    for compiled in candidates:
+        parity_ok = compiled.parity_ok(raw)
+        score = 2 if parity_ok else 0
+        if compiled.fc_whitelist is not None and compiled.facility_code(raw) in compiled.fc_whitelist:
+            score += 1
+        if score > best_score:
+            best, best_parity, best_score = compiled, parity_ok, score
+            if score == 3:
+                break
+    return best, best_parity
+
+for _bits, _format_info in WIEGAND_FORMATS.items():
+    register_format(_bits, _format_info)
+
+def words_to_int(words, bits):
+    """
+    Converts captured Wiegand words into a frame integer.
+    Full words hold 32 bits each (first bit in the MSB); the last word holds the
+    remaining bits right-aligned, exactly as the pulse ISRs shift them in.
+    """
+    raw = 0
+    full_words = bits >> 5
+    for i in range(full_words):
+        raw = (raw << 32) | words[i]
+    remainder = bits & 31
+    if remainder:
+        raw = (raw << remainder) | (words[full_words] & ((1 << remainder) - 1))
+    return raw
+
+# --- Card Read Results ---
+# A decoded swipe is held in a CardRead record taken from a small CardReadPool and
+# reused round-robin, so the reader path does not build a new dict per swipe.
+# Hex and binary renderings are only produced when a consumer asks for them.
+
+class CardRead:
+    """Decoded result of one Wiegand frame."""
+    __slots__ = ('raw', 'bits', 'name', 'fc', 'cn', 'parity_ok', 'format',
+                 'min_gap_us', 'max_gap_us', 'mean_gap_us', 'glitches', 'reader')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.raw = 0
+        self.bits = 0
+        self.name = "Unknown"
+        self.fc = -1
+        self.cn = -1
+        self.parity_ok = False
+        self.format = None
+        self.min_gap_us = 0
+        self.max_gap_us = 0
+        self.mean_gap_us = 0
+        self.glitches = 0
+        self.reader = None
+
+    def decode(self, raw, bits):
+        """Fills the record from a frame integer using the format registry."""
+        self.clear()
+        self.raw = raw
+        self.bits = bits
+        compiled, parity_ok = select_format(raw, bits)
+        if compiled is not None:
+            self.format = compiled
+            self.name = compiled.name
+            self.fc = compiled.facility_code(raw)
+            self.cn = compiled.card_number(raw)
+            self.parity_ok = parity_ok
+        return self
+
+    def set_pulse_stats(self, min_gap_us, max_gap_us, gap_sum_us, glitches):
+        """Attaches the frame's inter-pulse gap statistics and rejected glitch count."""
+        self.min_gap_us = min_gap_us
+        self.max_gap_us = max_gap_us
+        self.mean_gap_us = gap_sum_us // (self.bits - 1) if self.bits > 1 else 0
+        self.glitches = glitches
+
+    def hex(self):
+        """Renders the raw frame as a hex string, e.g. '0x2C6269A1'."""
+        return f"0x{self.raw:X}"
+
+    def binary(self):
+        """Renders the raw frame as a zero-padded binary string of 'bits' digits."""
+        binary = bin(self.raw)[2:]
+        return "0" * (self.bits - len(binary)) + binary
+
+class CardReadPool:
+    """Fixed set of CardRead records handed out round-robin."""
+    __slots__ = ('_records', '_next')
+
+    def __init__(self, size=4):
+        self._records = [CardRead() for _ in range(size)]
+        self._next = 0
+
+    def acquire(self):
+        """Returns the next record; it is only valid until the pool wraps around."""
+        record = self._records[self._next]
+        self._next = (self._next + 1) % len(self._records)
+        return record
@@ -0,0 +1,235 @@
+# bench.py - Host-side Wiegand pulse-train replay and throughput benchmark
+#
+# Runs the firmware's capture and decode path (wiegand.WiegandReader ISRs, frame
+# queue and end-of-frame timing, then formats decoding as in process_card_data)
+# on CPython against the stand-ins in this directory, in virtual time.
+#
+# Usage (from the opendoorsim_micropython-main directory):
+#   python3 host/bench.py                      # every WIEGAND_FORMATS entry
+#   python3 host/bench.py --format 26 --swipes 500 --swipe-gap-ms 20
+#   python3 host/bench.py --timer none         # main-loop polling instead of the frame timer
+
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE)) # Firmware modules
+sys.path.insert(0, HERE)                  # Stand-ins take precedence
+
+import argparse
+from array import array
+
+import machine
+import utime
+import sim
+import formats
+import wiegand
+
+# --- Synthetic Cards ---
+
+def make_frame(bits, rng):
+    """Builds a random frame with valid parity for the built-in format of 'bits' bits."""
+    format_info = formats.WIEGAND_FORMATS[bits]
+    compiled = formats.FORMAT_CANDIDATES[bits][0]
+    raw = 0
+    if compiled.fc_mask:
+        raw |= rng.randrange(compiled.fc_mask + 1) << compiled.fc_shift
+    raw |= rng.randrange(compiled.cn_mask + 1) << compiled.cn_shift
+    # Parity checks are applied in order, so a later check can cover an earlier parity bit
+    for p_check in format_info['parity_checks']:
+        parity_bit = 1 << (bits - 1 - p_check['parity_bit_pos'])
+        data_mask = formats._position_mask(bits, formats._bit_positions(p_check['data_bits']))
+        ones = formats.popcount(raw & data_mask & ~parity_bit) & 1
+        want_odd = p_check['type'].lower() == 'odd'
+        if ones != want_odd:
+            raw |= parity_bit
+        else:
+            raw &= ~parity_bit
+    return raw
+
+# --- Replay ---
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def replay(bits_list, args, rng):
+    """
+    Sends one swipe per entry of bits_list through a fresh reader and returns the
+    result counters. Each pulse is a falling edge every pulse_us + gap_us (+ jitter);
+    swipes are separated by swipe_gap_ms of idle line.
+    """
+    machine.Timer.armed.clear()
+    timer_id = None if args.timer == 'none' else 0
+    reader = wiegand.WiegandReader(
+        'bench', 21, 22, max_bits=args.max_bits, queue_size=args.queue_size,
+        timeout_ms=args.timeout_ms, emitter=args.emitter, timer_id=timer_id,
+        adaptive=not args.static, gap_multiplier=args.gap_multiplier,
+        glitch_filter_us=args.glitch_filter_us)
+    reader.start()
+
+    # Record when each frame is queued: that is the end-of-frame decision
+    decided_at = []
+    push_frame = reader.push_frame
+    def timed_push_frame():
+        queued = push_frame()
+        if queued:
+            decided_at.append(utime.now())
+        return queued
+    reader.push_frame = timed_push_frame
+
+    words = array('I', [0] * reader.words_per_frame)
+    meta = array('i', [0] * wiegand.FRAME_META_SIZE)
+    pool = formats.CardReadPool(4)
+    sent = {}          # first pulse ticks -> (raw, bits, last pulse time)
+    result = {'sent': 0, 'decoded': 0, 'mismatched': 0, 'bits_sent': 0, 'bits_captured': 0,
+              'latency_us': [], 'decode_us': [], 'isr_ns': 0, 'pulses': 0}
+
+    def drain():
+        while True:
+            bits = reader.pop_frame(words, meta)
+            if not bits:
+                return
+            decision_us = decided_at.pop(0)
+            started = time.perf_counter()
+            card = pool.acquire().decode(formats.words_to_int(words, bits), bits)
+            card.set_pulse_stats(meta[2], meta[3], meta[4], meta[5])
+            result['decode_us'].append((time.perf_counter() - started) * 1e6)
+            result['bits_captured'] += bits
+            expected = sent.pop(meta[0] & 0x3FFFFFFF, None)
+            if expected is not None and expected[0] == card.raw and expected[1] == bits and card.parity_ok:
+                result['decoded'] += 1
+                result['latency_us'].append(decision_us - expected[2])
+            else:
+                result['mismatched'] += 1
+
+    period_us = args.pulse_us + args.gap_us
+    started_us = utime.now()
+    t_us = started_us + 1000
+    for bits in bits_list:
+        raw = make_frame(bits, rng)
+        first_ticks = None
+        for i in range(bits):
+            sim.run_until(t_us)
+            if args.timer == 'none':
+                reader.poll()
+            if first_ticks is None:
+                first_ticks = utime.ticks_us()
+            pin = reader.pin_d1 if (raw >> (bits - 1 - i)) & 1 else reader.pin_d0
+            started = time.perf_counter_ns()
+            pin.handler(pin)
+            result['isr_ns'] += time.perf_counter_ns() - started
+            result['pulses'] += 1
+            last_us = t_us
+            t_us += period_us + (rng.randint(-args.jitter_us, args.jitter_us) if args.jitter_us else 0)
+        sent[first_ticks] = (raw, bits, last_us)
+        result['sent'] += 1
+        result['bits_sent'] += bits
+
+        # Idle line until the next swipe; a polled reader is checked every poll_us
+        t_us = last_us + args.swipe_gap_ms * 1000
+        if args.timer == 'none':
+            poll_us = utime.now()
+            while poll_us < t_us:
+                poll_us += args.poll_us
+                sim.run_until(min(poll_us, t_us))
+                reader.poll()
+                drain()
+        else:
+            sim.run_until(t_us)
+            drain()
+
+    # Let the last frame close
+    if args.timer == 'none':
+        for _ in range(args.timeout_ms * 1000 // args.poll_us + 1):
+            sim.run_until(utime.now() + args.poll_us)
+            reader.poll()
+    else:
+        sim.run_idle(args.timeout_ms * 1000 * 4)
+    drain()
+    stats = reader.stats()
+    result['dropped'] = stats['dropped']
+    result['junk'] = stats['junk']
+    result['duration_us'] = utime.now() - started_us
+    reader.stop()
+    return result
+
+# --- Report ---
+
+def report(label, r):
+    latency = sorted(r['latency_us'])
+    decode = sorted(r['decode_us'])
+    lost_bits = r['bits_sent'] - r['bits_captured']
+    swipes_per_s = r['sent'] * 1e6 / r['duration_us'] if r['duration_us'] else 0
+    isr_us = r['isr_ns'] / 1000 / r['pulses'] if r['pulses'] else 0
+    print(f"{label:<38} {r['decoded']:>5}/{r['sent']:<5} {lost_bits:>6} {r['mismatched'] + r['dropped'] + r['junk']:>5}"
+          f" {percentile(latency, 0.5) / 1000:>7.2f} {percentile(latency, 0.95) / 1000:>7.2f}"
+          f" {(latency[-1] if latency else 0) / 1000:>7.2f} {percentile(decode, 0.5):>7.1f} {isr_us:>6.2f} {swipes_per_s:>7.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic Wiegand swipes through the capture and decode path.")
+    parser.add_argument('--format', type=int, action='append', help="Bit length to test (repeatable; default: every WIEGAND_FORMATS entry)")
+    parser.add_argument('--mix', action='store_true', help="Interleave the formats on one reader instead of one reader per format")
+    parser.add_argument('--swipes', type=int, default=200, help="Swipes per format")
+    parser.add_argument('--pulse-us', type=int, default=50, help="Pulse width (us)")
+    parser.add_argument('--gap-us', type=int, default=2000, help="Interval between pulses (us)")
+    parser.add_argument('--jitter-us', type=int, default=0, help="Random +/- jitter on each pulse interval (us)")
+    parser.add_argument('--swipe-gap-ms', type=int, default=100, help="Idle line between swipes (ms)")
+    parser.add_argument('--timeout-ms', type=int, default=200, help="CARD_READ_TIMEOUT_MS")
+    parser.add_argument('--max-bits', type=int, default=96, help="MAX_BITS")
+    parser.add_argument('--queue-size', type=int, default=8, help="FRAME_QUEUE_SIZE")
+    parser.add_argument('--emitter', default='viper', help="ISR_EMITTER (all run as plain Python on the host)")
+    parser.add_argument('--timer', default='0', help="FRAME_TIMER_ID, or 'none' to poll from the main loop")
+    parser.add_argument('--poll-us', type=int, default=1000, help="Main-loop poll interval with --timer none (us)")
+    parser.add_argument('--static', action='store_true', help="Disable ADAPTIVE_TIMEOUT")
+    parser.add_argument('--gap-multiplier', type=int, default=4, help="ADAPTIVE_GAP_MULTIPLIER")
+    parser.add_argument('--glitch-filter-us', type=int, default=0, help="GLITCH_FILTER_US")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for card contents and jitter")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    lengths = args.format or sorted(formats.WIEGAND_FORMATS)
+    for bits in lengths:
+        if bits not in formats.WIEGAND_FORMATS:
+            parser.error(f"no built-in format for {bits} bits")
+
+    print(f"pulse {args.pulse_us}us + gap {args.gap_us}us (+/-{args.jitter_us}us), {args.swipe_gap_ms}ms between swipes, "
+          f"timeout {args.timeout_ms}ms, {'polled' if args.timer == 'none' else 'timer'}, "
+          f"{'static' if args.static else 'adaptive'} end of frame")
+    print(f"{'format':<38} {'ok/sent':>11} {'lost':>6} {'bad':>5} {'p50 ms':>7} {'p95 ms':>7} {'max ms':>7} {'dec us':>7} {'isr us':>6} {'swipe/s':>7}")
+    print("  (latency: last pulse -> frame queued, virtual time; dec/isr: host CPU time per frame/pulse)")
+
+    totals = None
+    runs = []
+    if args.mix:
+        bits_list = [lengths[i % len(lengths)] for i in range(args.swipes * len(lengths))]
+        rng.shuffle(bits_list)
+        runs.append(("mixed " + ",".join(str(b) for b in lengths), bits_list))
+    else:
+        for bits in lengths:
+            runs.append((f"{bits}: {formats.WIEGAND_FORMATS[bits]['name']}"[:38], [bits] * args.swipes))
+
+    for label, bits_list in runs:
+        r = replay(bits_list, args, rng)
+        report(label, r)
+        if totals is None:
+            totals = r
+        else:
+            for key in ('sent', 'decoded', 'mismatched', 'bits_sent', 'bits_captured', 'isr_ns',
+                        'pulses', 'dropped', 'junk', 'duration_us'):
+                totals[key] += r[key]
+            totals['latency_us'] += r['latency_us']
+            totals['decode_us'] += r['decode_us']
+    if len(runs) > 1:
+        report("total", totals)
+
+    # Non-zero exit if anything was lost, so the bench can gate a regression run
+    if totals['decoded'] != totals['sent'] or totals['bits_sent'] != totals['bits_captured']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+# build_static.py - Gzips the web interface's static assets for the board
+#
+# webserver.py serves static/<name>.gz with Content-Encoding: gzip when it
+# exists (falling back to static/<name>). Re-run this after editing a file in
+# static/ and copy the .gz files to the board's static/ directory.
+#
+# Usage (from the opendoorsim_micropython-main directory):
+#   python3 host/build_static.py
+
+import gzip
+import os
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(os.path.dirname(HERE), 'static')
+
+def build(static_dir=STATIC_DIR):
+    for name in sorted(os.listdir(static_dir)):
+        path = os.path.join(static_dir, name)
+        if name.endswith('.gz') or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        # mtime=0 keeps the output (and so the served ETag) the same for the same input
+        packed = gzip.compress(data, compresslevel=9, mtime=0)
+        with open(path + '.gz', 'wb') as f:
+            f.write(packed)
+        print(f"{name}: {len(data)} -> {len(packed)} bytes")
+
+if __name__ == '__main__':
+    build()
@@ -0,0 +1,95 @@
+# machine.py - Host (CPython) stand-in for the parts of machine used by the firmware
+# Pins record their IRQ handler so a test can call it directly; one-shot Timers
+# keep a virtual-time deadline that sim.py fires in order.
+
+import utime
+
+class Pin:
+    IN = 1
+    OUT = 3
+    PULL_UP = 2
+    PULL_DOWN = 1
+    IRQ_FALLING = 2
+    IRQ_RISING = 1
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        self._value = 1 if value is None else value
+        self.handler = None
+
+    def irq(self, handler=None, trigger=IRQ_FALLING):
+        self.handler = handler
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    armed = [] # Timers with a pending deadline
+
+    def __init__(self, id=-1):
+        self.id = id
+        self.deadline_us = None
+        self.period_us = 0
+        self.mode = Timer.ONE_SHOT
+        self.callback = None
+
+    def init(self, mode=ONE_SHOT, period=-1, freq=-1, callback=None):
+        self.deinit()
+        self.mode = mode
+        self.period_us = period * 1000
+        self.callback = callback
+        self.deadline_us = utime.now() + self.period_us
+        Timer.armed.append(self)
+
+    def deinit(self):
+        if self.deadline_us is not None:
+            self.deadline_us = None
+            Timer.armed.remove(self)
+
+    def fire(self):
+        """Runs the callback as the hardware timer IRQ would (host-side only)."""
+        if self.mode == Timer.PERIODIC:
+            self.deadline_us += max(self.period_us, 1)
+        else:
+            self.deadline_us = None
+            Timer.armed.remove(self)
+        if self.callback:
+            self.callback(self)
+
+class I2C:
+    def __init__(self, id=0, scl=None, sda=None, freq=400000):
+        pass
+
+    def scan(self):
+        return []
+
+    def writeto(self, addr, buf):
+        return len(buf)
+
+    def writeto_mem(self, addr, memaddr, buf):
+        pass
+
+def disable_irq():
+    return 1
+
+def enable_irq(state=1):
+    pass
+
+def unique_id():
+    return b'\x00\x00\x00\x00\x00\x00'
+
+def reset():
+    raise SystemExit("machine.reset()")
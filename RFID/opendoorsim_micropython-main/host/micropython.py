@@ -0,0 +1,31 @@
+# micropython.py - Host (CPython) stand-in for the micropython module
+# The viper/native decorators are identities (code runs as plain Python) and
+# schedule() queues callbacks for sim.py to run, with the same queue depth and
+# RuntimeError on overflow as the ESP32 port.
+
+SCHEDULER_DEPTH = 8
+
+_scheduled = []
+
+def const(value):
+    return value
+
+def viper(func):
+    return func
+
+def native(func):
+    return func
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+def schedule(func, arg):
+    if len(_scheduled) >= SCHEDULER_DEPTH:
+        raise RuntimeError("schedule queue full")
+    _scheduled.append((func, arg))
+
+def run_scheduled():
+    """Runs pending scheduled callbacks, as the VM does between bytecodes (host-side only)."""
+    while _scheduled:
+        func, arg = _scheduled.pop(0)
+        func(arg)
@@ -0,0 +1,37 @@
+# sim.py - Virtual-time event loop for the host stand-ins
+# Advances utime's clock to a target time, firing machine.Timer deadlines in
+# order on the way and running micropython.schedule() callbacks after each.
+
+import machine
+import micropython
+import utime
+
+def next_deadline():
+    """Returns the earliest armed timer deadline (us), or None."""
+    if not machine.Timer.armed:
+        return None
+    return min(timer.deadline_us for timer in machine.Timer.armed)
+
+def run_until(t_us):
+    """Advances virtual time to t_us, servicing every timer that expires before then."""
+    while True:
+        micropython.run_scheduled()
+        deadline = next_deadline()
+        if deadline is None or deadline > t_us:
+            break
+        utime.set_now(deadline)
+        for timer in list(machine.Timer.armed):
+            if timer.deadline_us is not None and timer.deadline_us <= deadline:
+                timer.fire()
+    utime.set_now(t_us)
+    micropython.run_scheduled()
+
+def run_idle(limit_us):
+    """Services timers until none are armed or limit_us of virtual time has passed."""
+    end_us = utime.now() + limit_us
+    while machine.Timer.armed:
+        deadline = next_deadline()
+        if deadline > end_us:
+            break
+        run_until(deadline)
+    micropython.run_scheduled()
@@ -0,0 +1,49 @@
+# utime.py - Host (CPython) stand-in for MicroPython's utime
+# Time is virtual: it only moves when sim.py (or a sleep) advances it, so
+# benchmark runs are repeatable and independent of the host's speed.
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = _TICKS_PERIOD >> 1
+
+_now_us = 0
+EPOCH = 1700000000 # Seconds returned by time() at virtual time 0
+
+def now():
+    """Returns the unwrapped virtual time in microseconds (host-side only)."""
+    return _now_us
+
+def set_now(us):
+    """Moves the virtual clock to 'us' (host-side only; time never runs backwards)."""
+    global _now_us
+    if us > _now_us:
+        _now_us = us
+
+def ticks_us():
+    return _now_us & _TICKS_MAX
+
+def ticks_ms():
+    return (_now_us // 1000) & _TICKS_MAX
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+def ticks_diff(ticks1, ticks2):
+    diff = (ticks1 - ticks2) & _TICKS_MAX
+    return diff - _TICKS_PERIOD if diff >= _TICKS_HALFPERIOD else diff
+
+def sleep_us(us):
+    set_now(_now_us + us)
+
+def sleep_ms(ms):
+    set_now(_now_us + ms * 1000)
+
+def sleep(seconds):
+    set_now(_now_us + int(seconds * 1000000))
+
+def time():
+    return EPOCH + _now_us // 1000000
+
+def localtime(secs=None):
+    import time as _time
+    return _time.gmtime(time() if secs is None else secs)[:8]
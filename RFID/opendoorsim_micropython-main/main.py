@@ -1,26 +1,35 @@
 import time
 
+from array import array
 from machine import Pin, I2C
 from lcd_i2c import LCD_I2C #We might have to change where the pins are
 import machine
 import utime
 import micropython
-import json
 import network
 import ssd1306 # Import OLED driver
 import formats # Import Wiegand formats
+import appconfig # Import shared typed configuration
+import credentials # Import credential index
+import datastore # Import journaled users/events storage
+import actions # Import event rules and action registry
+import scheduler # Import timed output actions
+import schedules # Import weekly access schedules
+import ratelimit # Import swipe rate limiting
+import wiegand # Import Wiegand reader capture
 import webserver # Import web server
 
 # Test comment 1
 
 # --- Global Wiegand Variables ---
-wiegand_bit_array = None
-current_bit_index = 0
-last_pulse_time_microsec = 0
-pin_d0 = None
-pin_d1 = None
+# Each reader (D0/D1 pin pair) is a wiegand.WiegandReader with its own capture
+# buffers, ISRs, end-of-frame timer and completed-frame queue.
+readers = []
 micropython.alloc_emergency_exception_buf(100) # For ISR exceptions
 
+# Decoded swipes are written into these records instead of a new dict per swipe
+card_pool = formats.CardReadPool(4)
+
 # --- Global OLED Variable ---
 display = None
 
@@ -28,6 +37,11 @@ display = None
 config = None
 users = None
 events = None
+event_rules = actions.EventRules() # Compiled 'events', replaced as a whole by set_events()
+user_index = credentials.UserIndex() # UserIndex over 'users', or a CredentialStore (USER_STORE)
+user_filter = None # BloomFilter over user_index's keys (BLOOM_FP_RATE), rebuilt with it
+access_schedules = schedules.Schedules() # Hour-of-week bitmaps per schedule group, replaced by set_schedules()
+limiter = None # ratelimit.RateLimiter over the readers, built with them
 
 # --- Configuration Loading Functions ---
 
@@ -41,33 +55,53 @@ i2c = I2C(0, scl=Pin(22), sda=Pin(21), freq=100000)
 lcd = LCD_I2C(i2c, addr=0x27, cols=16, rows=2)
 
 def load_config():
-    """Loads configuration from config.json file."""
-    try:
-        with open('config.json', 'r') as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"Error loading config.json: {e}")
-        lcd.print(f"Error loading config.json: {e}")
+    """
+    Returns the shared appconfig.Config. config.json is parsed once, by boot.py;
+    missing or invalid settings fall back to the defaults in appconfig.FIELDS.
+    """
+    config = appconfig.get()
+    if config.error:
+        print(f"Error loading config.json: {config.error}")
+        lcd.print(f"Error loading config.json: {config.error}")
         time.sleep(5)
         lcd.clear()
-        # Return default config if file can't be loaded
-        return {
-            "D0_PIN": 21,
-            "D1_PIN": 22,
-            "MAX_BITS": 96,
-            "CARD_READ_TIMEOUT_MS": 50,
-            "SCL_PIN": 18,
-            "SDA_PIN": 19,
-            "SCREEN_WIDTH": 128,
-            "SCREEN_HEIGHT": 32,
-            "OLED_FLIPPED": False
-        }
+    return config
+
+def setup_datastore(config):
+    """Applies JOURNAL_COMPACT_OPS and keeps the USER_STORE credential store in step with users.json."""
+    for db in (datastore.user_db, datastore.event_db, datastore.schedule_db):
+        db.compact_ops = config.JOURNAL_COMPACT_OPS
+    user_store = config.USER_STORE
+    if user_store:
+        datastore.user_db.on_compact = lambda records: rewrite_user_store(records, user_store)
+        datastore.user_db.resident = False # Lookups use the store; users.json is only read for edits
+        if datastore.user_db.has_journal():
+            datastore.user_db.compact() # Fold in edits made since the store was last written
+            datastore.user_db.release()
+
+def apply_config(config, changed):
+    """Config listener: applies the appconfig.LIVE_FIELDS settings saved from the web interface."""
+    if 'JOURNAL_COMPACT_OPS' in changed:
+        for db in (datastore.user_db, datastore.event_db, datastore.schedule_db):
+            db.compact_ops = config.JOURNAL_COMPACT_OPS
+    if 'BLOOM_FP_RATE' in changed or 'BLOOM_MAX_BYTES' in changed:
+        _swap_user_index(user_index) # Rebuilds the Bloom filter
+    if limiter is not None:
+        limiter.card_limit = config.CARD_RATE_LIMIT
+        limiter.reader_limit = config.READER_DENY_LIMIT
+        limiter.lockout_ms = config.RATE_LOCKOUT_S * 1000
+    # MQTT_TOPIC_PREFIX is read from config on every publish
+
+def rewrite_user_store(records, path):
+    """Rewrites the credential store after users.json is compacted, reopening it if it is in use."""
+    credentials.write_store(records, path)
+    if isinstance(user_index, credentials.CredentialStore):
+        open_user_store(path) # Also drops the changes it held in RAM
 
 def load_users():
-    """Loads users from users.json file."""
+    """Loads users from users.json file and replays users.journal over them."""
     try:
-        with open('users.json', 'r') as f:
-            return json.load(f)
+        return datastore.user_db.load()
     except Exception as e:
         print(f"Error loading users.json: {e}")
         lcd.print(f"Error loading users.json: {e}")
@@ -76,10 +110,9 @@ def load_users():
         return []
 
 def load_events():
-    """Loads events from events.json file."""
+    """Loads events from events.json file and replays events.journal over them."""
     try:
-        with open('events.json', 'r') as f:
-            return json.load(f)
+        return datastore.event_db.load()
     except Exception as e:
         print(f"Error loading events.json: {e}")
         lcd.print(f"Error loading events.json: {e}")
@@ -87,57 +120,83 @@ def load_events():
         lcd.clear()
         return []
 
-# --- Wiegand Bit Array Helpers ---
+def load_schedules():
+    """Loads schedule groups from schedules.json file and replays schedules.journal over them."""
+    try:
+        return datastore.schedule_db.load()
+    except Exception as e:
+        print(f"Error loading schedules.json: {e}")
+        return []
 
-def set_bit_in_array(bit_position, value):
-    """Sets a bit (0 or 1) at a given position in the wiegand_bit_array."""
-    # This function is ONLY called by ISRs and always acts on the global buffer
-    byte_index = bit_position // 8
-    bit_in_byte_offset = 7 - (bit_position % 8) # Store MSB first
-    if byte_index < len(wiegand_bit_array):
-        if value:
-            wiegand_bit_array[byte_index] |= (1 << bit_in_byte_offset)
-        else:
-            wiegand_bit_array[byte_index] &= ~(1 << bit_in_byte_offset)
+# --- Wiegand Readers ---
 
-def get_bit_from_array(buffer, bit_position):
+def build_readers(config):
     """
-    Gets a bit (0 or 1) from a given position in the *specified* buffer.
-    FIX: Now takes a 'buffer' argument to prevent race conditions.
+    Creates a WiegandReader for each entry in config['READERS'], or a single reader
+    named 'main' on D0_PIN/D1_PIN if READERS is absent. Entries need 'D0_PIN' and
+    'D1_PIN' and may override 'id', 'TIMER_ID' and any capture setting.
     """
-    byte_index = bit_position // 8
-    bit_in_byte_offset = 7 - (bit_position % 8)
-    if byte_index < len(buffer):
-        return (buffer[byte_index] >> bit_in_byte_offset) & 1
-    return None
-
-def reset_wiegand_buffer():
-    """Clears the buffer and resets counters for the next card read."""
-    # This function is called from within a critical (IRQ-disabled) section
-    global current_bit_index, last_pulse_time_microsec
-    for i in range(len(wiegand_bit_array)):
-        wiegand_bit_array[i] = 0
-    current_bit_index = 0
-
-# --- Interrupt Service Routines (ISRs) ---
-
-def d0_pulse_handler(pin_obj):
-    """Handles a pulse on the D0 line (bit value 0)."""
-    global current_bit_index, last_pulse_time_microsec, config
-    # This code runs in an interrupt and must be very fast
-    if current_bit_index < config['MAX_BITS']:
-        set_bit_in_array(current_bit_index, 0)
-        current_bit_index += 1
-    last_pulse_time_microsec = utime.ticks_us()
-
-def d1_pulse_handler(pin_obj):
-    """Handles a pulse on the D1 line (bit value 1)."""
-    global current_bit_index, last_pulse_time_microsec, config
-    # This code runs in an interrupt and must be very fast
-    if current_bit_index < config['MAX_BITS']:
-        set_bit_in_array(current_bit_index, 1)
-        current_bit_index += 1
-    last_pulse_time_microsec = utime.ticks_us()
+    reader_configs = config.READERS or [{'id': 'main', 'D0_PIN': config.D0_PIN, 'D1_PIN': config.D1_PIN}]
+    base_timer_id = config.FRAME_TIMER_ID
+    built = []
+    for index, rc in enumerate(reader_configs):
+        # Each reader needs its own hardware timer; by default they are numbered from FRAME_TIMER_ID
+        timer_id = rc.get('TIMER_ID', None if base_timer_id is None else base_timer_id + index)
+        built.append(wiegand.WiegandReader(
+            rc.get('id', str(index + 1)), rc['D0_PIN'], rc['D1_PIN'],
+            max_bits=config.MAX_BITS,
+            queue_size=rc.get('FRAME_QUEUE_SIZE', config.FRAME_QUEUE_SIZE),
+            timeout_ms=rc.get('CARD_READ_TIMEOUT_MS', config.CARD_READ_TIMEOUT_MS),
+            emitter=config.ISR_EMITTER,
+            timer_id=timer_id,
+            adaptive=rc.get('ADAPTIVE_TIMEOUT', config.ADAPTIVE_TIMEOUT),
+            gap_multiplier=rc.get('ADAPTIVE_GAP_MULTIPLIER', config.ADAPTIVE_GAP_MULTIPLIER),
+            glitch_filter_us=rc.get('GLITCH_FILTER_US', config.GLITCH_FILTER_US),
+            min_frame_bits=rc.get('MIN_FRAME_BITS', config.MIN_FRAME_BITS),
+            max_glitches=rc.get('MAX_GLITCHES', config.MAX_GLITCHES),
+            pulse_capture=config.PULSE_CAPTURE))
+    return built
+
+def build_limiter(config, readers):
+    """Creates the swipe rate limiter for the configured readers (fixed memory)."""
+    return ratelimit.RateLimiter(
+        [reader.id for reader in readers],
+        card_limit=config.CARD_RATE_LIMIT,
+        reader_limit=config.READER_DENY_LIMIT,
+        lockout_s=config.RATE_LOCKOUT_S,
+        window_s=config.RATE_WINDOW_S,
+        width=config.RATE_SKETCH_WIDTH,
+        hot_size=config.RATE_HOT_KEYS)
+
+def reader_label(card):
+    """Returns a short 'Reader: <id>' tag for display, or '' when only one reader is configured."""
+    if len(readers) > 1 and card is not None:
+        return f"Reader: {card.reader}"
+    return ""
+
+def wait_for_frame(timeout_ms):
+    """Sleeps up to timeout_ms, returning early once any reader has a frame queued."""
+    for _ in range(timeout_ms):
+        for reader in readers:
+            if reader.pending():
+                return
+        utime.sleep_ms(1) # Scheduled close_frame() calls run during the sleep
+
+def reader_busy():
+    """True if any reader has a frame queued or in progress (ends a web server slice early)."""
+    for reader in readers:
+        if reader.pending() or reader.is_reading():
+            return True
+    return False
+
+def frame_queue_stats(reader_id=None):
+    """Returns the frame queue counters of one reader, or summed over all readers."""
+    totals = {'pending': 0, 'dropped': 0, 'junk': 0, 'capacity': 0}
+    for reader in readers:
+        if reader_id is None or reader.id == reader_id:
+            for key, value in reader.stats().items():
+                totals[key] += value
+    return totals
 
 # --- OLED Helper Functions ---
 # (No changes needed)
@@ -153,27 +212,51 @@ def d1_pulse_handler(pin_obj):
 #             display.text(line4, 0, 24)
 #         display.show()
 
-# --- Peripheral Control Functions (Placeholders) ---
-# (No changes needed)
+# --- Peripheral Control Functions ---
+# Outputs are switched by scheduler.py, which the main loop runs every pass, so a
+# timed action never blocks the reader, web server or MQTT. Outputs without a
+# configured pin only print their transitions.
+
+def setup_outputs(config):
+    """Registers the door, light and buzzer outputs from DOOR_PIN, LIGHT_PINS and BUZZER_PIN."""
+    active_low = config.OUTPUT_ACTIVE_LOW
+    scheduler.add_output('door', config.DOOR_PIN, active_low)
+    for light_id, pin_number in config.light_pins.items():
+        scheduler.add_output(f"light{light_id}", pin_number, active_low)
+    scheduler.add_output('buzzer', config.BUZZER_PIN, active_low)
+
 def door_open(duration=5):
-    """Placeholder for door control - opens door for specified duration in seconds."""
-    print(f"[PLACEHOLDER] Door open for {duration} seconds")
+    """Opens the door for the specified duration in seconds."""
+    print(f"Door open for {duration} seconds")
+    scheduler.pulse('door_open', 'door', int(duration * 1000))
 
 def door_close():
-    """Placeholder for door control - closes door."""
-    print("[PLACEHOLDER] Door close")
+    """Closes the door, cancelling any pending door actions."""
+    print("Door close")
+    scheduler.cancel_output('door')
 
 def light_on(light_id, duration=10):
-    """Placeholder for light control - turns on light for specified duration in seconds."""
-    print(f"[PLACEHOLDER] Light {light_id} on for {duration} seconds")
+    """Turns on a light for the specified duration in seconds (0 = until light_off)."""
+    print(f"Light {light_id} on for {duration} seconds")
+    scheduler.pulse('light_on', f"light{light_id}", int(duration * 1000))
 
 def light_off(light_id):
-    """Placeholder for light control - turns off light."""
-    print(f"[PLACEHOLDER] Light {light_id} off")
+    """Turns off a light, cancelling any pending actions on it."""
+    print(f"Light {light_id} off")
+    scheduler.cancel_output(f"light{light_id}")
 
 def buzzer_beep(count=1, duration=100):
-    """Placeholder for buzzer control - beeps specified number of times."""
-    print(f"[PLACEHOLDER] Buzzer beep {count} time(s), {duration}ms each")
+    """Beeps the buzzer count times, duration ms on and duration ms off."""
+    print(f"Buzzer beep {count} time(s), {duration}ms each")
+    scheduler.pattern('buzzer_beep', 'buzzer', count, duration, duration)
+
+# --- Event Actions ---
+# Built-in events.json actions; each handler receives the event's params dict.
+actions.register_action('door_open', lambda params: door_open(params.get('duration', 5)))
+actions.register_action('door_close', lambda params: door_close())
+actions.register_action('light_on', lambda params: light_on(params.get('light_id', 1), params.get('duration', 10)))
+actions.register_action('light_off', lambda params: light_off(params.get('light_id', 1)))
+actions.register_action('buzzer_beep', lambda params: buzzer_beep(params.get('count', 1), params.get('duration', 100)))
 
 # --- MQTT Functions (Full Implementation) ---
 # (No changes needed in these functions)
@@ -214,14 +297,14 @@ def init_mqtt():
                 mqtt_connected = False
                 return
         
-        broker = config.get('MQTT_BROKER', '192.168.1.100')
-        port = config.get('MQTT_PORT', 1883)
-        client_id = config.get('MQTT_CLIENT_ID', '')
+        broker = config.MQTT_BROKER
+        port = config.MQTT_PORT
+        client_id = config.MQTT_CLIENT_ID
         if not client_id:
             client_id = f"opendoorsim_{get_device_id()[:8]}"
         
-        username = config.get('MQTT_USERNAME', '')
-        password = config.get('MQTT_PASSWORD', '')
+        username = config.MQTT_USERNAME
+        password = config.MQTT_PASSWORD
         
         mqtt_client = MQTTClient(client_id, broker, port, username, password, keepalive=60)
         mqtt_connected = False
@@ -241,7 +324,7 @@ def mqtt_connect():
         mqtt_client.connect()
         mqtt_connected = True
         
-        topic_prefix = config.get('MQTT_TOPIC_PREFIX', 'opendoorsim')
+        topic_prefix = config.MQTT_TOPIC_PREFIX
         device_id = get_device_id()
         
         command_topic = f"{topic_prefix}/{device_id}/command"
@@ -349,264 +432,276 @@ def mqtt_loop():
 
 # --- Wiegand Processing Functions ---
 
-def calculate_parity(buffer, bit_positions_to_check, parity_type='Even'):
-    """
-    Calculates the parity for a given list of specific bit positions.
-    FIX: Now takes a 'buffer' argument to read from.
+def process_card_data(bits_received, data_words, frame_meta=None, reader_id=None):
     """
-    count_of_ones = 0
-    for bit_pos in bit_positions_to_check:
-        bit_value = get_bit_from_array(buffer, bit_pos) # FIX: Pass buffer
-        if bit_value is None:
-            return None # Indicates a failure
-        if bit_value == 1:
-            count_of_ones += 1
-
-    if parity_type == 'Even':
-        return 0 if (count_of_ones % 2) == 0 else 1
-    elif parity_type == 'Odd':
-        return 1 if (count_of_ones % 2) == 0 else 0
-    return None
-
-def process_card_data(bits_received, data_buffer):
+    Processes the received Wiegand data using the format registry.
+    Returns a formats.CardRead record from card_pool (or None if no bits were received).
+    frame_meta (from pop_frame) attaches the frame's pulse gap statistics; reader_id
+    tags the record with the reader the frame came from.
+    The captured words are converted to a single integer once; FC, CN and parity are
+    then extracted with shifts, masks and popcounts (see formats.CompiledFormat).
     """
-    Processes the received Wiegand data using the formats dictionary.
-    Returns a dictionary with the results.
-    FIX: Now takes a 'data_buffer' argument to read from.
-    """
-    raw_bits_str = ""
-    result = {
-        "bits": bits_received,
-        "name": "Unknown",
-        "fc": -1,
-        "cn": -1,
-        "parity_ok": False,
-        "raw_hex": ""
-    }
-
     if bits_received == 0:
         print("[ERROR] No bits received.")
         lcd.print("[ERROR] No bits received.")
         return None
 
-    # Build raw bit string for hex conversion
-    full_binary_string = ""
-    for i in range(bits_received):
-        full_binary_string += str(get_bit_from_array(data_buffer, i)) # FIX: Pass data_buffer
-    
-    try:
-        hex_value = int(full_binary_string, 2)
-        result["raw_hex"] = f"0x{hex_value:X}"
-    except ValueError:
-        result["raw_hex"] = "Error"
-        
-    print(f"\n--- Card Swipe Detected ({bits_received} bits) ---")
-    print(f"Binary: {full_binary_string}")
-    print(f"Hex:    {result['raw_hex']}")
+    card = card_pool.acquire().decode(formats.words_to_int(data_words, bits_received), bits_received)
+    card.reader = reader_id
 
-    format_info = formats.WIEGAND_FORMATS.get(bits_received)
-    
-    if not format_info:
+    print(f"\n--- Card Swipe Detected ({bits_received} bits, reader '{reader_id}') ---")
+    print(f"Binary: {card.binary()}")
+    print(f"Hex:    {card.hex()}")
+    if frame_meta is not None:
+        card.set_pulse_stats(frame_meta[2], frame_meta[3], frame_meta[4], frame_meta[5])
+        print(f"Gaps:   min {card.min_gap_us}us / mean {card.mean_gap_us}us / max {card.max_gap_us}us, {card.glitches} glitch(es)")
+
+    if card.format is None:
         print(f"Format: Unknown. No format defined for {bits_received}-bit.")
         print("-----------------------------")
-        return result # Return partial result
-
-    result["name"] = format_info['name']
-    print(f"Format: {result['name']}")
+        return card # Return partial result
 
-    # 1. Extract Facility Code
-    fc_start = format_info['facility_code'].get('start', -1)
-    fc_end = format_info['facility_code'].get('end', -1)
-    
-    if fc_start != -1:
-        current_fc = 0
-        for i in range(fc_start, fc_end + 1):
-            bit = get_bit_from_array(data_buffer, i) # FIX: Pass data_buffer
-            current_fc = (current_fc << 1) | bit
-        result["fc"] = current_fc
-        print(f"FC: {result['fc']}")
+    print(f"Format: {card.name}")
+    if card.fc != -1:
+        print(f"FC: {card.fc}")
     else:
         print("FC: (Not defined for this format)")
-
-    # 2. Extract Card Number
-    cn_start = format_info['card_number']['start']
-    cn_end = format_info['card_number']['end']
-    current_cn = 0
-    for i in range(cn_start, cn_end + 1):
-        bit = get_bit_from_array(data_buffer, i) # FIX: Pass data_buffer
-        current_cn = (current_cn << 1) | bit
-    result["cn"] = current_cn
-    print(f"CN: {result['cn']}")
-
-    # 3. Do Parity Checks
-    all_parity_ok = True
-    if format_info['parity_checks']:
-        for p_check in format_info['parity_checks']:
-            actual_parity_bit_pos = p_check['parity_bit_pos']
-            data_bits_for_parity = p_check['data_bits']
-            parity_type = p_check['type']
-
-            actual_parity_value = get_bit_from_array(data_buffer, actual_parity_bit_pos) # FIX: Pass data_buffer
-            calculated_parity_value = calculate_parity(data_buffer, data_bits_for_parity, parity_type) # FIX: Pass data_buffer
-
-            if actual_parity_value != calculated_parity_value:
-                all_parity_ok = False
-                print(f"  {parity_type} Parity (Bit {actual_parity_bit_pos}): FAIL (Actual={actual_parity_value}, Calc={calculated_parity_value})")
-        
-        result["parity_ok"] = all_parity_ok
-        print(f"Parity: {'PASS' if all_parity_ok else 'FAIL'}")
+    print(f"CN: {card.cn}")
+    if card.format.parity_checks:
+        print(f"Parity: {'PASS' if card.parity_ok else 'FAIL'}")
     else:
         print("Parity: (No checks defined)")
-        result["parity_ok"] = True # No checks to fail
 
     print("-----------------------------")
-    return result
+    return card
 
 # --- Raw Mode Handler ---
 
-def handle_raw_mode(result, data_buffer):
+def handle_raw_mode(card, gaps=None):
     """
     Handles raw mode card reading - displays raw data without access control.
-    FIX: Now takes a 'data_buffer' argument to read from.
+    With PULSE_CAPTURE, gaps holds the gap (us) before each pulse for diagnosing readers.
     """
-    if not result:
+    if not card:
         return
     
-    # TODO: Add to card history for web interface
-    # webserver.add_card_to_history(result)
+    webserver.add_card_to_history(card)
     
     # Console output
-    print(f"\n--- Raw Mode Card Read ---")
-    print(f"Format: {result['name']}")
-    if result['fc'] != -1:
-        print(f"FC: {result['fc']}")
+    print(f"\n--- Raw Mode Card Read (reader '{card.reader}') ---")
+    print(f"Format: {card.name}")
+    if card.fc != -1:
+        print(f"FC: {card.fc}")
     else:
         print("FC: (Not defined for this format)")
-    print(f"CN: {result['cn']}")
-    print(f"Hex: {result['raw_hex']}")
-    print(f"Parity: {'PASS' if result['parity_ok'] else 'FAIL'}")
-    
-    # Build binary string for display
-    full_binary_string = ""
-    for i in range(result['bits']):
-        full_binary_string += str(get_bit_from_array(data_buffer, i)) # FIX: Pass data_buffer
-    print(f"Binary: {full_binary_string}")
+    print(f"CN: {card.cn}")
+    print(f"Hex: {card.hex()}")
+    print(f"Parity: {'PASS' if card.parity_ok else 'FAIL'}")
+    print(f"Binary: {card.binary()}")
+    if gaps is not None:
+        print(f"Pulse gaps (us): {list(gaps[1:card.bits])}")
     print("-----------------------------")
     
     # OLED output
-    oled_line_1 = f"FC: {result['fc']}" if result['fc'] != -1 else "FC: N/A"
-    oled_line_2 = f"CN: {result['cn']}"
-    oled_line_3 = result['raw_hex']
-    oled_line_4 = f"Parity: {'PASS' if result['parity_ok'] else 'FAIL'}"
+    oled_line_1 = f"FC: {card.fc}" if card.fc != -1 else "FC: N/A"
+    oled_line_2 = f"CN: {card.cn}"
+    oled_line_3 = card.hex()
+    oled_line_4 = f"Parity: {'PASS' if card.parity_ok else 'FAIL'}"
+    if len(readers) > 1:
+        oled_line_3 = reader_label(card) # Which door matters more than the hex on a multi-reader board
     lcd.print(oled_line_1, oled_line_2, oled_line_3, oled_line_4)
 
 # --- Access Control Functions ---
-# (No changes needed)
-def find_user(fc, cn):
-    """Searches users list for matching FC and CN. Returns user dict or None."""
+
+def set_users(new_users):
+    """
+    Replaces the user set. The new index is built completely before it is swapped
+    in, so a swipe never sees a half-built index.
+    """
     global users
-    if users is None:
+    index = credentials.UserIndex(new_users)
+    _swap_user_index(index)
+    users = index.users
+
+def open_user_store(path):
+    """
+    Switches lookups to the flash credential store at path. Returns False (and keeps
+    the current index) if the store cannot be opened.
+    """
+    global users
+    try:
+        store = credentials.CredentialStore(path)
+    except (OSError, ValueError) as e:
+        print(f"Error opening credential store {path}: {e}")
+        return False
+    _swap_user_index(store)
+    users = [] # Records stay on flash
+    return True
+
+def _swap_user_index(index):
+    global user_index, user_filter
+    fp_rate = config.BLOOM_FP_RATE if config else 0.01
+    bloom = None
+    if fp_rate:
+        bloom = credentials.build_bloom(index, fp_rate, config.BLOOM_MAX_BYTES if config else 16384)
+    old_index = user_index
+    user_index = index
+    user_filter = bloom
+    if old_index is not index and isinstance(old_index, credentials.CredentialStore):
+        old_index.close()
+
+def apply_user_change(op):
+    """
+    Datastore listener: applies one journaled users change to the live index and
+    Bloom filter in place, or rebuilds them when the whole table was replaced.
+    Runs from the web request handler, between swipes.
+    """
+    if op is None:
+        # A credential store is reopened by rewrite_user_store() instead
+        if not isinstance(user_index, credentials.CredentialStore):
+            set_users(datastore.user_db.get())
+        return
+    kind = op[0]
+    user = None
+    if kind == 'a':
+        user = op[1]
+    elif kind == 'u':
+        user_index.remove(op[1][0], op[1][1])
+        user = op[2]
+    elif kind == 'd':
+        user_index.remove(op[1][0], op[1][1])
+    elif kind == 's':
+        user = datastore.user_db.find(op[1])
+    if user is None or user.get('FC') is None or user.get('CN') is None:
+        return
+    user_index.put(user)
+    if user_filter is not None:
+        user_filter.add(user['FC'], user['CN']) # Deleted keys stay set until the next rebuild
+
+def find_user(fc, cn):
+    """Looks up the user for FC and CN (CN only when FC is -1). Returns user dict or None."""
+    # Unknown cards are rejected by the Bloom filter without an index or flash lookup
+    if fc != -1 and user_filter is not None and not user_filter.might_contain(fc, cn):
         return None
-    
-    for user in users:
-        if fc == -1:
-            if user.get('CN') == cn:
-                return user
-        else:
-            if user.get('FC') == fc and user.get('CN') == cn:
-                return user
-    return None
+    return user_index.find(fc, cn)
+
+def set_schedules(new_schedules):
+    """Compiles schedule groups into bitmaps and swaps them in."""
+    global access_schedules
+    access_schedules = schedules.Schedules(new_schedules)
 
-def handle_access_granted(user):
+def apply_schedule_change(op):
+    """Datastore listener: recompiles the schedule bitmaps."""
+    set_schedules(datastore.schedule_db.get())
+
+def handle_access_granted(user, card=None):
     """Displays 'Access Granted' message with user name on OLED."""
     print(f"Access Granted: {user.get('Name', 'Unknown')}")
-    lcd.print("Access Granted", user.get('Name', 'Unknown'), "", "")
+    lcd.print("Access Granted", user.get('Name', 'Unknown'), reader_label(card), "")
     if user.get('Flag'):
         print(f"Flag: {user.get('Flag')}")
 
-def handle_access_denied(reason, fc, cn):
+def handle_access_denied(reason, fc, cn, card=None):
     """Displays 'Access Denied' message with reason on OLED."""
     print(f"Access Denied: {reason}")
     if fc != -1:
-        lcd.print("Access Denied", reason, f"FC: {fc} CN: {cn}", "")
+        lcd.print("Access Denied", reason, f"FC: {fc} CN: {cn}", reader_label(card))
     else:
-        lcd.print("Access Denied", reason, f"CN: {cn}", "")
+        lcd.print("Access Denied", reason, f"CN: {cn}", reader_label(card))
+
+def report_lockout(reader_id):
+    """Announces a reader locked out for repeated denials on the display, console and MQTT."""
+    print(f"[RATE LIMIT] Reader '{reader_id}' locked for {config.RATE_LOCKOUT_S}s after repeated denials")
+    lcd.print("Reader Locked", "Too many denials", f"Reader: {reader_id}", f"{config.RATE_LOCKOUT_S}s lockout")
+    if config.MRACS_ENABLED:
+        mqtt_publish(f"{config.MQTT_TOPIC_PREFIX}/{get_device_id()}/alert", {
+            'type': 'reader_lockout',
+            'reader': reader_id,
+            'lockout_s': config.RATE_LOCKOUT_S,
+            'rate_limit': limiter.status(),
+            'timestamp': utime.time()
+        })
 
 # --- Special Event Handler ---
-# (No changes needed)
+
+def set_events(new_events):
+    """Replaces the events list, compiling the new rules before swapping them in."""
+    global events, event_rules
+    rules = actions.EventRules(new_events)
+    event_rules = rules
+    events = rules.events
+
+def apply_event_change(op):
+    """Datastore listener: recompiles the event rules (there are few, so every change rebuilds them)."""
+    set_events(datastore.event_db.get())
+
 def handle_special_events(fc, cn):
     """
     Checks events.json for matching FC+CN and executes corresponding actions.
     """
-    global events
-    if events is None:
-        return False
-    
-    for event in events:
-        event_fc = event.get('FC')
-        event_cn = event.get('CN')
-        action = event.get('action')
-        params = event.get('params', {})
-        
-        fc_match = (event_fc is None) or (event_fc == fc)
-        cn_match = (event_cn is None) or (event_cn == cn)
-        
-        if fc_match and cn_match:
-            print(f"Special event triggered: {action} for FC:{fc} CN:{cn}")
-            
-            if action == "door_open":
-                door_open(params.get('duration', 5))
-            elif action == "door_close":
-                door_close()
-            elif action == "light_on":
-                light_on(params.get('light_id', 1), params.get('duration', 10))
-            elif action == "light_off":
-                light_off(params.get('light_id', 1))
-            elif action == "buzzer_beep":
-                buzzer_beep(params.get('count', 1), params.get('duration', 100))
-            else:
-                print(f"Unknown action: {action}")
-            
-            return True  # Event was handled
+    rule = event_rules.match(fc, cn)
+    if rule is None:
+        return False  # No matching event found
     
-    return False  # No matching event found
+    print(f"Special event triggered: {rule.action} for FC:{fc} CN:{cn}")
+    rule.run()
+    return True  # Event was handled
 
 # --- Main Event Handler ---
 # (No changes needed)
 def trigger_card_read_event(fc, cn, card_data):
     """
     Main event handler for card read events.
+    card_data is the formats.CardRead returned by process_card_data().
     """
-    global config
-    
-    # TODO: Add to card history for web interface
-    # webserver.add_card_to_history(card_data)
-    
-    special_event_triggered = handle_special_events(fc, cn)
-    user = find_user(fc, cn)
+    # Replayed cards and locked-out readers are refused before any lookup or event
+    limited = limiter.check(fc, cn, card_data.reader) if limiter is not None else None
     
+    user = None
     access_granted = False
-    if user is None:
-        handle_access_denied("Unknown User", fc, cn)
-    elif not user.get('active', False):
-        handle_access_denied("Card Disabled", fc, cn)
+    if limited is not None:
+        result = limited
+    else:
+        handle_special_events(fc, cn)
+        user = find_user(fc, cn)
+        if user is None:
+            result = "Unknown User"
+        elif not user.get('active', False):
+            result = "Card Disabled"
+        elif not access_schedules.allows(user.get('group'), schedules.hour_of_week()):
+            result = "Outside Schedule"
+        else:
+            result = "Granted"
+            access_granted = True
+    
+    if access_granted:
+        handle_access_granted(user, card_data)
     else:
-        handle_access_granted(user)
-        access_granted = True
+        handle_access_denied(result, fc, cn, card_data)
+        if limited is None and limiter is not None and limiter.denied(card_data.reader):
+            report_lockout(card_data.reader)
+    
+    webserver.add_card_to_history(card_data, result)
     
-    if config.get('MRACS_ENABLED', False):
-        topic_prefix = config.get('MQTT_TOPIC_PREFIX', 'opendoorsim')
+    if config.MRACS_ENABLED:
+        topic_prefix = config.MQTT_TOPIC_PREFIX
         device_id = get_device_id()
         card_read_topic = f"{topic_prefix}/{device_id}/card_read"
         
         mqtt_message = {
             'fc': fc,
             'cn': cn,
-            'bits': card_data.get('bits', 0),
-            'hex': card_data.get('raw_hex', ''),
-            'format': card_data.get('name', 'Unknown'),
-            'parity_ok': card_data.get('parity_ok', False),
+            'bits': card_data.bits,
+            'hex': card_data.hex(),
+            'format': card_data.name,
+            'parity_ok': card_data.parity_ok,
             'access_granted': access_granted,
+            'result': result,
+            'rate_limited': limiter.limited if limiter is not None else 0,
+            'reader': card_data.reader,
+            'frames_dropped': frame_queue_stats(card_data.reader)['dropped'],
+            'gap_us': {'min': card_data.min_gap_us, 'mean': card_data.mean_gap_us, 'max': card_data.max_gap_us},
+            'glitches': card_data.glitches,
             'user_name': user.get('Name', '') if user else '',
             'timestamp': utime.time()
         }
@@ -615,26 +710,47 @@ def trigger_card_read_event(fc, cn, card_data):
 
 # --- Main ---
 def main():
-    global pin_d0, pin_d1, display, config, users, events, wiegand_bit_array
+    global display, config, readers, limiter
     
     print("Loading configuration...")
     lcd.print("Loading configuration...")
     config = load_config()
-    users = load_users()
-    events = load_events()
+    config.listeners.append(apply_config)
+    setup_datastore(config)
+    user_store = config.USER_STORE
+    if not (user_store and open_user_store(user_store)):
+        datastore.user_db.resident = True # The in-RAM index holds the users after all
+        set_users(load_users())
+    set_events(load_events())
+    set_schedules(load_schedules())
+    # Web edits reach the running reader through these, without a reboot
+    datastore.user_db.listeners.append(apply_user_change)
+    datastore.event_db.listeners.append(apply_event_change)
+    datastore.schedule_db.listeners.append(apply_schedule_change)
+    extra_formats = formats.load_formats_file()
     
-    mode = config.get('MODE', 'doorsim').lower()
-    mracs_enabled = config.get('MRACS_ENABLED', False)
+    mode = config.mode
+    mracs_enabled = config.MRACS_ENABLED
     print(f"System Mode: {mode.upper()}")
     lcd.print(f"System Mode: {mode.upper()}")
     print(f"MRACS Enabled: {mracs_enabled}")
-    print(f"Loaded {len(users)} users from users.json")
+    if user_store and isinstance(user_index, credentials.CredentialStore):
+        print(f"Using {len(user_index)} users from credential store {user_store}")
+    else:
+        print(f"Loaded {len(user_index)} users from users.json")
+    if user_filter is not None:
+        print(f"Bloom filter: {user_filter.size_bytes()} bytes, {user_filter.hashes} hashes, "
+              f"~{user_filter.fp_rate() * 100:.2f}% false positives")
     print(f"Loaded {len(events)} events from events.json")
+    print(f"Loaded {len(access_schedules)} schedule groups from schedules.json")
+    if extra_formats:
+        print(f"Registered {extra_formats} formats from formats.json")
+    
+    setup_outputs(config)
     
-    if mode not in ['raw', 'doorsim', 'accessory']:
-        print(f"Warning: Invalid MODE '{mode}', defaulting to 'doorsim'")
-        lcd.print(f"Warning: Invalid MODE '{mode}', defaulting to 'doorsim'")
-        mode = 'doorsim'
+    if config.MODE.lower() not in appconfig.MODES:
+        print(f"Warning: Invalid MODE '{config.MODE}', defaulting to 'doorsim'")
+        lcd.print(f"Warning: Invalid MODE '{config.MODE}', defaulting to 'doorsim'")
     
     ap = network.WLAN(network.AP_IF)
     should_start_webserver = False
@@ -644,7 +760,10 @@ def main():
         webserver.start_server_non_blocking()
     
     if mode != 'accessory':
-        wiegand_bit_array = bytearray(config['MAX_BITS'] // 8 + 1)
+        pulse_capture = config.PULSE_CAPTURE
+        frame_words = array('I', [0] * config.frame_words) # Reused copy of a queued frame's words
+        frame_meta = array('i', [0] * wiegand.FRAME_META_SIZE) # Pulse ticks and gap stats of that frame
+        frame_gaps = array('H', [0] * config.MAX_BITS) if pulse_capture else None
     
     if mracs_enabled and mode in ['doorsim', 'accessory']:
         print("Initializing MQTT (MRACS enabled)...")
@@ -656,10 +775,10 @@ def main():
         print("MQTT disabled (MRACS not enabled or wrong mode)")
     
     print("OLED Display Initializing...")
-    print(f"OLED SCL Pin: {config['SCL_PIN']}, SDA Pin: {config['SDA_PIN']}")
+    print(f"OLED SCL Pin: {config.SCL_PIN}, SDA Pin: {config.SDA_PIN}")
     
     try:
-        i2c = I2C(0, scl=Pin(config['SCL_PIN']), sda=Pin(config['SDA_PIN']), freq=400000)
+        i2c = I2C(0, scl=Pin(config.SCL_PIN), sda=Pin(config.SDA_PIN), freq=400000)
         print("Scanning I2C bus...")
         devices = i2c.scan()
 
@@ -673,8 +792,8 @@ def main():
             
             print(f"Initializing OLED at {hex(oled_addr)}...")
             display = ssd1306.SSD1306_I2C(
-                config['SCREEN_WIDTH'], config['SCREEN_HEIGHT'], i2c, 
-                addr=oled_addr, flipped=config['OLED_FLIPPED']
+                config.SCREEN_WIDTH, config.SCREEN_HEIGHT, i2c, 
+                addr=oled_addr, flipped=config.OLED_FLIPPED
             )
             lcd.print("System Ready.", "Please swipe...")
             print("OLED Initialized.")
@@ -685,16 +804,16 @@ def main():
 
     if mode != 'accessory':
         print("Wiegand Reader Initializing...")
-        print(f"Wiegand D0 Pin: {config['D0_PIN']}, D1 Pin: {config['D1_PIN']}")
         try:
-            pin_d0 = Pin(config['D0_PIN'], Pin.IN, Pin.PULL_UP)
-            pin_d1 = Pin(config['D1_PIN'], Pin.IN, Pin.PULL_UP)
+            readers = build_readers(config)
+            for reader in readers:
+                print(f"Wiegand reader '{reader.id}': D0 Pin {reader.d0_pin_num}, D1 Pin {reader.d1_pin_num}, "
+                      f"{'timer' if reader.timer else 'polled'} end of frame")
+                reader.start()
+            limiter = build_limiter(config, readers)
+            webserver.rate_limiter = limiter
+            print(f"Rate limiter: {limiter.size_bytes()} bytes of counters")
             
-            reset_wiegand_buffer() # Initialize buffer
-            
-            pin_d0.irq(trigger=Pin.IRQ_FALLING, handler=d0_pulse_handler)
-            pin_d1.irq(trigger=Pin.IRQ_FALLING, handler=d1_pulse_handler)
-
             print("\nReader is active. Please swipe a card...")
             lcd.print("Reader is active. Please swipe a card...")
 
@@ -712,74 +831,98 @@ def main():
     loop_counter = 0
     # Run heavy tasks every 10 loops (approx 10 * 10ms = 100ms)
     NON_CRITICAL_TASKS_INTERVAL = 10 
+    # How long a result stays on screen before the ready prompt returns
+    RESULT_DISPLAY_MS = 4000
+    ready_prompt_due = None
+    dropped_reported = [0] * len(readers)
+    junk_reported = [0] * len(readers)
+    next_reader = 0 # Reader to drain first on the next pass, so no reader starves the others
 
     while True:
         try:
+            scheduler.run() # Apply due door/light/buzzer transitions
+            
             # --- PRIORITY 1: Wiegand Reader Logic (if not accessory) ---
             if mode in ['raw', 'doorsim']:
                 
-                # Check if a card read is in progress
-                if current_bit_index > 0:
+                # Readers without a frame timer are polled for the end of a read in progress
+                reading = False
+                for index in range(len(readers)):
+                    reader = readers[index]
+                    reader.poll()
+                    if reader.timer is None and reader.is_reading():
+                        reading = True
                     
-                    # A read is happening. Check for timeout.
-                    time_since_last_pulse = utime.ticks_diff(utime.ticks_us(), last_pulse_time_microsec)
-                    timeout_threshold = config['CARD_READ_TIMEOUT_MS'] * 1000
-                    
-                    if time_since_last_pulse > timeout_threshold:
-                        # --- Card Read Finished ---
-                        
-                        # --- Start Critical Section ---
-                        irq_state = machine.disable_irq()
-                        # Copy the bit count and the *actual data*
-                        bits_to_process = current_bit_index
-                        data_to_process = bytearray(wiegand_bit_array) # Make a copy!
-                        # Reset the global buffer NOW so new pulses are not missed
-                        reset_wiegand_buffer()
-                        machine.enable_irq(irq_state) 
-                        # --- End Critical Section ---
-                        
-                        # Process the *copied* data
-                        result = process_card_data(bits_to_process, data_to_process) # FIX: Pass copy
-                        
-                        if result:
-                            if mode == 'raw':
-                                handle_raw_mode(result, data_to_process) # FIX: Pass copy
-                            elif mode == 'doorsim':
-                                trigger_card_read_event(result['fc'], result['cn'], result)
-                            
-                            utime.sleep(4) # Hold result on screen
-                            
-                            if mode == 'raw':
-                                lcd.print("Raw Mode Ready", "Please swipe...", "", "")
-                            else:
-                                lcd.print("System Ready.", "Please swipe...", "", "")
-                            print("\n\nReader is active. Please swipe a card...")
-                        else:
-                            print("Card processing failed (0 bits or error). Buffer reset.")
-                            lcd.print("Card processing failed (0 bits or error). Buffer reset.")
+                    # Report frames lost to queue overflow or discarded as noise
+                    if reader.dropped() != dropped_reported[index]:
+                        dropped_reported[index] = reader.dropped()
+                        print(f"[WARN] Reader '{reader.id}' frame queue overflow: {dropped_reported[index]} frame(s) dropped")
+                    if reader.junk() != junk_reported[index]:
+                        junk_reported[index] = reader.junk()
+                        print(f"[WARN] Reader '{reader.id}' discarded {junk_reported[index]} junk frame(s) (too short or glitchy)")
+                
+                # Drain at most one queued frame per reader per pass, round-robin, so a busy
+                # reader cannot starve the others and new pulses are still timed out promptly
+                processed = False
+                for offset in range(len(readers)):
+                    reader = readers[(next_reader + offset) % len(readers)]
+                    bits_to_process = reader.pop_frame(frame_words, frame_meta, frame_gaps)
+                    if not bits_to_process:
+                        continue
+                    processed = True
+                    card = process_card_data(bits_to_process, frame_words, frame_meta, reader.id)
                     
+                    if card:
+                        if mode == 'raw':
+                            handle_raw_mode(card, frame_gaps)
+                        elif mode == 'doorsim':
+                            trigger_card_read_event(card.fc, card.cn, card)
+                        # Hold result on screen without blocking the reader
+                        ready_prompt_due = utime.ticks_add(utime.ticks_ms(), RESULT_DISPLAY_MS)
                     else:
-                        # Card is *currently* being read (between pulses)
-                        # Do nothing else. Sleep for a tiny bit and re-check.
-                        utime.sleep_us(100)
-                        continue # Jump to start of while loop
+                        print("Card processing failed (0 bits or error). Buffer reset.")
+                        lcd.print("Card processing failed (0 bits or error). Buffer reset.")
+                if processed:
+                    next_reader = (next_reader + 1) % len(readers)
+                    continue # Jump to start of while loop
+                
+                if reading:
+                    # A card is *currently* being read (between pulses) on a polled reader
+                    # Do nothing else. Sleep for a tiny bit and re-check.
+                    utime.sleep_us(100)
+                    continue # Jump to start of while loop
+                
+                if ready_prompt_due is not None and utime.ticks_diff(utime.ticks_ms(), ready_prompt_due) >= 0:
+                    ready_prompt_due = None
+                    if mode == 'raw':
+                        lcd.print("Raw Mode Ready", "Please swipe...", "", "")
+                    else:
+                        lcd.print("System Ready.", "Please swipe...", "", "")
+                    print("\n\nReader is active. Please swipe a card...")
                 
                 # --- PRIORITY 2: Idle Loop Tasks ---
-                # This code only runs if current_bit_index == 0 (idle)
+                # This code only runs if no bits are pending (idle)
                 
                 loop_counter += 1
                 if loop_counter >= NON_CRITICAL_TASKS_INTERVAL:
                     loop_counter = 0 # Reset counter
                     
                     # Run heavy tasks
+                    if limiter is not None:
+                        limiter.decay()
+                    
                     if should_start_webserver:
-                        webserver.process_requests()
+                        webserver.process_requests(reader_busy)
                     
                     if mracs_enabled and mode == 'doorsim':
                         mqtt_loop()
                 
-                # Sleep to yield to interrupts and prevent busy-loop
-                utime.sleep_ms(10) # 10ms is a good idle poll rate
+                # Sleep to yield to interrupts and prevent busy-loop. With the frame
+                # timer, wake as soon as a frame is queued instead of after the full 10ms.
+                if any(reader.timer is None for reader in readers):
+                    utime.sleep_ms(10) # 10ms is a good idle poll rate
+                else:
+                    wait_for_frame(10)
 
             else:
                 # --- Accessory Mode Loop (No Wiegand) ---
@@ -800,8 +943,8 @@ def main():
             utime.sleep(5) # Pause on error
             
     # Cleanup
-    if pin_d0: pin_d0.irq(handler=None)
-    if pin_d1: pin_d1.irq(handler=None)
+    for reader in readers:
+        reader.stop()
     print("Interrupts detached. Program End.")
     lcd.print("SYSTEM HALTED.")
 
@@ -0,0 +1,210 @@
+# ratelimit.py - Fixed-memory swipe rate limiting and brute-force lockout
+
+from array import array
+import utime
+from credentials import key_hashes
+
+# --- Rate Limiter ---
+# Two kinds of abuse are caught, with memory fixed when the limiter is built
+# however many distinct cards are presented:
+#
+#   replay       one credential swiped faster than card_limit per window. Swipes
+#                are counted in a count-min sketch (depth x width 16-bit counters,
+#                conservative update; it can only over-count), and a credential over the
+#                limit enters a small table of hot keys and is locked out.
+#   enumeration  many different cards denied at one reader. Each reader counts
+#                its denials, and a reader over reader_limit per window is locked
+#                out (every swipe there is denied) for lockout_s.
+#
+# Every window_s all counters are halved, so the counts track the recent rate.
+# check() and denied() cost a few array updates per swipe; the hot-key table is
+# scanned linearly but holds only hot_size entries, least recently seen evicted.
+
+SKETCH_DEPTH = 4
+
+class RateLimiter:
+    """Count-min sketch per credential plus denial counters per reader."""
+    __slots__ = ('card_limit', 'reader_limit', 'lockout_ms', 'window_ms', 'width',
+                 'sketch', 'reader_ids', 'reader_denials', 'reader_until', 'reader_lockouts',
+                 'hot_keys', 'hot_until', 'hot_seen', 'hot_strikes', 'limited', '_window_start', '_indexes')
+
+    def __init__(self, reader_ids, card_limit=10, reader_limit=20, lockout_s=60, window_s=60,
+                 width=256, hot_size=8):
+        self.card_limit = card_limit        # Swipes of one credential per window (0 = no limit)
+        self.reader_limit = reader_limit    # Denials at one reader per window (0 = no lockout)
+        self.lockout_ms = lockout_s * 1000
+        self.window_ms = window_s * 1000
+        self.width = width
+        self.sketch = array('H', [0] * (SKETCH_DEPTH * width))
+        self._indexes = array('i', [0] * SKETCH_DEPTH)
+        self.reader_ids = list(reader_ids)
+        count = len(self.reader_ids)
+        self.reader_denials = array('H', [0] * count)
+        self.reader_until = array('i', [0] * count)   # ticks_ms the lockout ends (0 = not locked)
+        self.reader_lockouts = array('H', [0] * count)
+        self.hot_keys = [None] * hot_size             # (FC, CN) of credentials over card_limit
+        self.hot_until = array('i', [0] * hot_size)
+        self.hot_seen = array('i', [0] * hot_size)
+        self.hot_strikes = array('H', [0] * hot_size)
+        self.limited = 0                              # Swipes denied by the limiter
+        self._window_start = utime.ticks_ms()
+
+    def _reader(self, reader_id):
+        try:
+            return self.reader_ids.index(reader_id)
+        except ValueError:
+            return -1
+
+    def _locked(self, deadlines, index, now_ms):
+        """
+        True while deadlines[index] is in the future. An expired deadline is reset
+        to 0: ticks_ms wraps every 2^30 ms, and a stale deadline would otherwise
+        look like it is in the future again about 6 days later.
+        """
+        until = deadlines[index]
+        if until == 0:
+            return False
+        if utime.ticks_diff(until, now_ms) > 0:
+            return True
+        deadlines[index] = 0
+        return False
+
+    def _until(self, now_ms):
+        return utime.ticks_add(now_ms, self.lockout_ms) or 1 # 0 means "not locked"
+
+    def _count(self, fc, cn):
+        """Adds one swipe of (FC, CN) to the sketch and returns its estimated count."""
+        h1, h2 = key_hashes(fc, cn)
+        sketch = self.sketch
+        width = self.width
+        indexes = self._indexes
+        estimate = 0xFFFF
+        for row in range(SKETCH_DEPTH):
+            index = row * width + h1 % width
+            indexes[row] = index
+            if sketch[index] < estimate:
+                estimate = sketch[index]
+            h1 += h2
+        if estimate < 0xFFFF:
+            estimate += 1
+        # Conservative update: only raise counters below the new estimate, which
+        # keeps busy cells from inflating the counts of unrelated cards
+        for row in range(SKETCH_DEPTH):
+            if sketch[indexes[row]] < estimate:
+                sketch[indexes[row]] = estimate
+        return estimate
+
+    def _hot_slot(self, key, now_ms):
+        """Returns the hot-key slot for key, evicting the least recently seen one if needed."""
+        keys = self.hot_keys
+        oldest = 0
+        for slot in range(len(keys)):
+            if keys[slot] == key:
+                return slot
+            if keys[slot] is None:
+                oldest = slot
+                break
+            if utime.ticks_diff(self.hot_seen[slot], self.hot_seen[oldest]) < 0:
+                oldest = slot
+        keys[oldest] = key
+        self.hot_until[oldest] = 0
+        self.hot_strikes[oldest] = 0
+        return oldest
+
+    def check(self, fc, cn, reader_id, now_ms=None):
+        """
+        Counts a swipe and returns the reason to deny it ('Reader Locked',
+        'Rate Limited'), or None if it may go on to the normal access check.
+        """
+        if now_ms is None:
+            now_ms = utime.ticks_ms()
+        reader = self._reader(reader_id)
+        if reader >= 0 and self._locked(self.reader_until, reader, now_ms):
+            self.limited += 1
+            return 'Reader Locked'
+        if not self.card_limit:
+            return None
+        key = (fc, cn)
+        for slot in range(len(self.hot_keys)):
+            if self.hot_keys[slot] == key:
+                self.hot_seen[slot] = now_ms
+                if self._locked(self.hot_until, slot, now_ms):
+                    self.limited += 1
+                    return 'Rate Limited'
+                break
+        if self._count(fc, cn) <= self.card_limit:
+            return None
+        slot = self._hot_slot(key, now_ms)
+        self.hot_seen[slot] = now_ms
+        self.hot_until[slot] = self._until(now_ms)
+        self.hot_strikes[slot] += 1
+        self.limited += 1
+        return 'Rate Limited'
+
+    def denied(self, reader_id, now_ms=None):
+        """
+        Counts a denial at a reader. Returns True if this denial locked the reader
+        out (so the caller can raise an alert once per lockout).
+        """
+        if not self.reader_limit:
+            return False
+        reader = self._reader(reader_id)
+        if reader < 0:
+            return False
+        if now_ms is None:
+            now_ms = utime.ticks_ms()
+        if self.reader_denials[reader] < 0xFFFF:
+            self.reader_denials[reader] += 1
+        if self.reader_denials[reader] > self.reader_limit and not self._locked(self.reader_until, reader, now_ms):
+            self.reader_until[reader] = self._until(now_ms)
+            self.reader_lockouts[reader] += 1
+            self.reader_denials[reader] = 0
+            return True
+        return False
+
+    def decay(self, now_ms=None):
+        """Halves every counter once per window. Call from the main loop."""
+        if now_ms is None:
+            now_ms = utime.ticks_ms()
+        if utime.ticks_diff(now_ms, self._window_start) < self.window_ms:
+            return False
+        self._window_start = now_ms
+        sketch = self.sketch
+        for index in range(len(sketch)):
+            sketch[index] >>= 1
+        for reader in range(len(self.reader_denials)):
+            self.reader_denials[reader] >>= 1
+            self._locked(self.reader_until, reader, now_ms) # Clears ended lockouts before they can wrap
+        for slot in range(len(self.hot_until)):
+            self._locked(self.hot_until, slot, now_ms)
+        return True
+
+    def _remaining_s(self, deadlines, index, now_ms):
+        return utime.ticks_diff(deadlines[index], now_ms) // 1000 if self._locked(deadlines, index, now_ms) else 0
+
+    def status(self, now_ms=None):
+        """Returns the readers and credentials currently locked out, for the web page and MQTT."""
+        if now_ms is None:
+            now_ms = utime.ticks_ms()
+        readers = []
+        for reader, reader_id in enumerate(self.reader_ids):
+            readers.append({
+                'reader': reader_id,
+                'denials': self.reader_denials[reader],
+                'lockouts': self.reader_lockouts[reader],
+                'locked_s': self._remaining_s(self.reader_until, reader, now_ms)
+            })
+        cards = []
+        for slot, key in enumerate(self.hot_keys):
+            if key is not None:
+                cards.append({
+                    'fc': key[0],
+                    'cn': key[1],
+                    'strikes': self.hot_strikes[slot],
+                    'locked_s': self._remaining_s(self.hot_until, slot, now_ms)
+                })
+        return {'limited': self.limited, 'readers': readers, 'cards': cards}
+
+    def size_bytes(self):
+        """Approximate RAM held by the counter arrays (fixed at construction)."""
+        return 2 * len(self.sketch) + 8 * len(self.reader_ids) + 10 * len(self.hot_keys)
@@ -0,0 +1,217 @@
+# scheduler.py - Non-blocking timed actions on door, light and buzzer outputs
+
+from machine import Pin
+import utime
+
+# --- Outputs ---
+# Each output is a GPIO pin (or a console-only stand-in when no pin is configured)
+# driven by the actions holding it: it is on while at least one action holds it,
+# so overlapping actions on the same output extend each other instead of one
+# action's "off" cutting another short.
+
+class Output:
+    """A GPIO output switched on while any action holds it."""
+    __slots__ = ('name', 'pin', 'active_low', 'holders')
+
+    def __init__(self, name, pin_number=None, active_low=False):
+        self.name = name
+        self.active_low = active_low
+        self.holders = 0
+        self.pin = None
+        if pin_number is not None:
+            self.pin = Pin(pin_number, Pin.OUT, value=1 if active_low else 0)
+
+    def is_on(self):
+        return self.holders > 0
+
+    def _drive(self):
+        on = self.holders > 0
+        if self.pin is not None:
+            self.pin.value(int(on) ^ int(self.active_low))
+        else:
+            print(f"[OUTPUT] {self.name} {'on' if on else 'off'}")
+
+    def hold(self):
+        self.holders += 1
+        if self.holders == 1:
+            self._drive()
+
+    def release(self):
+        if self.holders:
+            self.holders -= 1
+            if self.holders == 0:
+                self._drive()
+
+outputs = {}
+
+def add_output(name, pin_number=None, active_low=False):
+    """Registers an output; without a pin number its transitions are only printed."""
+    outputs[name] = Output(name, pin_number, active_low)
+    return outputs[name]
+
+def get_output(name):
+    """Returns the named output, creating a console-only one if it is not configured."""
+    output = outputs.get(name)
+    if output is None:
+        output = add_output(name)
+    return output
+
+# --- Timer Wheel ---
+# Pending transitions sit in WHEEL_SLOTS buckets of TICK_MS each, indexed by their
+# due tick; longer delays simply wait for a later pass of the wheel. run() is
+# called from the main loop and only touches the buckets for the ticks that have
+# passed, so it costs the same however many actions are pending, and nothing in
+# here ever sleeps.
+
+TICK_MS = 10
+WHEEL_SLOTS = 64
+
+_wheel = [[] for _ in range(WHEEL_SLOTS)]
+_tick = 0             # Ticks processed so far
+_last_ms = None       # utime.ticks_ms() at the last processed tick
+_next_id = 1
+actions = {}          # Action id -> Action, while the action has steps pending or holds its output
+
+class Action:
+    """A named sequence of on/off transitions on one output."""
+    __slots__ = ('id', 'name', 'output', 'holding', 'pending', 'ends_tick', 'cancelled')
+
+    def __init__(self, action_id, name, output):
+        self.id = action_id
+        self.name = name
+        self.output = output
+        self.holding = False
+        self.pending = 0       # Transitions still in the wheel
+        self.ends_tick = None  # Tick of the last transition (None = held until cancelled)
+        self.cancelled = False
+
+    def _step(self, on):
+        if on and not self.holding:
+            self.holding = True
+            self.output.hold()
+        elif not on and self.holding:
+            self.holding = False
+            self.output.release()
+
+def _add_step(action, delay_ms, on):
+    due = _tick + (delay_ms + TICK_MS - 1) // TICK_MS
+    _wheel[due % WHEEL_SLOTS].append((due, action, on))
+    action.pending += 1
+    return due
+
+def _finish(action):
+    if action.pending == 0 and not action.holding:
+        actions.pop(action.id, None)
+
+def start_action(name, output_name, steps):
+    """
+    Starts an action from (delay_ms, on) steps, delays counted from now. A step with
+    delay 0 runs immediately. Returns the Action (see cancel()).
+    """
+    global _next_id
+    run() # Bring the wheel up to date so delays count from now
+    action = Action(_next_id, name, get_output(output_name))
+    _next_id += 1
+    actions[action.id] = action
+    for delay_ms, on in steps:
+        if delay_ms <= 0:
+            action._step(on)
+        else:
+            action.ends_tick = _add_step(action, delay_ms, on)
+    if action.ends_tick is None and not action.holding:
+        _finish(action)
+    return action
+
+def pulse(name, output_name, duration_ms):
+    """Turns the output on for duration_ms (duration_ms <= 0 holds it until cancelled)."""
+    if duration_ms <= 0:
+        return start_action(name, output_name, ((0, True),))
+    return start_action(name, output_name, ((0, True), (duration_ms, False)))
+
+def pattern(name, output_name, count, on_ms, off_ms):
+    """Switches the output on for on_ms then off for off_ms, count times."""
+    steps = []
+    at_ms = 0
+    for _ in range(count):
+        steps.append((at_ms, True))
+        steps.append((at_ms + on_ms, False))
+        at_ms += on_ms + off_ms
+    return start_action(name, output_name, steps)
+
+def cancel(action_id):
+    """Cancels a pending action and releases its output. Returns False if it is not active."""
+    action = actions.pop(action_id, None)
+    if action is None:
+        return False
+    action.cancelled = True # Its steps are dropped when their bucket comes round
+    action._step(False)
+    return True
+
+def cancel_output(output_name):
+    """Cancels every action on an output, which then turns off. Returns the number cancelled."""
+    cancelled = 0
+    for action in list(actions.values()):
+        if action.output.name == output_name:
+            cancel(action.id)
+            cancelled += 1
+    return cancelled
+
+def run():
+    """Applies every transition that has come due. Call from the main loop."""
+    global _tick, _last_ms
+    now_ms = utime.ticks_ms()
+    if _last_ms is None:
+        # First call: start counting ticks from here
+        _last_ms = now_ms
+        return
+    elapsed = utime.ticks_diff(now_ms, _last_ms) // TICK_MS
+    if elapsed <= 0:
+        return
+    target = _tick + elapsed
+    _last_ms = utime.ticks_add(_last_ms, elapsed * TICK_MS)
+    due_steps = None
+    # A stall longer than a whole turn of the wheel still only visits each bucket once
+    for tick in range(_tick + 1, _tick + 1 + min(elapsed, WHEEL_SLOTS)):
+        bucket = _wheel[tick % WHEEL_SLOTS]
+        if not bucket:
+            continue
+        keep = []
+        for step in bucket:
+            if step[0] <= target:
+                if due_steps is None:
+                    due_steps = []
+                due_steps.append(step)
+            else:
+                keep.append(step)
+        _wheel[tick % WHEEL_SLOTS] = keep
+    _tick = target
+    if due_steps is None:
+        return
+    if elapsed > 1:
+        due_steps.sort(key=lambda step: step[0]) # Keep each action's steps in order after a stall
+    for due, action, on in due_steps:
+        action.pending -= 1
+        if action.cancelled:
+            continue
+        action._step(on)
+        _finish(action)
+
+# --- Inspection ---
+
+def pending_actions():
+    """Returns the active actions as dicts (id, name, output, state, remaining_ms)."""
+    result = []
+    for action in actions.values():
+        result.append({
+            'id': action.id,
+            'name': action.name,
+            'output': action.output.name,
+            'state': 'on' if action.holding else 'off',
+            'remaining_ms': -1 if action.ends_tick is None else max(0, (action.ends_tick - _tick) * TICK_MS)
+        })
+    result.sort(key=lambda entry: entry['id'])
+    return result
+
+def output_states():
+    """Returns {output name: (on, holders)} for every output."""
+    return {name: (output.is_on(), output.holders) for name, output in outputs.items()}
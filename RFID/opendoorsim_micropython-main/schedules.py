@@ -0,0 +1,94 @@
+# schedules.py - Weekly access schedules compiled to hour-of-week bitmaps
+
+import utime
+
+# --- Schedule Bitmaps ---
+# A schedule group's opening hours are written as text in schedules.json, e.g.
+#   {"group": 1, "name": "Lab hours", "hours": "Mon-Fri 8-18; Sat 10-14"}
+# and compiled once into 168 bits, one per hour of the week (Monday 00:00 is
+# bit 0). Checking a swipe is then a single bit test. Users with no 'group' (or
+# group 0) are not restricted; a group with no schedule never has access.
+#
+# Entries are separated by ';'. Each is a day or day range (Mon..Sun, or
+# Daily/Weekdays/Weekends) and an hour range start-end, end exclusive (0-24 is
+# the whole day). An end at or before the start runs past midnight into the
+# next day, wrapping from Sunday to Monday.
+
+HOURS_PER_WEEK = 168
+BITMAP_BYTES = 21
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+_DAY_SETS = {'daily': (0, 6), 'weekdays': (0, 4), 'weekends': (5, 6)}
+
+def _day(name):
+    try:
+        return DAYS.index(name[:3].lower())
+    except ValueError:
+        raise ValueError(f"unknown day '{name}'")
+
+def _days(text):
+    text = text.lower()
+    if text in _DAY_SETS:
+        first, last = _DAY_SETS[text]
+    elif '-' in text:
+        first, last = (_day(part) for part in text.split('-', 1))
+    else:
+        first = last = _day(text)
+    if last < first:
+        last += 7 # e.g. Sat-Mon
+    return [day % 7 for day in range(first, last + 1)]
+
+def compile_hours(hours):
+    """Compiles an hours string into a BITMAP_BYTES bytearray. Raises ValueError if it is malformed."""
+    bitmap = bytearray(BITMAP_BYTES)
+    for entry in hours.split(';'):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            days, span = entry.split()
+            start, end = (int(part) for part in span.split('-', 1))
+        except ValueError:
+            raise ValueError(f"expected '<days> <start>-<end>', got '{entry}'")
+        if not (0 <= start <= 23 and 0 <= end <= 24):
+            raise ValueError(f"hours out of range in '{entry}'")
+        length = end - start if end > start else end + 24 - start
+        for day in _days(days):
+            for hour in range(day * 24 + start, day * 24 + start + length):
+                hour %= HOURS_PER_WEEK
+                bitmap[hour >> 3] |= 1 << (hour & 7)
+    return bitmap
+
+def hour_of_week(t=None):
+    """Hour of the week (0 = Monday 00:00) for utime.localtime(t)."""
+    tm = utime.localtime(t) if t is not None else utime.localtime()
+    return tm[6] * 24 + tm[3]
+
+class Schedules:
+    """Compiled schedule groups: group number -> hour-of-week bitmap."""
+    __slots__ = ('schedules', 'bitmaps')
+
+    def __init__(self, schedules=None):
+        self.schedules = schedules if schedules is not None else []
+        bitmaps = {}
+        for schedule in self.schedules:
+            group = schedule.get('group')
+            if not group or group in bitmaps:
+                continue
+            try:
+                bitmaps[group] = compile_hours(schedule.get('hours', ''))
+            except ValueError as e:
+                print(f"Schedule {group}: {e}; no access")
+                bitmaps[group] = bytearray(BITMAP_BYTES)
+        self.bitmaps = bitmaps
+
+    def __len__(self):
+        return len(self.bitmaps)
+
+    def allows(self, group, hour):
+        """True if group (0/None = unrestricted) has access in hour of the week."""
+        if not group:
+            return True
+        bitmap = self.bitmaps.get(group)
+        if bitmap is None:
+            return False
+        return bool(bitmap[hour >> 3] & (1 << (hour & 7)))
@@ -0,0 +1,141 @@
+// app.js - OpenDoorSim web interface scripts (gzipped by host/build_static.py)
+function showTab(tabName) {
+    document.querySelectorAll(".tab-content").forEach(function(tab) { tab.classList.remove("active"); });
+    document.querySelectorAll(".tab").forEach(function(tab) { tab.classList.remove("active"); });
+    document.getElementById(tabName).classList.add("active");
+    event.target.classList.add("active");
+}
+function rebootDevice() {
+    if (confirm("Reboot device?")) {
+        fetch("/reboot", {method: "POST"}).then(function() { location.reload(); });
+    }
+}
+function addUserRow() {
+    const table = document.getElementById("usersTable");
+    const row = table.insertRow();
+    const i = table.rows.length - 1;
+    row.innerHTML = `
+        <td><input type="number" name="fc_${i}" value="" /></td>
+        <td><input type="number" name="cn_${i}" value="" /></td>
+        <td><input type="text" name="name_${i}" value="" /></td>
+        <td><input type="text" name="flag_${i}" value="" /></td>
+        <td><input type="number" name="group_${i}" value="" placeholder="any time" /></td>
+        <td><input type="checkbox" name="active_${i}" checked onchange="setUserActive(this)" /></td>
+        <td><button type="button" onclick="saveUserRow(this)">Save</button> <button type="button" onclick="deleteUser(this)">Delete</button></td>
+    `;
+    numberRows(table);
+}
+function numberRows(table) {
+    // Renames each row's fields to field_0, field_1, ... in table order; returns the row count
+    let count = 0;
+    Array.from(table.rows).forEach(function(row) {
+        const fields = row.querySelectorAll("[name]");
+        if (!fields.length) { return; } // "No users defined" placeholder
+        fields.forEach(function(field) { field.name = field.name.replace(/_\d+$/, "_" + count); });
+        count++;
+    });
+    return count;
+}
+function countRows(form, tableId) {
+    // Sent with whole-table saves so the device can refuse a form that arrived incomplete
+    form.elements["rows"].value = numberRows(document.getElementById(tableId));
+}
+function postRow(path, body, done) {
+    fetch(path, {method: "POST", headers: {"Content-Type": "application/x-www-form-urlencoded"}, body: body})
+        .then(function(r) {
+            if (r.ok) { done(); } else { r.text().then(function(text) { alert("Change failed: " + text); }); }
+        });
+}
+function userKey(row) {
+    // "fc=..&cn=.." of the saved user a row shows, or null for a row not saved yet
+    return row.dataset.fc === undefined ? null : "fc=" + row.dataset.fc + "&cn=" + row.dataset.cn;
+}
+function saveUserRow(button) {
+    // Saves one row through the journal: /users/add for a new row, /users/update for an existing one
+    const row = button.closest("tr");
+    const field = function(name) { return row.querySelector("[name^='" + name + "_']"); };
+    const key = userKey(row);
+    let body = ["fc", "cn", "name", "flag", "group"].map(function(name) {
+        return name + "=" + encodeURIComponent(field(name).value);
+    }).join("&") + "&active=" + (field("active").checked ? 1 : 0);
+    if (key) { body += "&old_" + key.replace("&", "&old_"); }
+    postRow(key ? "/users/update" : "/users/add", body, function() {
+        row.dataset.fc = field("fc").value;
+        row.dataset.cn = field("cn").value;
+    });
+}
+function setUserActive(checkbox) {
+    const key = userKey(checkbox.closest("tr"));
+    if (key) { postRow("/users/active", key + "&active=" + (checkbox.checked ? 1 : 0), function() {}); }
+}
+function removeRow(button) {
+    // Removes the button's own row and renumbers the rest, so later saves see every row
+    const row = button.closest("tr");
+    const table = row.parentElement;
+    row.remove();
+    numberRows(table);
+}
+function deleteUser(button) {
+    const key = userKey(button.closest("tr"));
+    if (!key) { removeRow(button); return; } // Never saved
+    if (confirm("Delete this user?")) {
+        postRow("/users/delete", key, function() { removeRow(button); });
+    }
+}
+function saveSchedule(group) {
+    const g = group === "new" ? document.getElementById("schedule_group_new").value : group;
+    const name = document.getElementById("schedule_name_" + group).value;
+    const hours = document.getElementById("schedule_hours_" + group).value;
+    postRow("/schedules/save", "group=" + g + "&name=" + encodeURIComponent(name) + "&hours=" + encodeURIComponent(hours),
+            function() { location.reload(); });
+}
+function deleteSchedule(group) {
+    if (confirm("Delete this schedule group? Its users will have no access.")) {
+        postRow("/schedules/delete", "group=" + group, function() { location.reload(); });
+    }
+}
+function syncClock() {
+    const d = new Date();
+    postRow("/set_time", "year=" + d.getFullYear() + "&month=" + (d.getMonth() + 1) + "&day=" + d.getDate() +
+            "&weekday=" + ((d.getDay() + 6) % 7) + "&hour=" + d.getHours() + "&minute=" + d.getMinutes() +
+            "&second=" + d.getSeconds(), function() { location.reload(); });
+}
+function addEventRow() {
+    const table = document.getElementById("eventsTable");
+    const row = table.insertRow();
+    const i = table.rows.length - 1;
+    row.innerHTML = `
+        <td><input type="number" name="fc_${i}" value="" placeholder="-1 for event code" /></td>
+        <td><input type="number" name="cn_${i}" value="" /></td>
+        <td><input type="text" name="action_${i}" value="" /></td>
+        <td><textarea name="params_${i}" rows="2">{}</textarea></td>
+        <td><button type="button" onclick="removeRow(this)">Delete</button></td>
+    `;
+    numberRows(table);
+}
+function deleteEvent(button, id) {
+    if (confirm("Delete this event?")) {
+        postRow("/events/delete", "id=" + id, function() { removeRow(button); });
+    }
+}
+function reloadUsers() { location.reload(); }
+function reloadEvents() { location.reload(); }
+function reloadConfig() { location.reload(); }
+function startFeed() {
+    // Live card reads from /feed, added to the Home tab's history without a reload
+    if (!window.EventSource) { return; }
+    const feed = new EventSource("/feed");
+    feed.addEventListener("card", function(e) {
+        const card = JSON.parse(e.data);
+        const table = document.getElementById("historyTable");
+        if (!table) { return; }
+        if (table.rows.length == 1 && table.rows[0].cells.length == 1) { table.deleteRow(0); } // "No card reads yet"
+        const row = table.insertRow(0);
+        [card.timestamp, card.fc == -1 ? "N/A" : card.fc, card.cn, card.bits, "0x" + card.hex,
+         card.parity_ok ? "PASS" : "FAIL", card.format, card.reader, card.result].forEach(function(value) {
+            row.insertCell().textContent = value;
+        });
+        while (table.rows.length > 25) { table.deleteRow(-1); }
+    });
+}
+startFeed();
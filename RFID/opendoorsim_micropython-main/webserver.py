@@ -1,28 +1,54 @@
 # webserver.py - Web Interface Server for OpenDoorSim
 
-import socket
 import json
+import os
+import hashlib
+import binascii
 import network
 import utime
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio # CPython, for the host tools
+import appconfig
+import datastore
+import scheduler
+import schedules
 
 # Global variables
 card_history = []  # Store last 25 card reads
 MAX_HISTORY = 25
+rate_limiter = None  # main.py's ratelimit.RateLimiter, shown on the Home tab
+feed_clients = []  # FeedClients subscribed to /feed
 
-def add_card_to_history(card_data):
-    """Add a card read to the history, keeping only the last MAX_HISTORY entries."""
-    global card_history
+def history_json(entry):
+    """A history entry as sent by /feed and /api/history: raw as a 'hex' string."""
+    data = dict(entry)
+    data['hex'] = f"{entry['raw']:X}" # raw can exceed what a JavaScript number holds exactly
+    del data['raw']
+    return data
+
+def add_card_to_history(card_data, result=''):
+    """
+    Add a card read to the history, keeping only the last MAX_HISTORY entries.
+    card_data is a formats.CardRead; its fields are copied because the record is
+    reused for later swipes, and the hex string is only built when the page renders.
+    """
     card_history.insert(0, {
         'timestamp': utime.time(),
-        'fc': card_data.get('fc', -1),
-        'cn': card_data.get('cn', -1),
-        'bits': card_data.get('bits', 0),
-        'hex': card_data.get('raw_hex', ''),
-        'parity_ok': card_data.get('parity_ok', False),
-        'format': card_data.get('name', 'Unknown')
+        'fc': card_data.fc,
+        'cn': card_data.cn,
+        'bits': card_data.bits,
+        'raw': card_data.raw,
+        'parity_ok': card_data.parity_ok,
+        'format': card_data.name,
+        'reader': card_data.reader,
+        'result': result
     })
     if len(card_history) > MAX_HISTORY:
-        card_history = card_history[:MAX_HISTORY]
+        card_history.pop()
+    if feed_clients:
+        publish_card(card_history[0])
 
 def get_ap_ip():
     """Get the Access Point IP address."""
@@ -32,54 +58,70 @@ def get_ap_ip():
     return "192.168.4.1"  # Default AP IP
 
 def load_config():
-    """Load configuration from config.json."""
-    try:
-        with open('config.json', 'r') as f:
-            return json.load(f)
-    except:
-        return {}
+    """Return the shared configuration (parsed once at boot, not per request)."""
+    return appconfig.get()
 
-def save_config(config):
-    """Save configuration to config.json."""
+# Settings on the Config tab (appconfig converts the submitted strings)
+CONFIG_FORM_FIELDS = ('MODE', 'D0_PIN', 'D1_PIN', 'SCL_PIN', 'SDA_PIN', 'SCREEN_WIDTH', 'SCREEN_HEIGHT',
+                      'MQTT_BROKER', 'MQTT_PORT', 'MQTT_CLIENT_ID')
+
+def save_config(params):
+    """
+    Apply a submitted config form through appconfig's versioned update.
+    Returns (status, message).
+    """
+    config = appconfig.get()
+    changes = {name: params[name] for name in CONFIG_FORM_FIELDS if name in params}
+    changes['MRACS_ENABLED'] = 'MRACS_ENABLED' in params # Unchecked boxes are not submitted
     try:
-        with open('config.json', 'w') as f:
-            json.dump(config, f, indent=2)
-        return True
-    except Exception as e:
+        version = int(params['version']) if params.get('version') else None
+        changed = config.update(changes, version)
+    except appconfig.ConfigConflict:
+        return 409, "Config was changed elsewhere since this page was loaded. Reload and try again."
+    except ValueError as e:
+        return 400, f"Error saving config: {e}"
+    except OSError as e:
         print(f"Error saving config: {e}")
-        return False
+        return 500, "Error saving config"
+    reboot = [name for name in changed if name not in appconfig.LIVE_FIELDS]
+    if reboot:
+        return 200, f"Config saved (version {config.version})! Reboot required for {', '.join(reboot)}."
+    return 200, f"Config saved (version {config.version})!"
 
 def load_users():
-    """Load users from users.json."""
+    """Load users (users.json plus its journal, cached after the first request)."""
     try:
-        with open('users.json', 'r') as f:
-            return json.load(f)
+        return datastore.user_db.get()
     except:
         return []
 
 def save_users(users):
-    """Save users to users.json."""
+    """Replace every user and compact users.json."""
     try:
-        with open('users.json', 'w') as f:
-            json.dump(users, f, indent=2)
+        datastore.user_db.replace(users)
         return True
     except Exception as e:
         print(f"Error saving users: {e}")
         return False
 
 def load_events():
-    """Load events from events.json."""
+    """Load events (events.json plus its journal, cached after the first request)."""
     try:
-        with open('events.json', 'r') as f:
-            return json.load(f)
+        return datastore.event_db.get()
+    except:
+        return []
+
+def load_schedules():
+    """Load schedule groups (schedules.json plus its journal, cached after the first request)."""
+    try:
+        return datastore.schedule_db.get()
     except:
         return []
 
 def save_events(events):
-    """Save events to events.json."""
+    """Replace every event and compact events.json."""
     try:
-        with open('events.json', 'w') as f:
-            json.dump(events, f, indent=2)
+        datastore.event_db.replace(events)
         return True
     except Exception as e:
         print(f"Error saving events: {e}")
@@ -93,32 +135,43 @@ def format_timestamp(timestamp):
     except:
         return "Unknown"
 
+def generate_html_rate_limit():
+    """Generate the lockout table for the Home tab (readers and credentials being rate limited)."""
+    if rate_limiter is None:
+        return ""
+    status = rate_limiter.status()
+    rows_html = ""
+    for reader in status['readers']:
+        if reader['locked_s'] or reader['lockouts']:
+            state = f"locked {reader['locked_s']}s" if reader['locked_s'] else "ok"
+            rows_html += f"<tr><td>Reader {reader['reader']}</td><td>{reader['lockouts']} lockouts</td><td>{state}</td></tr>"
+    for card in status['cards']:
+        state = f"locked {card['locked_s']}s" if card['locked_s'] else "ok"
+        rows_html += f"<tr><td>FC {card['fc']} CN {card['cn']}</td><td>{card['strikes']} strikes</td><td>{state}</td></tr>"
+    if not rows_html:
+        rows_html = "<tr><td colspan='3'>No abusive readers or cards</td></tr>"
+    return f"""
+        <h2>Rate Limiting ({status['limited']} swipes refused)</h2>
+        <table class="history-table">
+            <thead>
+                <tr>
+                    <th>Source</th>
+                    <th>Count</th>
+                    <th>State</th>
+                </tr>
+            </thead>
+            <tbody>
+                {rows_html}
+            </tbody>
+        </table>
+    """
+
 def generate_html_home(config, users, events):
-    """Generate HTML for the Home tab."""
+    """Generate HTML for the Home tab (yields fragments, one per history row)."""
     mracs_status = "Enabled" if config.get('MRACS_ENABLED', False) else "Disabled"
     mode = config.get('MODE', 'doorsim').upper()
     
-    history_html = ""
-    for card in card_history:
-        timestamp_str = format_timestamp(card['timestamp'])
-        parity_status = "PASS" if card['parity_ok'] else "FAIL"
-        fc_display = str(card['fc']) if card['fc'] != -1 else "N/A"
-        history_html += f"""
-        <tr>
-            <td>{timestamp_str}</td>
-            <td>{fc_display}</td>
-            <td>{card['cn']}</td>
-            <td>{card['bits']}</td>
-            <td>{card['hex']}</td>
-            <td>{parity_status}</td>
-            <td>{card['format']}</td>
-        </tr>
-        """
-    
-    if not history_html:
-        history_html = "<tr><td colspan='7'>No card reads yet</td></tr>"
-    
-    return f"""
+    yield f"""
     <div id="home" class="tab-content active">
         <h2>System Status</h2>
         <div class="status-grid">
@@ -157,12 +210,38 @@ def generate_html_home(config, users, events):
                     <th>Hex</th>
                     <th>Parity</th>
                     <th>Format</th>
+                    <th>Reader</th>
+                    <th>Result</th>
                 </tr>
             </thead>
-            <tbody>
-                {history_html}
+            <tbody id="historyTable">
+    """
+    
+    for card in list(card_history): # Copy: a swipe may be added while the page is sent
+        timestamp_str = format_timestamp(card['timestamp'])
+        parity_status = "PASS" if card['parity_ok'] else "FAIL"
+        fc_display = str(card['fc']) if card['fc'] != -1 else "N/A"
+        yield f"""
+        <tr>
+            <td>{timestamp_str}</td>
+            <td>{fc_display}</td>
+            <td>{card['cn']}</td>
+            <td>{card['bits']}</td>
+            <td>0x{card['raw']:X}</td>
+            <td>{parity_status}</td>
+            <td>{card['format']}</td>
+            <td>{card['reader']}</td>
+            <td>{card['result']}</td>
+        </tr>
+        """
+    
+    if not card_history:
+        yield "<tr><td colspan='9'>No card reads yet</td></tr>"
+    
+    yield f"""
             </tbody>
         </table>
+        {generate_html_rate_limit()}
         
         <div class="button-group">
             <button onclick="location.reload()">Refresh</button>
@@ -171,29 +250,57 @@ def generate_html_home(config, users, events):
     </div>
     """
 
-def generate_html_users(users):
-    """Generate HTML for the USERS tab."""
-    users_html = ""
-    for i, user in enumerate(users):
-        active_checked = "checked" if user.get('active', True) else ""
-        users_html += f"""
+def generate_html_schedules(schedule_list):
+    """Generate the schedule groups table for the USERS tab (yields fragments)."""
+    now = utime.localtime()
+    yield f"""
+        <h3>Schedule Groups</h3>
+        <p>Users with a group only have access during its hours (device time: {schedules.DAYS[now[6]].title()} {now[3]:02d}:{now[4]:02d}
+        <button type="button" onclick="syncClock()">Set from this browser</button>).</p>
+        <table class="edit-table">
+            <thead>
+                <tr>
+                    <th>Group</th>
+                    <th>Name</th>
+                    <th>Hours (days start-end; ...)</th>
+                    <th>Action</th>
+                </tr>
+            </thead>
+            <tbody>
+    """
+    for schedule in schedule_list:
+        group = schedule.get('group', '')
+        yield f"""
         <tr>
-            <td><input type="number" name="fc_{i}" value="{user.get('FC', '')}" /></td>
-            <td><input type="number" name="cn_{i}" value="{user.get('CN', '')}" /></td>
-            <td><input type="text" name="name_{i}" value="{user.get('Name', '')}" /></td>
-            <td><input type="text" name="flag_{i}" value="{user.get('Flag', '')}" /></td>
-            <td><input type="checkbox" name="active_{i}" {active_checked} /></td>
-            <td><button onclick="deleteUser({i})">Delete</button></td>
+            <td>{group}</td>
+            <td><input type="text" id="schedule_name_{group}" value="{schedule.get('name', '')}" /></td>
+            <td><input type="text" id="schedule_hours_{group}" value="{schedule.get('hours', '')}" placeholder="Weekdays 8-18; Sat 10-14" /></td>
+            <td>
+                <button type="button" onclick="saveSchedule({group})">Save</button>
+                <button type="button" onclick="deleteSchedule({group})">Delete</button>
+            </td>
         </tr>
         """
-    
-    if not users_html:
-        users_html = "<tr><td colspan='6'>No users defined</td></tr>"
-    
-    return f"""
+    yield """
+                <tr>
+                    <td><input type="number" id="schedule_group_new" min="1" /></td>
+                    <td><input type="text" id="schedule_name_new" /></td>
+                    <td><input type="text" id="schedule_hours_new" placeholder="Weekdays 8-18; Sat 10-14" /></td>
+                    <td><button type="button" onclick="saveSchedule('new')">Add</button></td>
+                </tr>
+            </tbody>
+        </table>
+    """
+
+def generate_html_users(users, schedule_list=None):
+    """Generate HTML for the USERS tab (yields fragments, one per user row)."""
+    if schedule_list is None:
+        schedule_list = load_schedules()
+    yield f"""
     <div id="users" class="tab-content">
         <h2>User Management</h2>
-        <form method="POST" action="/save_users">
+        <form method="POST" action="/save_users" onsubmit="countRows(this, 'usersTable')">
+            <input type="hidden" name="rows" value="{len(users)}" />
             <table class="edit-table">
                 <thead>
                     <tr>
@@ -201,60 +308,83 @@ def generate_html_users(users):
                         <th>CN</th>
                         <th>Name</th>
                         <th>Flag</th>
+                        <th>Group</th>
                         <th>Active</th>
                         <th>Action</th>
                     </tr>
                 </thead>
                 <tbody id="usersTable">
-                    {users_html}
+    """
+    for i, user in enumerate(users):
+        active_checked = "checked" if user.get('active', True) else ""
+        yield f"""
+        <tr data-fc="{user.get('FC', '')}" data-cn="{user.get('CN', '')}">
+            <td><input type="number" name="fc_{i}" value="{user.get('FC', '')}" /></td>
+            <td><input type="number" name="cn_{i}" value="{user.get('CN', '')}" /></td>
+            <td><input type="text" name="name_{i}" value="{user.get('Name', '')}" /></td>
+            <td><input type="text" name="flag_{i}" value="{user.get('Flag', '')}" /></td>
+            <td><input type="number" name="group_{i}" value="{user.get('group') or ''}" placeholder="any time" /></td>
+            <td><input type="checkbox" name="active_{i}" {active_checked} onchange="setUserActive(this)" /></td>
+            <td><button type="button" onclick="saveUserRow(this)">Save</button> <button type="button" onclick="deleteUser(this)">Delete</button></td>
+        </tr>
+        """
+    
+    if not users:
+        yield "<tr><td colspan='7'>No users defined</td></tr>"
+    
+    yield """
                 </tbody>
             </table>
             <div class="button-group">
                 <button type="button" onclick="addUserRow()">Add User</button>
-                <button type="submit">Save Users</button>
+                <button type="submit">Save All Users</button>
                 <button type="button" onclick="reloadUsers()">Reload</button>
             </div>
         </form>
+    """
+    yield from generate_html_schedules(schedule_list)
+    yield """
     </div>
     """
 
 def generate_html_events(events):
-    """Generate HTML for the EVENTS tab."""
-    events_html = ""
+    """Generate HTML for the EVENTS tab (yields fragments, one per event row)."""
+    yield f"""
+    <div id="events" class="tab-content">
+        <h2>Event Management</h2>
+        <form method="POST" action="/save_events" onsubmit="countRows(this, 'eventsTable')">
+            <input type="hidden" name="rows" value="{len(events)}" />
+            <table class="edit-table">
+                <thead>
+                    <tr>
+                        <th>FC</th>
+                        <th>CN</th>
+                        <th>Action</th>
+                        <th>Params (JSON)</th>
+                        <th>Action</th>
+                    </tr>
+                </thead>
+                <tbody id="eventsTable">
+    """
     for i, event in enumerate(events):
         fc_value = event.get('FC', '')
         cn_value = event.get('CN', '')
         action = event.get('action', '')
         params = json.dumps(event.get('params', {}))
-        events_html += f"""
+        yield f"""
         <tr>
             <td><input type="number" name="fc_{i}" value="{fc_value}" placeholder="-1 for event code" /></td>
             <td><input type="number" name="cn_{i}" value="{cn_value}" /></td>
             <td><input type="text" name="action_{i}" value="{action}" /></td>
             <td><textarea name="params_{i}" rows="2">{params}</textarea></td>
-            <td><button onclick="deleteEvent({i})">Delete</button></td>
+            <td><button type="button" onclick="deleteEvent(this, {event.get('id', -1)})">Delete</button></td>
         </tr>
         """
     
-    if not events_html:
-        events_html = "<tr><td colspan='5'>No events defined</td></tr>"
+    if not events:
+        yield "<tr><td colspan='5'>No events defined</td></tr>"
     
-    return f"""
-    <div id="events" class="tab-content">
-        <h2>Event Management</h2>
-        <form method="POST" action="/save_events">
-            <table class="edit-table">
-                <thead>
-                    <tr>
-                        <th>FC</th>
-                        <th>CN</th>
-                        <th>Action</th>
-                        <th>Params (JSON)</th>
-                        <th>Action</th>
-                    </tr>
-                </thead>
-                <tbody id="eventsTable">
-                    {events_html}
+    yield """
                 </tbody>
             </table>
             <div class="button-group">
@@ -268,10 +398,11 @@ def generate_html_events(events):
 
 def generate_html_config(config):
     """Generate HTML for the CONFIG tab."""
-    return f"""
+    yield f"""
     <div id="config" class="tab-content">
         <h2>Configuration</h2>
         <form method="POST" action="/save_config">
+            <input type="hidden" name="version" value="{config.version}" />
             <div class="config-form">
                 <label>Mode:</label>
                 <select name="MODE">
@@ -317,43 +448,177 @@ def generate_html_config(config):
         </form>
     </div>
     """
-        # {generate_html_home(config, users, events)}
-        # {generate_html_users(users)}
-        # {generate_html_events(events)}
-        # {generate_html_config(config)}
-def generate_full_html(config, users, events):
-    """Generate the complete HTML page."""
-    return f"""<!DOCTYPE html>
+
+def generate_html_actions(active=False):
+    """Generate the ACTIONS tab: pending door/light/buzzer actions and output states, with cancel buttons (yields fragments)."""
+    yield f"""
+    <div id="actions" class="tab-content{' active' if active else ''}">
+        <h2>Pending Actions</h2>
+        <table>
+            <thead>
+                <tr>
+                    <th>ID</th>
+                    <th>Action</th>
+                    <th>Output</th>
+                    <th>State</th>
+                    <th>Remaining</th>
+                    <th></th>
+                </tr>
+            </thead>
+            <tbody>
+    """
+    pending = scheduler.pending_actions()
+    for action in pending:
+        remaining = "until cancelled" if action['remaining_ms'] < 0 else f"{action['remaining_ms'] / 1000:.1f}s"
+        yield f"""
+        <tr>
+            <td>{action['id']}</td>
+            <td>{action['name']}</td>
+            <td>{action['output']}</td>
+            <td>{action['state']}</td>
+            <td>{remaining}</td>
+            <td><form method="POST" action="/cancel_action"><input type="hidden" name="id" value="{action['id']}" /><button type="submit">Cancel</button></form></td>
+        </tr>
+        """
+    
+    if not pending:
+        yield "<tr><td colspan='6'>No pending actions</td></tr>"
+    
+    yield """
+            </tbody>
+        </table>
+        <h2>Outputs</h2>
+        <table>
+            <thead>
+                <tr>
+                    <th>Output</th>
+                    <th>State</th>
+                    <th>Held by</th>
+                    <th></th>
+                </tr>
+            </thead>
+            <tbody>
+    """
+    for name, (on, holders) in scheduler.output_states().items():
+        yield f"""
+        <tr>
+            <td>{name}</td>
+            <td>{'ON' if on else 'off'}</td>
+            <td>{holders}</td>
+            <td><form method="POST" action="/cancel_action"><input type="hidden" name="output" value="{name}" /><button type="submit">Turn off</button></form></td>
+        </tr>
+        """
+    yield """
+            </tbody>
+        </table>
+        <div class="button-group">
+            <a href="/actions"><button type="button">Live view</button></a>
+        </div>
+    </div>
+    """
+
+def generate_actions_page():
+    """Generate the standalone /actions page, refreshed every 2 seconds (yields fragments)."""
+    yield f"""<!DOCTYPE html>
+<html>
+<head>
+    <title>OpenDoorSim Actions</title>
+    <meta http-equiv="refresh" content="2">
+    <link rel="stylesheet" href="{static_url('app.css')}">
+</head>
+<body>
+    <div class="container">
+    """
+    yield from generate_html_actions(active=True)
+    yield """
+        <div class="button-group"><a href="/"><button type="button">Back</button></a></div>
+    </div>
+</body>
+</html>"""
+
+# --- Static Assets ---
+# The page's CSS and JavaScript are files in static/, gzipped on a PC by
+# host/build_static.py and copied to the board next to their sources. They are
+# sent as stored, with Content-Encoding: gzip, and an ETag (a hash of the file,
+# computed once per boot). The page links them as /static/<name>?v=<etag>, so
+# browsers keep them for a year and only fetch them again once the link changes;
+# a request whose If-None-Match carries the current ETag is answered 304.
+
+STATIC_DIR = 'static'
+STATIC_TYPES = {'css': 'text/css', 'js': 'application/javascript', 'html': 'text/html', 'svg': 'image/svg+xml'}
+STATIC_MAX_AGE = 31536000 # 1 year
+_static_assets = {}  # name -> (etag, path, gzipped)
+
+def static_asset(name):
+    """Returns (etag, path, gzipped) for static/<name>, preferring the .gz, or None if there is neither."""
+    asset = _static_assets.get(name)
+    if asset is not None:
+        return asset
+    if '/' in name or name.startswith('.'):
+        return None
+    for path, gzipped in ((f"{STATIC_DIR}/{name}.gz", True), (f"{STATIC_DIR}/{name}", False)):
+        digest = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    block = f.read(SEND_CHUNK)
+                    if not block:
+                        break
+                    digest.update(block)
+        except OSError:
+            continue
+        asset = (binascii.hexlify(digest.digest()[:8]).decode(), path, gzipped)
+        _static_assets[name] = asset
+        return asset
+    return None
+
+def static_url(name):
+    """Versioned link to a static asset, so it can be cached until it changes."""
+    asset = static_asset(name)
+    return f"/{STATIC_DIR}/{name}?v={asset[0]}" if asset else f"/{STATIC_DIR}/{name}"
+
+def request_header(request, name):
+    """Value of header name in the request text, or ''."""
+    prefix = name.lower() + ':'
+    for line in request.split('\r\n\r\n', 1)[0].split('\n')[1:]:
+        if line.lower().startswith(prefix):
+            return line[len(prefix):].strip()
+    return ''
+
+async def send_static(writer, name, request):
+    """Sends static/<name> (gzipped when available), or 304 if the client's copy is current."""
+    asset = static_asset(name)
+    if asset is None:
+        await send(writer, "HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+        return
+    etag, path, gzipped = asset
+    cache = f'ETag: "{etag}"\r\nCache-Control: public, max-age={STATIC_MAX_AGE}\r\nVary: Accept-Encoding\r\n'
+    if f'"{etag}"' in request_header(request, 'If-None-Match'):
+        await send(writer, f"HTTP/1.1 304 Not Modified\r\n{cache}\r\n")
+        return
+    content_type = STATIC_TYPES.get(name.rsplit('.', 1)[-1], 'application/octet-stream')
+    encoding = "Content-Encoding: gzip\r\n" if gzipped else ""
+    await send(writer, f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n{encoding}"
+                       f"Content-Length: {os.stat(path)[6]}\r\n{cache}\r\n")
+    buf = bytearray(SEND_CHUNK)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            count = f.readinto(buf)
+            if not count:
+                break
+            writer.write(view[:count])
+            await writer.drain()
+
+# The page is sent as a sequence of fragments (see send_chunked), so the
+# largest string built is one table row however many users and events there are.
+
+PAGE_HEAD = """<!DOCTYPE html>
 <html>
 <head>
     <title>OpenDoorSim Home</title>
     <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-        body {{ font-family: Arial, sans-serif; background: #f5f5f5; padding: 20px; }}
-        .container {{ max-width: 1200px; margin: 0 auto; background: white; border-radius: 8px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-        .header {{ background: #2c3e50; color: white; padding: 20px; border-radius: 8px 8px 0 0; }}
-        .tabs {{ display: flex; background: #34495e; }}
-        .tab {{ padding: 15px 20px; cursor: pointer; color: white; border: none; background: transparent; }}
-        .tab:hover {{ background: #2c3e50; }}
-        .tab.active {{ background: #2c3e50; }}
-        .tab-content {{ display: none; padding: 20px; }}
-        .tab-content.active {{ display: block; }}
-        .status-grid {{ display: grid; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)); gap: 15px; margin: 20px 0; }}
-        .status-item {{ background: #ecf0f1; padding: 15px; border-radius: 5px; }}
-        .config-display {{ background: #ecf0f1; padding: 15px; border-radius: 5px; margin: 20px 0; }}
-        table {{ width: 100%; border-collapse: collapse; margin: 20px 0; }}
-        th, td {{ padding: 10px; text-align: left; border-bottom: 1px solid #ddd; }}
-        th {{ background: #34495e; color: white; }}
-        tr:hover {{ background: #f5f5f5; }}
-        .edit-table input, .edit-table textarea {{ width: 100%; padding: 5px; }}
-        .button-group {{ margin-top: 20px; }}
-        button {{ padding: 10px 20px; margin: 5px; background: #3498db; color: white; border: none; border-radius: 5px; cursor: pointer; }}
-        button:hover {{ background: #2980b9; }}
-        .config-form {{ display: grid; grid-template-columns: 150px 1fr; gap: 10px; align-items: center; margin: 20px 0; }}
-        .config-form label {{ font-weight: bold; }}
-        .config-form input, .config-form select {{ padding: 8px; }}
-    </style>
+    <link rel="stylesheet" href="{css}">
 </head>
 <body>
     <div class="container">
@@ -365,65 +630,26 @@ def generate_full_html(config, users, events):
             <button class="tab active" onclick="showTab('home')">Home</button>
             <button class="tab" onclick="showTab('users')">Users</button>
             <button class="tab" onclick="showTab('events')">Events</button>
+            <button class="tab" onclick="showTab('actions')">Actions</button>
             <button class="tab" onclick="showTab('config')">Config</button>
         </div>
-        
+"""
 
-    </div>
-    <script>
-        function showTab(tabName) {{
-            document.querySelectorAll(".tab-content").forEach(function(tab) {{ tab.classList.remove("active"); }});
-            document.querySelectorAll(".tab").forEach(function(tab) {{ tab.classList.remove("active"); }});
-            document.getElementById(tabName).classList.add("active");
-            event.target.classList.add("active");
-        }}
-        function rebootDevice() {{
-            if (confirm("Reboot device?")) {{
-                fetch("/reboot", {{method: "POST"}}).then(function() {{ location.reload(); }});
-            }}
-        }}
-        function addUserRow() {{
-            const table = document.getElementById("usersTable");
-            const row = table.insertRow();
-            const i = table.rows.length - 1;
-            row.innerHTML = `
-                <td><input type="number" name="fc_${{i}}" value="" /></td>
-                <td><input type="number" name="cn_${{i}}" value="" /></td>
-                <td><input type="text" name="name_${{i}}" value="" /></td>
-                <td><input type="text" name="flag_${{i}}" value="" /></td>
-                <td><input type="checkbox" name="active_${{i}}" checked /></td>
-                <td><button onclick="this.parentElement.parentElement.remove()">Delete</button></td>
-            `;
-        }}
-        function deleteUser(index) {{
-            if (confirm("Delete this user?")) {{
-                document.getElementById("usersTable").rows[index].remove();
-            }}
-        }}
-        function addEventRow() {{
-            const table = document.getElementById("eventsTable");
-            const row = table.insertRow();
-            const i = table.rows.length - 1;
-            row.innerHTML = `
-                <td><input type="number" name="fc_${{i}}" value="" placeholder="-1 for event code" /></td>
-                <td><input type="number" name="cn_${{i}}" value="" /></td>
-                <td><input type="text" name="action_${{i}}" value="" /></td>
-                <td><textarea name="params_${{i}}" rows="2">{{}}</textarea></td>
-                <td><button onclick="this.parentElement.parentElement.remove()">Delete</button></td>
-            `;
-        }}
-        function deleteEvent(index) {{
-            if (confirm("Delete this event?")) {{
-                document.getElementById("eventsTable").rows[index].remove();
-            }}
-        }}
-        function reloadUsers() {{ location.reload(); }}
-        function reloadEvents() {{ location.reload(); }}
-        function reloadConfig() {{ location.reload(); }}
-    </script>
+PAGE_TAIL = """    </div>
+    <script src="{js}"></script>
 </body>
 </html>"""
 
+def generate_full_html(config, users, events):
+    """Generate the complete HTML page as a generator of fragments."""
+    yield PAGE_HEAD.format(css=static_url('app.css'))
+    yield from generate_html_home(config, users, events)
+    yield from generate_html_users(users)
+    yield from generate_html_events(events)
+    yield from generate_html_actions()
+    yield from generate_html_config(config)
+    yield PAGE_TAIL.format(js=static_url('app.js'))
+
 def parse_post_data(data):
     """Parse POST form data."""
     params = {}
@@ -433,192 +659,753 @@ def parse_post_data(data):
         for pair in body.split('&'):
             if '=' in pair:
                 key, value = pair.split('=', 1)
-                params[key] = value.replace('+', ' ').replace('%3A', ':').replace('%2F', '/')
+                params[key] = url_decode(value)
     return params
 
-def handle_request(conn, addr):
-    """Handle HTTP request."""
+def url_decode(value):
+    """Decode a form-urlencoded value ('+' and %XX escapes)."""
+    value = value.replace('+', ' ')
+    if '%' not in value:
+        return value
+    parts = value.split('%')
+    data = bytearray(parts[0].encode())
+    for part in parts[1:]:
+        try:
+            data.append(int(part[:2], 16))
+            data.extend(part[2:].encode())
+        except ValueError:
+            data.extend(('%' + part).encode())
+    return data.decode('utf-8')
+
+def user_from_params(params):
+    """Build a users.json record from form fields fc, cn, name, flag, active."""
+    return {
+        'FC': int(params['fc']),
+        'CN': int(params['cn']),
+        'Name': params.get('name', ''),
+        'Flag': params.get('flag', ''),
+        'active': params.get('active', '1') not in ('0', '', 'false', 'off'),
+        'group': int(params['group']) if params.get('group', '') else 0
+    }
+
+def event_from_params(params):
+    """Build an events.json record from form fields fc, cn, action, params (JSON)."""
+    event = {'action': params['action']}
+    if params.get('fc', ''):
+        event['FC'] = int(params['fc'])
+    if params.get('cn', ''):
+        event['CN'] = int(params['cn'])
+    try:
+        event['params'] = json.loads(params.get('params', '{}'))
+    except:
+        event['params'] = {}
+    return event
+
+def form_rows(params):
+    """
+    Number of table rows a whole-table form submitted. The page sends the count
+    as 'rows'; a missing row or an extra one means the form arrived incomplete
+    (or was built by an old page) and raises ValueError, so replace() is never
+    called with part of the table.
+    """
+    try:
+        count = int(params['rows'])
+    except (KeyError, ValueError):
+        raise ValueError("no row count (reload the page and try again)")
+    for i in range(count + 1):
+        if (f'fc_{i}' in params) != (i < count):
+            raise ValueError(f"expected {count} rows, form is incomplete")
+    return count
+
+def users_from_form(params):
+    """Users from a /save_users form. Rows with FC and CN empty are skipped; any other bad row raises ValueError."""
+    users = []
+    for i in range(form_rows(params)):
+        if not params[f'fc_{i}'] and not params.get(f'cn_{i}', ''):
+            continue # Added but never filled in
+        try:
+            users.append({
+                'FC': int(params[f'fc_{i}']),
+                'CN': int(params[f'cn_{i}']),
+                'Name': params.get(f'name_{i}', ''),
+                'Flag': params.get(f'flag_{i}', ''),
+                'active': f'active_{i}' in params,
+                'group': int(params[f'group_{i}']) if params.get(f'group_{i}', '') else 0
+            })
+        except (KeyError, ValueError):
+            raise ValueError(f"row {i + 1} needs a numeric FC, CN and group")
+    return users
+
+def events_from_form(params):
+    """Events from a /save_events form. Rows without an action are skipped; any other bad row raises ValueError."""
+    events = []
+    for i in range(form_rows(params)):
+        action = params.get(f'action_{i}', '')
+        if not action:
+            continue
+        event = {'action': action}
+        try:
+            for name in ('fc', 'cn'):
+                if params.get(f'{name}_{i}', ''):
+                    event[name.upper()] = int(params[f'{name}_{i}'])
+            event['params'] = json.loads(params.get(f'params_{i}', '') or '{}')
+        except ValueError:
+            raise ValueError(f"row {i + 1} needs numeric FC/CN and JSON params")
+        events.append(event)
+    return events
+
+def handle_row_change(path, params):
+    """
+    Apply one /users/..., /events/... or /schedules/... change through the journal.
+    Returns (status, message).
+    """
+    try:
+        if path == '/users/add':
+            user = user_from_params(params)
+            if datastore.user_db.find(datastore.user_key(user)) is not None:
+                return 409, "a user with that FC/CN exists"
+            datastore.user_db.add(user)
+            return 200, "added"
+        if path == '/users/update':
+            # old_fc/old_cn select the row; the other fields are its new contents
+            key = (int(params['old_fc']), int(params['old_cn']))
+            user = user_from_params(params)
+            new_key = datastore.user_key(user)
+            if new_key != key and datastore.user_db.find(new_key) is not None:
+                return 409, "another user has that FC/CN"
+            done = datastore.user_db.update(key, user)
+        elif path == '/users/delete':
+            done = datastore.user_db.delete((int(params['fc']), int(params['cn'])))
+        elif path == '/users/active':
+            key = (int(params['fc']), int(params['cn']))
+            user = datastore.user_db.find(key)
+            if 'active' in params:
+                active = params['active'] not in ('0', '', 'false', 'off')
+            else:
+                active = user is not None and not user.get('active', True) # Toggle
+            done = datastore.user_db.set_active(key, active)
+        elif path == '/events/add':
+            event = datastore.event_db.add(event_from_params(params))
+            return 200, str(event['id'])
+        elif path == '/events/update':
+            event = event_from_params(params)
+            event['id'] = int(params['id'])
+            done = datastore.event_db.update(event['id'], event)
+        elif path == '/events/delete':
+            done = datastore.event_db.delete(int(params['id']))
+        elif path == '/schedules/save':
+            group = int(params['group'])
+            if group < 1:
+                raise ValueError("group must be 1 or more")
+            schedules.compile_hours(params.get('hours', '')) # Reject text that would not compile
+            datastore.schedule_db.add({'group': group, 'name': params.get('name', ''), 'hours': params.get('hours', '')})
+            return 200, "saved"
+        elif path == '/schedules/delete':
+            done = datastore.schedule_db.delete(int(params['group']))
+        else:
+            return 404, "unknown change"
+    except (KeyError, ValueError) as e:
+        return 400, f"bad request: {e}"
+    return (200, "ok") if done else (404, "no such row")
+
+# --- JSON API ---
+# /api/users, /api/events, /api/history and /api/config for scripts. Collections
+# are paged with ?offset=&limit= and streamed one record at a time through
+# send_chunked, so a response never holds the whole collection as JSON. Single
+# records are addressed as /api/users/<fc>/<cn>, /api/events/<id> and
+# /api/config/<NAME>; writes go through the same journal as the web page.
+#
+#   GET    /api/users?offset=0&limit=50   {"total": n, "offset": 0, "limit": 50, "items": [...]}
+#   POST   /api/users                     add a user (JSON body), 201; 409 if FC/CN exists
+#   GET    /api/users/<fc>/<cn>           one user
+#   PUT    /api/users/<fc>/<cn>           replace (the body may change FC/CN) or create it
+#   DELETE /api/users/<fc>/<cn>           204
+#   (events the same with /api/events/<id>; history is read-only)
+#   GET    /api/config                    every setting plus "version"
+#   PUT    /api/config                    {NAME: value, ..., "version": n}; 409 if stale
+#   GET    /api/config/<NAME>             {"name": NAME, "value": ...}
+#   PUT    /api/config/<NAME>             {"value": ...}
+
+API_DEFAULT_LIMIT = 50
+API_MAX_LIMIT = 200
+API_HIDDEN_FIELDS = ('MQTT_PASSWORD',) # Write-only through the API
+
+STATUS_REASONS = {200: 'OK', 201: 'Created', 204: 'No Content', 400: 'Bad Request', 404: 'Not Found',
+                  405: 'Method Not Allowed', 409: 'Conflict', 500: 'Internal Server Error'}
+
+class ApiError(Exception):
+    """An API request that cannot be served: status and message for the JSON error body."""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def split_query(path):
+    """Splits '/a/b?x=1&y=2' into ('/a/b', {'x': '1', 'y': '2'})."""
+    if '?' not in path:
+        return path, {}
+    path, query = path.split('?', 1)
+    params = {}
+    for pair in query.split('&'):
+        if '=' in pair:
+            key, value = pair.split('=', 1)
+            params[key] = url_decode(value)
+    return path, params
+
+def request_body(request):
+    """The body of a request's text (after the blank line), or ''."""
+    return request.split('\r\n\r\n', 1)[1] if '\r\n\r\n' in request else ''
+
+def json_body(request):
+    """The request body parsed as a JSON object. Raises ApiError(400) otherwise."""
+    try:
+        data = json.loads(request_body(request))
+    except ValueError:
+        raise ApiError(400, "body is not valid JSON")
+    if not isinstance(data, dict):
+        raise ApiError(400, "body must be a JSON object")
+    return data
+
+def page_bounds(params):
+    """(offset, limit) from ?offset=&limit=, limit clamped to API_MAX_LIMIT."""
+    try:
+        offset = max(0, int(params.get('offset', 0)))
+        limit = min(API_MAX_LIMIT, max(0, int(params.get('limit', API_DEFAULT_LIMIT))))
+    except ValueError:
+        raise ApiError(400, "offset and limit must be integers")
+    return offset, limit
+
+def json_page(items, total, offset, limit, to_json=None):
+    """Yields a page of items as a JSON object, a record at a time (each passed through to_json if given)."""
+    yield f'{{"total": {total}, "offset": {min(offset, total)}, "limit": {limit}, "items": ['
+    for index, item in enumerate(items):
+        item = item if to_json is None else to_json(item)
+        yield json.dumps(item) if index == 0 else ',' + json.dumps(item)
+    yield ']}'
+
+def user_from_json(data):
+    """Build a users.json record from an API body (FC and CN required)."""
+    try:
+        return {
+            'FC': int(data['FC']),
+            'CN': int(data['CN']),
+            'Name': str(data.get('Name', '')),
+            'Flag': str(data.get('Flag', '')),
+            'active': bool(data.get('active', True)),
+            'group': int(data.get('group') or 0)
+        }
+    except KeyError as e:
+        raise ApiError(400, f"missing {e}")
+    except (TypeError, ValueError) as e:
+        raise ApiError(400, f"bad user: {e}")
+
+def event_from_json(data):
+    """Build an events.json record from an API body (action required)."""
+    if not data.get('action'):
+        raise ApiError(400, "missing 'action'")
+    event = {'action': str(data['action'])}
+    try:
+        for name in ('FC', 'CN'):
+            if data.get(name) is not None:
+                event[name] = int(data[name])
+    except (TypeError, ValueError) as e:
+        raise ApiError(400, f"bad event: {e}")
+    event['params'] = data.get('params') if isinstance(data.get('params'), dict) else {}
+    return event
+
+def config_json(config):
+    data = config.to_dict()
+    for name in API_HIDDEN_FIELDS:
+        if data.get(name):
+            data[name] = '********'
+    data['version'] = config.version
+    return data
+
+def update_config(changes, version=None):
+    """Applies changes through Config.update, returning the config as JSON data."""
+    config = appconfig.get()
+    try:
+        config.update(changes, version)
+    except appconfig.ConfigConflict as e:
+        raise ApiError(409, str(e))
+    except ValueError as e:
+        raise ApiError(400, str(e))
+    return config_json(config)
+
+def _int_parts(parts, count):
+    if len(parts) != count:
+        raise ApiError(404, "no such resource")
+    try:
+        return [int(part) for part in parts]
+    except ValueError:
+        raise ApiError(404, "no such resource")
+
+def api_collection(method, db, parts, request, from_json, key_of):
+    """GET/POST on a collection or GET/PUT/DELETE on one of its records. Returns (status, data)."""
+    if not parts:
+        if method == 'POST':
+            record = from_json(json_body(request))
+            key = db.key_func(record)
+            if key is not None and db.find(key) is not None:
+                raise ApiError(409, "a record with that key exists; use PUT to replace it")
+            return 201, db.add(record)
+        raise ApiError(405, "use GET or POST")
+    key = key_of(parts)
+    if method == 'GET':
+        record = db.find(key)
+        if record is None:
+            raise ApiError(404, "no such record")
+        return 200, record
+    if method == 'PUT':
+        record = from_json(json_body(request))
+        new_key = db.key_func(record)
+        if new_key != key and db.find(new_key) is not None:
+            raise ApiError(409, "another record has the key in the body")
+        if db.update(key, record):
+            return 200, record
+        return 201, db.add(record)
+    if method == 'DELETE':
+        if not db.delete(key):
+            raise ApiError(404, "no such record")
+        return 204, None
+    raise ApiError(405, "use GET, PUT or DELETE")
+
+def api_request(method, path, request):
+    """
+    Serves one /api/ request. Returns (status, data), where data is an object to
+    send as JSON or a generator of JSON fragments (a collection page).
+    """
+    path, params = split_query(path)
+    parts = [part for part in path.split('/')[2:] if part]
+    if not parts:
+        raise ApiError(404, "no such resource")
+    name, parts = parts[0], parts[1:]
+    if method == 'GET' and name in ('users', 'events', 'history') and not parts:
+        offset, limit = page_bounds(params)
+        if name == 'history':
+            return 200, json_page(card_history[offset:offset + limit], len(card_history), offset, limit, history_json)
+        # With USER_STORE, users.json is paged from flash rather than loaded
+        db = datastore.user_db if name == 'users' else datastore.event_db
+        total, items = db.page(offset, limit)
+        return 200, json_page(items, total, offset, limit)
+    if name == 'users':
+        def user_key(parts):
+            return tuple(_int_parts(parts, 2))
+        return api_collection(method, datastore.user_db, parts, request, user_from_json, user_key)
+    if name == 'events':
+        def event_key(parts):
+            return _int_parts(parts, 1)[0]
+        def event_with_id(data):
+            event = event_from_json(data)
+            if parts:
+                event['id'] = event_key(parts) # PUT keeps the id in the URL
+            return event
+        return api_collection(method, datastore.event_db, parts, request, event_with_id, event_key)
+    if name == 'config':
+        config = appconfig.get()
+        if not parts:
+            if method == 'GET':
+                return 200, config_json(config)
+            if method in ('PUT', 'PATCH'):
+                changes = json_body(request)
+                version = changes.pop('version', None)
+                return 200, update_config(changes, version)
+            raise ApiError(405, "use GET or PUT")
+        setting = parts[0]
+        if len(parts) != 1 or setting not in config:
+            raise ApiError(404, "no such setting")
+        if method == 'PUT':
+            update_config({setting: json_body(request).get('value')})
+        elif method != 'GET':
+            raise ApiError(405, "use GET or PUT")
+        value = '********' if setting in API_HIDDEN_FIELDS and config[setting] else config[setting]
+        return 200, {'name': setting, 'value': value, 'version': config.version}
+    raise ApiError(404, "no such resource")
+
+async def send_json(writer, status, data):
+    """Sends an API response: data as JSON, or streamed chunked when it is a generator of fragments."""
+    head = f"HTTP/1.1 {status} {STATUS_REASONS.get(status, '')}\r\nContent-Type: application/json\r\n"
+    if data is None:
+        await send(writer, head + "Content-Length: 0\r\n\r\n")
+    elif isinstance(data, (dict, list)):
+        body = json.dumps(data).encode()
+        await send(writer, head + f"Content-Length: {len(body)}\r\n\r\n")
+        await send(writer, body)
+    else:
+        await send(writer, head + "Transfer-Encoding: chunked\r\n\r\n")
+        await send_chunked(writer, data)
+
+async def handle_api(writer, method, path, request):
+    try:
+        status, data = api_request(method, path, request)
+    except ApiError as e:
+        status, data = e.status, {'error': str(e)}
+    except OSError as e:
+        print(f"API error: {e}")
+        status, data = 500, {'error': "storage error"}
+    await send_json(writer, status, data)
+
+class RequestTooLarge(Exception):
+    """The request body is longer than MAX_BODY (answered 413, never handled in part)."""
+
+async def read_request(reader):
+    """
+    Reads one request: the request line, headers and a Content-Length body.
+    Returns (method, path, request text), or None if the client sent nothing.
+    Raises RequestTooLarge instead of reading a body over MAX_BODY.
+    """
+    head = []
+    length = 0
+    while len(head) < MAX_HEADER_LINES:
+        line = (await reader.readline()).decode('utf-8')
+        if not line or line in ('\r\n', '\n'):
+            break
+        head.append(line)
+        if line.lower().startswith('content-length:'):
+            length = int(line.split(':', 1)[1])
+    if not head:
+        return None
+    if length > MAX_BODY:
+        raise RequestTooLarge(length)
+    body = (await reader.readexactly(length)).decode('utf-8') if length else ''
+    method, path, _ = head[0].split(' ', 2)
+    return method, path, ''.join(head) + '\r\n' + body
+
+async def send(writer, data):
+    """Writes data SEND_CHUNK bytes at a time, yielding to other tasks after each piece."""
+    if isinstance(data, str):
+        data = data.encode()
+    for start in range(0, len(data), SEND_CHUNK):
+        writer.write(data[start:start + SEND_CHUNK])
+        await writer.drain()
+
+async def _write_chunk(writer, view, count):
+    writer.write(f"{count:x}\r\n".encode())
+    writer.write(view[:count]) # Copied by the stream if it cannot be sent at once
+    writer.write(b"\r\n")
+    await writer.drain()
+
+async def send_chunked(writer, fragments):
+    """
+    Sends an iterable of str/bytes fragments as a Transfer-Encoding: chunked body.
+    Fragments are packed into one SEND_CHUNK buffer that is reused for every chunk,
+    so memory use does not grow with the length of the response.
+    """
+    buf = bytearray(SEND_CHUNK)
+    view = memoryview(buf)
+    used = 0
+    for fragment in fragments:
+        data = memoryview(fragment.encode() if isinstance(fragment, str) else fragment)
+        start = 0
+        while start < len(data):
+            count = min(len(data) - start, SEND_CHUNK - used)
+            view[used:used + count] = data[start:start + count]
+            used += count
+            start += count
+            if used == SEND_CHUNK:
+                await _write_chunk(writer, view, used)
+                used = 0
+    if used:
+        await _write_chunk(writer, view, used)
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+async def handle_request(writer, method, path, request):
+    """Handle HTTP request (read by serve_client) and close the connection."""
     try:
-        request = conn.recv(1024).decode('utf-8')
-        if not request:
-            return
-        
-        # Parse request
-        request_line = request.split('\n')[0]
-        method, path, _ = request_line.split(' ', 2)
-        
-        # Load current data
-        config = load_config()
-        users = load_users() 
-        events = load_events() 
-        
         if path == '/' or path == '/index.html':
-            # Serve main page
-            html = generate_full_html(config, users, events) 
-            # html = "<h1>Hello World</h1>" # TODO: remove this, its just a test webpage
-            response = f"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: {len(html)}\r\n\r\n{html}"
-            conn.send(response.encode())
+            # Serve main page (users and events are only loaded by the routes that use them)
+            config = load_config()
+            users = load_users()
+            events = load_events()
+            await send(writer, "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nTransfer-Encoding: chunked\r\n\r\n")
+            await send_chunked(writer, generate_full_html(config, users, events))
             
-        elif path == '/save_users' and method == 'POST':
-            # Parse and save users
-            params = parse_post_data(request)
-            new_users = []
-            i = 0
-            while f'fc_{i}' in params:
-                try:
-                    fc = int(params.get(f'fc_{i}', '')) if params.get(f'fc_{i}', '') else None
-                    cn = int(params.get(f'cn_{i}', '')) if params.get(f'cn_{i}', '') else None
-                    if fc is not None and cn is not None:
-                        new_users.append({
-                            'FC': fc,
-                            'CN': cn,
-                            'Name': params.get(f'name_{i}', ''),
-                            'Flag': params.get(f'flag_{i}', ''),
-                            'active': f'active_{i}' in params
-                        })
-                except:
-                    pass
-                i += 1
+        elif path.startswith('/api/'):
+            # JSON API for provisioning and monitoring scripts
+            await handle_api(writer, method, path, request)
             
-            if save_users(new_users):
+        elif path.startswith('/static/'):
+            # CSS/JS shell, precompressed and cached by the browser
+            await send_static(writer, path[len('/static/'):].split('?', 1)[0], request)
+            
+        elif path == '/save_users' and method == 'POST':
+            # Parse and save users; nothing is saved unless every submitted row is valid
+            try:
+                new_users = users_from_form(parse_post_data(request))
+            except ValueError as e:
+                new_users = None
+                response = f"HTTP/1.1 400 Bad Request\r\nContent-Type: text/html\r\n\r\n<h1>Users not saved: {e}</h1><a href='/'>Back</a>"
+            if new_users is None:
+                pass
+            elif save_users(new_users):
                 response = "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n<h1>Users saved!</h1><a href='/'>Back</a>"
             else:
                 response = "HTTP/1.1 500 OK\r\nContent-Type: text/html\r\n\r\n<h1>Error saving users</h1>"
-            conn.send(response.encode())
+            await send(writer, response)
             
         elif path == '/save_events' and method == 'POST':
-            # Parse and save events
-            params = parse_post_data(request)
-            new_events = []
-            i = 0
-            while f'fc_{i}' in params:
-                try:
-                    fc_str = params.get(f'fc_{i}', '')
-                    cn_str = params.get(f'cn_{i}', '')
-                    fc = int(fc_str) if fc_str else None
-                    cn = int(cn_str) if cn_str else None
-                    action = params.get(f'action_{i}', '')
-                    params_json = params.get(f'params_{i}', '{}')
-                    
-                    if action:
-                        event = {'action': action}
-                        if fc is not None:
-                            event['FC'] = fc
-                        if cn is not None:
-                            event['CN'] = cn
-                        try:
-                            event['params'] = json.loads(params_json)
-                        except:
-                            event['params'] = {}
-                        new_events.append(event)
-                except Exception as e:
-                    print(f"Error parsing event {i}: {e}")
-                i += 1
-            
-            if save_events(new_events):
+            # Parse and save events; nothing is saved unless every submitted row is valid
+            try:
+                new_events = events_from_form(parse_post_data(request))
+            except ValueError as e:
+                new_events = None
+                response = f"HTTP/1.1 400 Bad Request\r\nContent-Type: text/html\r\n\r\n<h1>Events not saved: {e}</h1><a href='/'>Back</a>"
+            if new_events is None:
+                pass
+            elif save_events(new_events):
                 response = "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n<h1>Events saved!</h1><a href='/'>Back</a>"
             else:
                 response = "HTTP/1.1 500 OK\r\nContent-Type: text/html\r\n\r\n<h1>Error saving events</h1>"
-            conn.send(response.encode())
+            await send(writer, response)
+            
+        elif method == 'POST' and (path.startswith('/users/') or path.startswith('/events/') or path.startswith('/schedules/')):
+            # Single-row change, appended to the users/events journal
+            status, message = handle_row_change(path, parse_post_data(request))
+            reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 409: 'Conflict'}[status]
+            response = f"HTTP/1.1 {status} {reason}\r\nContent-Type: text/plain\r\nContent-Length: {len(message)}\r\n\r\n{message}"
+            await send(writer, response)
             
         elif path == '/save_config' and method == 'POST':
             # Parse and save config
-            params = parse_post_data(request)
-            new_config = config.copy()
+            status, message = save_config(parse_post_data(request))
+            reason = {200: 'OK', 400: 'Bad Request', 409: 'Conflict', 500: 'Internal Server Error'}[status]
+            response = f"HTTP/1.1 {status} {reason}\r\nContent-Type: text/html\r\n\r\n<h1>{message}</h1><a href='/'>Back</a>"
+            await send(writer, response)
             
-            if 'MODE' in params:
-                new_config['MODE'] = params['MODE']
-            if 'MRACS_ENABLED' in params:
-                new_config['MRACS_ENABLED'] = True
-            else:
-                new_config['MRACS_ENABLED'] = False
-            if 'D0_PIN' in params:
-                new_config['D0_PIN'] = int(params['D0_PIN'])
-            if 'D1_PIN' in params:
-                new_config['D1_PIN'] = int(params['D1_PIN'])
-            if 'SCL_PIN' in params:
-                new_config['SCL_PIN'] = int(params['SCL_PIN'])
-            if 'SDA_PIN' in params:
-                new_config['SDA_PIN'] = int(params['SDA_PIN'])
-            if 'SCREEN_WIDTH' in params:
-                new_config['SCREEN_WIDTH'] = int(params['SCREEN_WIDTH'])
-            if 'SCREEN_HEIGHT' in params:
-                new_config['SCREEN_HEIGHT'] = int(params['SCREEN_HEIGHT'])
-            if 'MQTT_BROKER' in params:
-                new_config['MQTT_BROKER'] = params['MQTT_BROKER']
-            if 'MQTT_PORT' in params:
-                new_config['MQTT_PORT'] = int(params['MQTT_PORT'])
-            if 'MQTT_CLIENT_ID' in params:
-                new_config['MQTT_CLIENT_ID'] = params['MQTT_CLIENT_ID']
+        elif path == '/actions':
+            # Pending timed actions and output states
+            await send(writer, "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nTransfer-Encoding: chunked\r\n\r\n")
+            await send_chunked(writer, generate_actions_page())
             
-            if save_config(new_config):
-                response = "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n<h1>Config saved! Reboot required.</h1><a href='/'>Back</a>"
-            else:
-                response = "HTTP/1.1 500 OK\r\nContent-Type: text/html\r\n\r\n<h1>Error saving config</h1>"
-            conn.send(response.encode())
+        elif path == '/cancel_action' and method == 'POST':
+            # Cancel one action by id, or every action on an output
+            params = parse_post_data(request)
+            try:
+                if params.get('id'):
+                    scheduler.cancel(int(params['id']))
+                elif params.get('output'):
+                    scheduler.cancel_output(params['output'])
+                else:
+                    raise ValueError("no id or output")
+                response = "HTTP/1.1 303 See Other\r\nLocation: /actions\r\n\r\n"
+            except ValueError:
+                response = "HTTP/1.1 400 Bad Request\r\nContent-Type: text/plain\r\nContent-Length: 11\r\n\r\nbad request"
+            await send(writer, response)
+            
+        elif path == '/set_time' and method == 'POST':
+            # Set the RTC (used by access schedules) from the browser's local time
+            params = parse_post_data(request)
+            try:
+                import machine
+                machine.RTC().datetime(tuple(int(params[name]) for name in
+                                             ('year', 'month', 'day', 'weekday', 'hour', 'minute', 'second')) + (0,))
+                response = "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nok"
+            except (KeyError, ValueError):
+                response = "HTTP/1.1 400 Bad Request\r\nContent-Type: text/plain\r\nContent-Length: 11\r\n\r\nbad request"
+            await send(writer, response)
             
         elif path == '/reboot' and method == 'POST':
             response = "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n<h1>Rebooting...</h1>"
-            conn.send(response.encode())
-            conn.close()
-            utime.sleep(1)
+            await send(writer, response)
+            await close(writer)
+            await asyncio.sleep(1)
             import machine
             machine.reset()
             
         else:
             # 404
             response = "HTTP/1.1 404 Not Found\r\nContent-Type: text/html\r\n\r\n<h1>404 Not Found</h1>"
-            conn.send(response.encode())
+            await send(writer, response)
             
     except Exception as e:
         print(f"Error handling request: {e}")
         try:
             response = "HTTP/1.1 500 Internal Server Error\r\n\r\n"
-            conn.send(response.encode())
+            await send(writer, response)
         except:
             pass
     finally:
-        conn.close()
+        datastore.user_db.release() # With USER_STORE, users.json is not kept in RAM between requests
+        await close(writer)
+
+async def close(writer):
+    """Closes a connection, ignoring a client that already went away."""
+    try:
+        writer.close()
+        await writer.wait_closed()
+    except Exception:
+        pass
+
+# --- Live Feed ---
+# GET /feed is a Server-Sent Events stream carrying every card read as it is
+# added to the history (from trigger_card_read_event and handle_raw_mode):
+#
+#   id: 7
+#   event: card
+#   data: {"timestamp": ..., "fc": 123, "cn": 45678, "hex": "F6B2DC", "result": "Granted", ...}
+#
+# Each read is encoded once and the same bytes are queued for every subscriber.
+# A subscriber's queue holds at most FEED_QUEUE_SIZE reads; when a slow client
+# falls behind its oldest reads are dropped and it is sent a 'dropped' event
+# with the count instead, so a stalled browser costs a fixed amount of RAM and
+# never holds up the main loop. A comment line is sent every FEED_KEEPALIVE_S
+# so connections that went away are noticed and freed.
+
+FEED_MAX_CLIENTS = 4
+FEED_QUEUE_SIZE = 8
+FEED_KEEPALIVE_S = 15
+_feed_id = 0
+
+class FeedClient:
+    """One /feed subscriber: a bounded queue of encoded events and a wake-up flag."""
+    __slots__ = ('queue', 'dropped', 'ready')
+
+    def __init__(self):
+        self.queue = []
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+    def push(self, message):
+        if len(self.queue) >= FEED_QUEUE_SIZE:
+            self.queue.pop(0)
+            self.dropped += 1
+        self.queue.append(message)
+        self.ready.set()
+
+def publish_card(entry):
+    """Queues a history entry for every /feed subscriber."""
+    global _feed_id
+    _feed_id += 1
+    message = f"id: {_feed_id}\nevent: card\ndata: {json.dumps(history_json(entry))}\n\n".encode()
+    for client in feed_clients:
+        client.push(message)
+
+async def serve_feed(writer):
+    """Streams card reads to one subscriber until it disconnects."""
+    if len(feed_clients) >= FEED_MAX_CLIENTS:
+        try:
+            await send(writer, "HTTP/1.1 503 Service Unavailable\r\nRetry-After: 10\r\nContent-Length: 0\r\n\r\n")
+        except Exception:
+            pass
+        await close(writer)
+        return
+    client = FeedClient()
+    feed_clients.append(client)
+    try:
+        await send(writer, "HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\nretry: 3000\n\n")
+        while True:
+            try:
+                await asyncio.wait_for(client.ready.wait(), FEED_KEEPALIVE_S)
+            except asyncio.TimeoutError:
+                await send(writer, ": keepalive\n\n")
+                continue
+            client.ready.clear()
+            if client.dropped:
+                dropped, client.dropped = client.dropped, 0
+                await send(writer, f"event: dropped\ndata: {dropped}\n\n")
+            while client.queue:
+                await send(writer, client.queue.pop(0))
+    except Exception:
+        pass # Client went away
+    finally:
+        feed_clients.remove(client)
+        await close(writer)
+
+# --- Server ---
+# The server is a uasyncio task. Each connection runs as its own coroutine and
+# yields whenever it waits on the socket or has written SEND_CHUNK bytes, so
+# several clients are served at once and none of them holds the CPU for long.
+#
+# main.py keeps its own synchronous loop and calls process_requests() when the
+# readers are idle. That runs the event loop for at most WEB_SLICE_MS and
+# returns as soon as busy() reports a card being read or queued, so a swipe
+# never waits for a page to finish. start_server() runs the loop forever, for
+# using the web interface on its own.
+
+MAX_CLIENTS = 3          # Connections served at once; more are answered 503
+REQUEST_TIMEOUT_S = 5    # Time a client has to send its request
+CLIENT_TIMEOUT_S = 30    # Time a connection may stay open in all
+MAX_HEADER_LINES = 32
+MAX_BODY = 8192          # Longest request body read
+SEND_CHUNK = 512         # Bytes written per step
+WEB_SLICE_MS = 20        # Longest process_requests() runs the server for
+
+_loop = asyncio.new_event_loop()
+_server = None
+_clients = 0
+
+async def serve_client(reader, writer):
+    """Connection callback: limits concurrent clients and the time each may take."""
+    global _clients
+    if _clients >= MAX_CLIENTS:
+        try:
+            await send(writer, "HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n\r\n")
+        except Exception:
+            pass
+        await close(writer)
+        return
+    _clients += 1
+    feed = False
+    try:
+        request = await asyncio.wait_for(read_request(reader), REQUEST_TIMEOUT_S)
+        if request is None:
+            await close(writer)
+            return
+        method, path, request = request
+        if path == '/feed':
+            feed = True # Served below, outside the request slots and time limit
+        else:
+            await asyncio.wait_for(handle_request(writer, method, path, request), CLIENT_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        print("Web client timed out")
+        await close(writer)
+    except RequestTooLarge as e:
+        message = f"Request body of {e} bytes is over the {MAX_BODY} byte limit; nothing was changed."
+        try:
+            await send(writer, f"HTTP/1.1 413 Payload Too Large\r\nContent-Type: text/plain\r\n"
+                               f"Content-Length: {len(message)}\r\nConnection: close\r\n\r\n{message}")
+        except Exception:
+            pass
+        await close(writer)
+    except Exception as e:
+        print(f"Error reading request: {e}")
+        await close(writer)
+    finally:
+        _clients -= 1
+    if feed:
+        await serve_feed(writer)
+
+async def _start(port):
+    global _server
+    _server = await asyncio.start_server(serve_client, '0.0.0.0', port, backlog=5)
 
 def start_server(port=80):
-    """Start the web server."""
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(('0.0.0.0', port))
-    s.listen(5)
+    """Start the web server and run it forever (blocks)."""
+    _loop.run_until_complete(_start(port))
     print(f"Web server started on port {port}")
     print(f"Access at http://{get_ap_ip()}")
-    
-    while True:
-        try:
-            conn, addr = s.accept()
-            handle_request(conn, addr)
-        except Exception as e:
-            print(f"Server error: {e}")
-            utime.sleep(1)
-
-# For non-blocking operation
-server_socket = None
+    _loop.run_forever()
 
 def start_server_non_blocking(port=80):
-    """Start web server in non-blocking mode."""
-    global server_socket
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.settimeout(0.1)  # Non-blocking
-    server_socket.bind(('0.0.0.0', port))
-    server_socket.listen(5)
+    """Start the web server task; process_requests() then runs it from the main loop."""
+    _loop.run_until_complete(_start(port))
     print(f"Web server started (non-blocking) on port {port}")
 
-def process_requests():
-    """Process pending web server requests (call this in main loop)."""
-    global server_socket
-    if server_socket:
-        try:
-            conn, addr = server_socket.accept()
-            handle_request(conn, addr)
-        except OSError:
-            pass  # No connection pending
-        except Exception as e:
-            print(f"Error processing request: {e}")
+async def _slice(budget_ms, busy):
+    deadline = utime.ticks_add(utime.ticks_ms(), budget_ms)
+    while utime.ticks_diff(deadline, utime.ticks_ms()) > 0:
+        if busy is not None and busy():
+            return
+        await asyncio.sleep(0.001) # Lets the server tasks run and polls their sockets
 
+def process_requests(busy=None, budget_ms=WEB_SLICE_MS):
+    """
+    Run the web server for up to budget_ms (call this in main loop). busy() is
+    checked between steps; returning True hands control back at once.
+    """
+    if _server is None:
+        return
+    try:
+        _loop.run_until_complete(_slice(budget_ms, busy))
+    except Exception as e:
+        print(f"Error processing request: {e}")
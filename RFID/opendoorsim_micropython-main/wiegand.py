@@ -0,0 +1,485 @@
+# wiegand.py - Interrupt-driven Wiegand reader capture
+
+from array import array
+from machine import Pin
+import machine
+import utime
+import micropython
+from micropython import const
+import formats
+
+# --- Capture State ---
+# Bits are shifted into 32-bit words: bit 0 of the frame ends up in the MSB of
+# word 0 and the last (partial) word is right-aligned. The ISRs only touch
+# preallocated arrays, so they never allocate or look anything up in a dict.
+_S_BIT_COUNT = const(0)   # Bits captured in the current frame
+_S_LAST_PULSE = const(1)  # utime.ticks_us() of the most recent pulse
+_S_FIRST_PULSE = const(2) # utime.ticks_us() of the first pulse of the current frame
+_S_MAX_GAP = const(3)     # Longest inter-pulse gap (us) seen in the current frame
+_S_MIN_GAP = const(4)     # Shortest accepted inter-pulse gap (us) in the current frame
+_S_GAP_SUM = const(5)     # Sum of accepted inter-pulse gaps (us), for the mean
+_S_GLITCHES = const(6)    # Pulses rejected by the glitch filter in the current frame
+_S_SIZE = const(7)
+
+# --- Completed Frame Queue ---
+# Finished frames are pushed into a preallocated ring of slots so the main loop
+# can decode and display them at its own pace without losing the next swipe.
+# Each slot is [bit count, first/last pulse ticks, gap stats, words...]; with
+# pulse capture the per-pulse gaps are kept in a parallel array('H') ring.
+_F_BITS = const(0)
+_F_FIRST_PULSE = const(1)
+_F_LAST_PULSE = const(2)
+_F_MIN_GAP = const(3)
+_F_MAX_GAP = const(4)
+_F_GAP_SUM = const(5)
+_F_GLITCHES = const(6)
+_F_WORDS = const(7)
+FRAME_META_SIZE = const(6) # Fields copied out by pop_frame(): first pulse .. glitches
+_R_HEAD = const(0)      # Next slot to write
+_R_TAIL = const(1)      # Next slot to read
+_R_COUNT = const(2)     # Frames waiting to be processed
+_R_DROPPED = const(3)   # Frames lost because the ring was full
+_R_SLOTS = const(4)     # Capacity
+_R_SLOT_SIZE = const(5) # Words per slot
+_R_JUNK = const(6)      # Frames discarded as noise before decoding
+_R_MAX_BITS = const(7)  # Gaps per slot in the gap ring
+
+# First end-of-frame check (ms) for a reader whose pulse timing is not learned yet
+_FIRST_CHECK_MS = const(10)
+
+# --- Interrupt Service Routines (ISRs) ---
+# The pulse handlers are closures built per reader, so the bit value, buffers and
+# MAX_BITS are captured constants. The emitter is 'viper' (default), 'native' or
+# 'python' (fallback for ports/builds without the native emitters).
+# A pulse arriving less than glitch_filter_us after the previous one is counted
+# as a glitch and ignored, so EMI spikes on long D0/D1 runs do not become bits.
+
+try:
+    ptr32
+except NameError:
+    # Outside the viper emitter (e.g. host-side CPython runs) ptr32/ptr16 are not builtins
+    def ptr32(buf):
+        return buf
+    ptr16 = ptr32
+
+def _make_viper_handler(bit_value, words, state, gaps, max_bits, min_gap_us, ticks_us, on_first_pulse):
+    @micropython.viper
+    def handler(pin_obj):
+        s = ptr32(state)
+        n = s[0]
+        t = int(ticks_us())
+        if n < int(max_bits):
+            if n:
+                g = (t - s[1]) & 0x3FFFFFFF # ticks_us wraps at 2**30
+                if g < int(min_gap_us):
+                    s[6] = s[6] + 1
+                    return
+                if g > s[3]:
+                    s[3] = g
+                if g < s[4]:
+                    s[4] = g
+                s[5] = s[5] + g
+                if gaps:
+                    d = ptr16(gaps)
+                    d[n] = g if g < 0xFFFF else 0xFFFF
+            else:
+                s[2] = t
+                s[3] = 0
+                s[4] = 0x3FFFFFFF
+                s[5] = 0
+                s[6] = 0
+                on_first_pulse()
+            w = ptr32(words)
+            i = n >> 5
+            if n & 31:
+                w[i] = (w[i] << 1) | int(bit_value)
+            else:
+                w[i] = int(bit_value)
+            s[0] = n + 1
+        s[1] = t
+    return handler
+
+def _make_native_handler(bit_value, words, state, gaps, max_bits, min_gap_us, ticks_us, on_first_pulse):
+    @micropython.native
+    def handler(pin_obj):
+        n = state[0]
+        t = ticks_us()
+        if n < max_bits:
+            if n:
+                g = (t - state[1]) & 0x3FFFFFFF # ticks_us wraps at 2**30
+                if g < min_gap_us:
+                    state[6] += 1
+                    return
+                if g > state[3]:
+                    state[3] = g
+                if g < state[4]:
+                    state[4] = g
+                state[5] += g
+                if gaps:
+                    gaps[n] = g if g < 0xFFFF else 0xFFFF
+            else:
+                state[2] = t
+                state[3] = 0
+                state[4] = 0x3FFFFFFF
+                state[5] = 0
+                state[6] = 0
+                on_first_pulse()
+            i = n >> 5
+            if n & 31:
+                words[i] = (words[i] << 1) | bit_value
+            else:
+                words[i] = bit_value
+            state[0] = n + 1
+        state[1] = t
+    return handler
+
+def _make_python_handler(bit_value, words, state, gaps, max_bits, min_gap_us, ticks_us, on_first_pulse):
+    def handler(pin_obj):
+        n = state[0]
+        t = ticks_us()
+        if n < max_bits:
+            if n:
+                g = (t - state[1]) & 0x3FFFFFFF # ticks_us wraps at 2**30
+                if g < min_gap_us:
+                    state[6] += 1
+                    return
+                if g > state[3]:
+                    state[3] = g
+                if g < state[4]:
+                    state[4] = g
+                state[5] += g
+                if gaps:
+                    gaps[n] = g if g < 0xFFFF else 0xFFFF
+            else:
+                state[2] = t
+                state[3] = 0
+                state[4] = 0x3FFFFFFF
+                state[5] = 0
+                state[6] = 0
+                on_first_pulse()
+            i = n >> 5
+            if n & 31:
+                words[i] = (words[i] << 1) | bit_value
+            else:
+                words[i] = bit_value
+            state[0] = n + 1
+        state[1] = t
+    return handler
+
+_HANDLER_FACTORIES = {
+    'viper': _make_viper_handler,
+    'native': _make_native_handler,
+    'python': _make_python_handler,
+}
+
+def _no_op():
+    pass
+
+class WiegandReader:
+    """
+    One Wiegand reader on a D0/D1 pin pair, with its own capture buffers, ISRs,
+    end-of-frame timer, learned timing and completed-frame queue.
+
+    End of frame: the first pulse arms a one-shot machine.Timer; on expiry
+    close_frame() is handed to micropython.schedule and either re-arms for the
+    time still needed or queues the frame. Without a timer, poll() does the same
+    check from the main loop.
+
+    Adaptive end of frame: the ISRs track the longest gap in the frame, and
+    completed frames of a known length feed a running average of the gap. While
+    pulses are arriving the timer sleeps until the next known format length could
+    have ended. A frame closes after gap_multiplier x gap of silence, or
+    after only 2 x gap if its bit count matches a known format and its parity
+    validates. timeout_ms is always the upper bound.
+    """
+
+    def __init__(self, reader_id, d0_pin, d1_pin, max_bits=96, queue_size=8,
+                 timeout_ms=200, emitter='viper', timer_id=None, adaptive=True,
+                 gap_multiplier=4, glitch_filter_us=0, min_frame_bits=4,
+                 max_glitches=2, pulse_capture=False):
+        self.id = reader_id
+        self.d0_pin_num = d0_pin
+        self.d1_pin_num = d1_pin
+        self.pin_d0 = None
+        self.pin_d1 = None
+        self.max_bits = max_bits
+        self.timeout_us = timeout_ms * 1000
+        self.adaptive = adaptive
+        self.gap_multiplier = gap_multiplier
+        self.min_frame_bits = min_frame_bits
+        self.max_glitches = max_glitches
+        self.learned_gap_us = 0    # Average longest inter-pulse gap of recent frames
+        self.learned_period_us = 0 # Average mean inter-pulse gap of recent frames
+        self.first_check_ms = min(_FIRST_CHECK_MS, timeout_ms) # First end-of-frame check of a new frame
+
+        # Capture buffers (written by the ISRs)
+        words_per_frame = (max_bits + 31) // 32
+        self.words_per_frame = words_per_frame
+        self.words = array('I', [0] * words_per_frame)
+        self.check_words = array('I', [0] * words_per_frame) # Copy parity-checked with IRQs enabled
+        self.state = array('i', [0] * _S_SIZE)
+        self.gaps = array('H', [0] * max_bits) if pulse_capture else None
+
+        # Completed frame ring
+        slot_size = _F_WORDS + words_per_frame
+        self.ring = array('I', [0] * (queue_size * slot_size))
+        self.gap_ring = array('H', [0] * (queue_size * max_bits)) if pulse_capture else None
+        self.ring_state = array('i', [0, 0, 0, 0, queue_size, slot_size, 0, max_bits if pulse_capture else 0])
+
+        # Bound methods are created once here so the IRQ/timer paths never allocate them
+        self._close_frame_cb = self.close_frame
+        self._timer_expired_cb = self._timer_expired
+        self.timer = None
+        on_first_pulse = _no_op
+        if timer_id is not None:
+            try:
+                self.timer = machine.Timer(timer_id)
+                on_first_pulse = self.arm_timer
+            except Exception as e:
+                print(f"[{reader_id}] Frame timer unavailable ({e}), polling for end of frame")
+
+        factory = _HANDLER_FACTORIES.get(emitter, _make_python_handler)
+        for bit_value in (0, 1):
+            args = (bit_value, self.words, self.state, self.gaps, max_bits,
+                    glitch_filter_us, utime.ticks_us, on_first_pulse)
+            try:
+                handler = factory(*args)
+            except Exception as e:
+                print(f"[{reader_id}] ISR emitter '{emitter}' unavailable ({e}), using python handlers")
+                factory = _make_python_handler
+                handler = factory(*args)
+            if bit_value:
+                self.d1_pulse_handler = handler # Handles a pulse on the D1 line (bit value 1)
+            else:
+                self.d0_pulse_handler = handler # Handles a pulse on the D0 line (bit value 0)
+
+    # --- Pins ---
+
+    def start(self):
+        """Configures the D0/D1 pins and attaches the pulse ISRs."""
+        self.reset()
+        self.pin_d0 = Pin(self.d0_pin_num, Pin.IN, Pin.PULL_UP)
+        self.pin_d1 = Pin(self.d1_pin_num, Pin.IN, Pin.PULL_UP)
+        self.pin_d0.irq(trigger=Pin.IRQ_FALLING, handler=self.d0_pulse_handler)
+        self.pin_d1.irq(trigger=Pin.IRQ_FALLING, handler=self.d1_pulse_handler)
+
+    def stop(self):
+        """Detaches the pulse ISRs and stops the frame timer."""
+        if self.pin_d0: self.pin_d0.irq(handler=None)
+        if self.pin_d1: self.pin_d1.irq(handler=None)
+        if self.timer: self.timer.deinit()
+
+    # --- Capture Buffer ---
+
+    def reset(self):
+        """Resets the bit counter for the next card read."""
+        # Called from within a critical (IRQ-disabled) section. The words do not
+        # need clearing: the ISRs overwrite each word on its first bit.
+        self.state[_S_BIT_COUNT] = 0
+
+    def is_reading(self):
+        """Returns True while a frame is being captured."""
+        return self.state[_S_BIT_COUNT] > 0
+
+    def is_junk_frame(self, bits):
+        """Returns True if the captured frame of 'bits' bits is noise rather than a card read."""
+        return bits < self.min_frame_bits or self.state[_S_GLITCHES] > self.max_glitches
+
+    # --- Frame Queue ---
+
+    def push_frame(self):
+        """
+        Moves the frame currently in the capture buffer into the ring and resets capture.
+        Must be called with IRQs disabled. Returns False if the frame was discarded as
+        junk or dropped (and counted) because the ring is full.
+        """
+        rs = self.ring_state
+        state = self.state
+        ring = self.ring
+        bits = state[_S_BIT_COUNT]
+        self.reset()
+        if self.is_junk_frame(bits):
+            rs[_R_JUNK] += 1
+            return False
+        if rs[_R_COUNT] >= rs[_R_SLOTS]:
+            rs[_R_DROPPED] += 1
+            return False
+        slot = rs[_R_HEAD]
+        base = slot * rs[_R_SLOT_SIZE]
+        ring[base + _F_BITS] = bits
+        ring[base + _F_FIRST_PULSE] = state[_S_FIRST_PULSE]
+        ring[base + _F_LAST_PULSE] = state[_S_LAST_PULSE]
+        ring[base + _F_MIN_GAP] = state[_S_MIN_GAP] if bits > 1 else 0
+        ring[base + _F_MAX_GAP] = state[_S_MAX_GAP]
+        ring[base + _F_GAP_SUM] = state[_S_GAP_SUM]
+        ring[base + _F_GLITCHES] = state[_S_GLITCHES]
+        base += _F_WORDS
+        for i in range((bits + 31) >> 5):
+            ring[base + i] = self.words[i]
+        if self.gap_ring is not None:
+            base = slot * rs[_R_MAX_BITS]
+            for i in range(bits):
+                self.gap_ring[base + i] = self.gaps[i]
+        rs[_R_HEAD] = (slot + 1) % rs[_R_SLOTS]
+        rs[_R_COUNT] += 1
+        return True
+
+    def pop_frame(self, out_words, out_meta, out_gaps=None):
+        """
+        Copies the oldest queued frame into out_words and its timing into out_meta
+        (first pulse ticks, last pulse ticks, min gap, max gap, gap sum, glitches).
+        With pulse capture, out_gaps receives the gap before each pulse.
+        Returns the frame's bit count, or 0 if the ring is empty.
+        """
+        rs = self.ring_state
+        ring = self.ring
+        irq_state = machine.disable_irq()
+        if rs[_R_COUNT] == 0:
+            machine.enable_irq(irq_state)
+            return 0
+        slot = rs[_R_TAIL]
+        base = slot * rs[_R_SLOT_SIZE]
+        bits = ring[base + _F_BITS]
+        for i in range(FRAME_META_SIZE):
+            out_meta[i] = ring[base + _F_FIRST_PULSE + i]
+        base += _F_WORDS
+        for i in range((bits + 31) >> 5):
+            out_words[i] = ring[base + i]
+        if out_gaps is not None and self.gap_ring is not None:
+            base = slot * rs[_R_MAX_BITS]
+            for i in range(bits):
+                out_gaps[i] = self.gap_ring[base + i]
+        rs[_R_TAIL] = (slot + 1) % rs[_R_SLOTS]
+        rs[_R_COUNT] -= 1
+        machine.enable_irq(irq_state)
+        return bits
+
+    def pending(self):
+        """Returns the number of completed frames waiting to be processed."""
+        return self.ring_state[_R_COUNT]
+
+    def dropped(self):
+        """Returns the number of frames lost because the queue was full."""
+        return self.ring_state[_R_DROPPED]
+
+    def junk(self):
+        """Returns the number of frames discarded as noise."""
+        return self.ring_state[_R_JUNK]
+
+    def stats(self):
+        """Returns the frame queue occupancy, overflow and junk counters."""
+        rs = self.ring_state
+        return {
+            'pending': rs[_R_COUNT],
+            'dropped': rs[_R_DROPPED],
+            'junk': rs[_R_JUNK],
+            'capacity': rs[_R_SLOTS]
+        }
+
+    # --- End-of-Frame Detection ---
+
+    def _timer_expired(self, timer):
+        try:
+            micropython.schedule(self._close_frame_cb, 0)
+        except RuntimeError:
+            self.arm_timer(1) # Schedule queue full, try again shortly
+
+    def arm_timer(self, period_ms=0):
+        """(Re)starts the one-shot end-of-frame timer; 0 means the first check of a new frame."""
+        if not period_ms:
+            period_ms = self.first_check_ms
+        self.timer.init(mode=machine.Timer.ONE_SHOT, period=period_ms, callback=self._timer_expired_cb)
+
+    def _learn_frame_timing(self, bits, gap_us, gap_sum):
+        """Folds the timing of a completed known-length frame (longest gap, gap sum) into the running averages."""
+        if not gap_us or bits not in formats.FORMAT_CANDIDATES:
+            return
+        period_us = gap_sum // (bits - 1)
+        if self.learned_gap_us:
+            self.learned_gap_us = (3 * self.learned_gap_us + gap_us) // 4
+            self.learned_period_us = (3 * self.learned_period_us + period_us) // 4
+        else:
+            self.learned_gap_us = gap_us
+            self.learned_period_us = period_us
+        # A new frame is first checked when the shortest known format could have ended.
+        # Computed here because arm_timer() runs in the ISR and must not allocate.
+        shortest = min(formats.FORMAT_CANDIDATES)
+        first_check_us = (shortest - 1) * self.learned_period_us + 2 * self.learned_gap_us
+        self.first_check_ms = min(first_check_us // 1000 + 1, self.timeout_us // 1000)
+
+    def _next_frame_end_us(self, bits, gap_us, gap_sum):
+        """
+        Time from the last pulse until a frame of 'bits' bits so far could be complete:
+        2 x gap of silence at a known length, otherwise the remaining pulses of the
+        next longer known format plus that silence.
+        """
+        if bits in formats.FORMAT_CANDIDATES:
+            return 2 * gap_us # This may already be the whole frame
+        next_bits = 0
+        for known_bits in formats.FORMAT_CANDIDATES:
+            if known_bits > bits and (not next_bits or known_bits < next_bits):
+                next_bits = known_bits
+        if not next_bits:
+            return self.gap_multiplier * gap_us
+        # The remaining pulses are timed at this frame's mean spacing, so jitter in
+        # the longest gap does not add up into the next swipe
+        period_us = gap_sum // (bits - 1) if bits > 1 else gap_us
+        return (next_bits - bits) * period_us + 2 * gap_us
+
+    def check_frame_end(self):
+        """
+        Decides whether the frame being captured is complete and queues it if so.
+        IRQs are disabled only to copy the counters and words and to queue the
+        frame; the parity check runs on the copy with IRQs enabled, so pulses on
+        other readers are never held off behind it. Returns 0 if nothing is
+        pending any more, otherwise the number of microseconds to wait before
+        checking again.
+        """
+        state = self.state
+        irq_state = machine.disable_irq()
+        bits = state[_S_BIT_COUNT]
+        last_pulse = state[_S_LAST_PULSE]
+        max_gap = state[_S_MAX_GAP]
+        gap_sum = state[_S_GAP_SUM]
+        for i in range((bits + 31) >> 5):
+            self.check_words[i] = self.words[i]
+        machine.enable_irq(irq_state)
+        if bits == 0:
+            return 0
+        idle_us = utime.ticks_diff(utime.ticks_us(), last_pulse)
+        limit_us = self.timeout_us
+        if self.adaptive:
+            # Once learned, the reader's own gap is trusted over this frame's longest gap,
+            # which includes the idle line if two swipes have already run together
+            gap_us = self.learned_gap_us or max_gap
+            if gap_us:
+                early_us = 2 * gap_us
+                if idle_us < early_us:
+                    # Pulses are still arriving: wait until the frame could next be complete
+                    return max(self._next_frame_end_us(bits, gap_us, gap_sum), early_us) - idle_us
+                if bits in formats.FORMAT_CANDIDATES and formats.select_format(formats.words_to_int(self.check_words, bits), bits)[1]:
+                    limit_us = early_us
+                else:
+                    limit_us = min(limit_us, self.gap_multiplier * gap_us)
+        if idle_us < limit_us:
+            return limit_us - idle_us
+        irq_state = machine.disable_irq()
+        if state[_S_BIT_COUNT] != bits or state[_S_LAST_PULSE] != last_pulse:
+            machine.enable_irq(irq_state)
+            return 1 # A pulse arrived during the check, so the frame goes on
+        self.push_frame()
+        machine.enable_irq(irq_state)
+        if self.adaptive:
+            self._learn_frame_timing(bits, max_gap, gap_sum)
+        return 0
+
+    def close_frame(self, _):
+        """Scheduled on timer expiry: queues the frame if it is complete, else re-arms."""
+        wait_us = self.check_frame_end()
+        if wait_us:
+            self.arm_timer((wait_us + 999) // 1000)
+
+    def poll(self):
+        """Main-loop end-of-frame check for readers without a frame timer."""
+        if self.timer is None and self.state[_S_BIT_COUNT] > 0:
+            self.check_frame_end()